@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+
+ROUTE_TTL = 900  # Seconds a cached route stays valid
+WARM_DAYS = 90  # Level combinations seen in outbox_sp_tickets during this window are warmed
+ROUTE_IDLE = 6 * 3600  # Routes not used for this long are evicted instead of refreshed
+
+ACTION_PROCEDURE = "msb_api.tk_get_action_by_level"
+ROUTE_COMBINATIONS = """
+    SELECT DISTINCT
+        coalesce(c_PhanLoai,'') as L1,
+        coalesce(c_NhomYeuCau,'') as L2,
+        coalesce(c_DanhMucYeuCau,'') as L3
+    FROM jwdb.outbox_sp_tickets
+    WHERE dateModified >= NOW() - INTERVAL %s DAY
+    """
+
+# (L1, L2, L3) -> (dòng Status/Email/Type/Object/API... hoặc None nếu thủ tục không trả về, thời điểm nạp)
+action_routes = {}
+action_routes_lock = threading.Lock()
+route_last_used = {}  # (L1, L2, L3) -> thời điểm được tra gần nhất
+route_stats = {"hits": 0, "misses": 0, "calls": 0}
+
+
+def call_action_procedure(cursor, l1, l2, l3):
+    """
+    Gọi tk_get_action_by_level và đọc hết các result set, trả về dòng đầu tiên dạng dict.
+    Dùng callproc()/stored_results() (có từ mysql-connector 8.x) thay cho cursor.nextset().
+    """
+    cursor.callproc(ACTION_PROCEDURE, (l1, l2, l3, ""))
+    route_stats["calls"] += 1
+    row = None
+    for result in cursor.stored_results():
+        rows = result.fetchall()
+        if row is None and rows and result.description:
+            row = dict(zip([col[0] for col in result.description], rows[0]))
+    return row
+
+
+def get_action_route(cursor, l1, l2, l3):
+    """
+    Trả về dòng định tuyến của bộ (L1, L2, L3) từ cache. Chỉ gọi thủ tục khi chưa có
+    hoặc đã quá ROUTE_TTL; kết quả rỗng cũng được cache để không gọi lại liên tục.
+    """
+    key = (l1, l2, l3)
+    route_last_used[key] = time.time()
+    cached = action_routes.get(key)
+    if cached is not None and time.time() - cached[1] < ROUTE_TTL:
+        route_stats["hits"] += 1
+        return cached[0]
+    route_stats["misses"] += 1
+    row = call_action_procedure(cursor, l1, l2, l3)
+    with action_routes_lock:
+        action_routes[key] = (row, time.time())
+    return row
+
+
+def warm_action_routes(cursor, keys=None):
+    """
+    Nạp trước định tuyến cho các bộ level. Mặc định lấy các bộ đã xuất hiện trong
+    outbox_sp_tickets WARM_DAYS ngày gần nhất cùng với các bộ được tra trong ROUTE_IDLE giây qua.
+    """
+    if keys is None:
+        cursor.execute(ROUTE_COMBINATIONS, (WARM_DAYS,))
+        keys = {tuple(row) for row in cursor.fetchall()}
+        keys.update(key for key in list(action_routes) if not _is_idle(key, time.time()))
+    loaded = 0
+    for key in keys:
+        try:
+            row = call_action_procedure(cursor, *key)
+        except Exception as e:
+            logging.error(f"Error loading action route {key}: {e}")
+            continue
+        with action_routes_lock:
+            action_routes[key] = (row, time.time())
+        loaded += 1
+    logging.info(f"Warmed {loaded} action routes")
+    return loaded
+
+
+def _is_idle(key, now):
+    return now - route_last_used.get(key, 0) > ROUTE_IDLE
+
+
+def evict_idle_routes():
+    """Xóa các bộ level không được tra trong ROUTE_IDLE giây, để không làm mới chúng mãi."""
+    now = time.time()
+    with action_routes_lock:
+        keys = [key for key in action_routes if _is_idle(key, now)]
+        for key in keys:
+            del action_routes[key]
+            route_last_used.pop(key, None)
+    if keys:
+        logging.info(f"Evicted {len(keys)} idle action routes")
+    return len(keys)
+
+
+def expiring_route_keys(margin):
+    """Các bộ level đang được dùng sẽ hết hạn trong `margin` giây tới; bộ không dùng bị xóa."""
+    evict_idle_routes()
+    deadline = time.time() - ROUTE_TTL + margin
+    return [key for key, (_, loaded_at) in list(action_routes.items()) if loaded_at < deadline]
+
+
+def invalidate_action_routes(l1=None, l2=None, l3=None):
+    """Xóa cache định tuyến; truyền L1/L2/L3 để chỉ xóa các bộ khớp."""
+    with action_routes_lock:
+        if l1 is None and l2 is None and l3 is None:
+            removed = len(action_routes)
+            action_routes.clear()
+        else:
+            keys = [
+                key for key in action_routes
+                if (l1 is None or key[0] == l1) and (l2 is None or key[1] == l2) and (l3 is None or key[2] == l3)
+            ]
+            for key in keys:
+                del action_routes[key]
+            removed = len(keys)
+    logging.info(f"Invalidated {removed} action routes")
+    return removed
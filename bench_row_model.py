@@ -0,0 +1,169 @@
+"""
+Benchmark the outbox assignment row model of xuly_luong_ticket.py.
+
+Compares the old pandas path (pd.DataFrame from the cursor rows, assignments.loc[[index]],
+isinstance(..., pd.Series) guards) with row_model.Row. Each mode runs in a fresh interpreter
+so import time (worker cold start) and peak RSS are measured separately.
+
+    python bench_row_model.py [--count 5000] [--repeat 5]
+
+No database is needed: rows are synthesised with the columns of ASSIGNMENT_SELECT.
+The pandas column needs `pip install pandas`; without it that mode prints "failed".
+
+Result (Python 3.11, pandas 3.0.6, --count 5000 --repeat 5):
+
+    mode      cold start (ms)  per assignment (us)  peak RSS (MB)
+    pandas              385.1               2849.6           92.9
+    rows                  0.6                  6.4           39.4
+"""
+import argparse
+import ast
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+# Các cột được hot path đọc cho mỗi assignment (match_and_fetch_status, build_change_note, handler_its_ho)
+ACCESSED_COLUMNS = [
+    "ticket_index", "id", "Nhom", "L1", "L2", "L3", "L4", "flag", "don_vi_gan", "createdBy",
+    "c_source", "c_individual", "c_CapDoXuLy", "c_PhanLoai", "c_NhomYeuCau", "c_DanhMucYeuCau",
+    "c_ChiTietYeuCau", "c_level5", "c_DonViGan", "c_MucDo", "c_content", "c_sla_phanHoiKH",
+    "c_huongxl", "c_user_pheDuyet", "c_pheDuyet", "dateModified", "modifiedBy", "c_maTicket",
+]
+
+
+def assignment_columns():
+    """Tên cột (alias) của ASSIGNMENT_SELECT, đọc từ mã nguồn để không phải import worker."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "xuly_luong_ticket.py")
+    with open(path, encoding="utf-8") as file:
+        tree = ast.parse(file.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and getattr(node.targets[0], "id", "") == "ASSIGNMENT_SELECT":
+            select = node.value.value
+            break
+    else:
+        raise RuntimeError("ASSIGNMENT_SELECT not found")
+    body = select.split("SELECT", 1)[1].rsplit("FROM", 1)[0]
+    columns = []
+    for item in re.split(r",\s*\n", body):
+        item = item.strip().rstrip(",").strip()
+        if item:
+            columns.append(re.split(r"\s+as\s+", item, flags=re.I)[-1].strip())
+    return columns
+
+
+def synthesise(columns, count):
+    now = datetime(2025, 1, 1)
+    records = []
+    for i in range(count):
+        record = []
+        for col in columns:
+            if col == "ticket_index":
+                record.append(i + 1)
+            elif col.startswith("date") or col == "c_thoigian_Tiepnhan":
+                record.append(now + timedelta(seconds=i))
+            elif col == "id":
+                record.append(f"ticket-{i // 3}")
+            else:
+                record.append(f"{col}-{i % 97}")
+        records.append(tuple(record))
+    return records
+
+
+class FakeCursor:
+    def __init__(self, columns, records):
+        self.description = [(col,) for col in columns]
+        self.records = records
+
+    def execute(self, query, params=()):
+        pass
+
+    def fetchall(self):
+        return self.records
+
+
+def run_rows(columns, records, repeat):
+    started = time.perf_counter()
+    from row_model import fetch_rows
+    import_s = time.perf_counter() - started
+
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        assignments = fetch_rows(FakeCursor(columns, records), "")
+        for assignment in assignments:
+            for col in ACCESSED_COLUMNS:
+                assignment[col]
+            assignment.get("c_type_ticket_ho", "")
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return import_s, best
+
+
+def run_pandas(columns, records, repeat):
+    started = time.perf_counter()
+    import pandas as pd
+    import_s = time.perf_counter() - started
+
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        assignments = pd.DataFrame.from_records(records, columns=columns)
+        for index in assignments.index:
+            assignment = assignments.loc[index]
+            one_row = assignments.loc[[index]]
+            for col in ACCESSED_COLUMNS:
+                assignment[col]
+                value = one_row[col]
+                value if not isinstance(value, pd.Series) else value.iloc[0]
+            assignment.get("c_type_ticket_ho", "")
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return import_s, best
+
+
+def child(mode, count, repeat):
+    columns = assignment_columns()
+    records = synthesise(columns, count)
+    runner = run_rows if mode == "rows" else run_pandas
+    import_s, elapsed = runner(columns, records, repeat)
+    print(json.dumps({
+        "mode": mode,
+        "import_ms": import_s * 1000,
+        "per_assignment_us": elapsed / count * 1e6,
+        # ru_maxrss: KB trên Linux
+        "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--mode", choices=["rows", "pandas"])
+    args = parser.parse_args()
+    if args.mode:
+        child(args.mode, args.count, args.repeat)
+        return
+
+    print(f"{args.count} assignments, {len(ACCESSED_COLUMNS)} fields read per assignment, best of {args.repeat}")
+    print(f"{'mode':<8} {'cold start (ms)':>16} {'per assignment (us)':>20} {'peak RSS (MB)':>14}")
+    for mode in ("pandas", "rows"):
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--mode", mode,
+             "--count", str(args.count), "--repeat", str(args.repeat)],
+            capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            print(f"{mode:<8} failed: {result.stderr.strip().splitlines()[-1] if result.stderr else result.returncode}")
+            continue
+        data = json.loads(result.stdout)
+        print(f"{mode:<8} {data['import_ms']:>16.1f} {data['per_assignment_us']:>20.1f} {data['rss_mb']:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
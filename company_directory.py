@@ -0,0 +1,240 @@
+import logging
+import re
+import threading
+import time
+from collections import namedtuple
+
+from sla_rule_matcher import fold
+
+RELOAD_CHECK_INTERVAL = 60  # Seconds between COUNT/MAX(dateModified) checks
+
+# ORDER BY id: cùng thứ tự quét khóa chính của câu `%s LIKE company_code` cũ
+COMPANY_QUERY = """
+    SELECT company_code, loaihinh, mnemonic, com_manager
+    FROM jwdb.app_fd_etl_company
+    ORDER BY id
+    """
+COMPANY_VERSION_QUERY = "SELECT COUNT(*), MAX(dateModified) FROM jwdb.app_fd_etl_company"
+# Chưa nạp được index lần nào: dùng lại các câu SQL cũ
+COMPANY_LIKE_QUERY = """
+    SELECT company_code, loaihinh, mnemonic, com_manager
+    FROM jwdb.app_fd_etl_company
+    WHERE %s like company_code
+    ORDER BY id
+    """
+COMPANY_CODE_QUERY = """
+    SELECT company_code, loaihinh, mnemonic, com_manager
+    FROM jwdb.app_fd_etl_company
+    WHERE company_code = %s
+    ORDER BY id LIMIT 1
+    """
+
+Company = namedtuple("Company", ["company_code", "loaihinh", "mnemonic", "com_manager"])
+
+
+def compile_like(pattern):
+    """Biên dịch mẫu LIKE (% _ và escape \\) thành regex, so khớp trên chuỗi đã fold()."""
+    parts = []
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == "\\" and i + 1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        elif ch == "%":
+            parts.append(".*")
+        elif ch == "_":
+            parts.append(".")
+        else:
+            parts.append(re.escape(ch))
+        i += 1
+    return re.compile("".join(parts), re.DOTALL)
+
+
+class CompanyIndex:
+    """
+    Bảng app_fd_etl_company trong bộ nhớ.
+    - like_exact: mã không có ký tự đại diện, tra bằng hash (LIKE không bỏ dấu cách cuối);
+    - patterns: mã có % _ \\, giữ theo thứ tự dòng;
+    - by_code: tra `company_code = %s` (bỏ dấu cách cuối như collation PAD SPACE).
+    """
+
+    def __init__(self, rows):
+        self.companies = [Company(*row) for row in rows]
+        self.like_exact = {}
+        self.patterns = []
+        self.by_code = {}
+        for position, company in enumerate(self.companies):
+            if company.company_code is None:
+                continue
+            code = fold(company.company_code)
+            self.by_code.setdefault(code.rstrip(" "), position)
+            if any(ch in code for ch in "%_\\"):
+                self.patterns.append((position, compile_like(code)))
+            else:
+                self.like_exact.setdefault(code, []).append(position)
+
+    def match(self, value):
+        """Các công ty có `value LIKE company_code`, theo thứ tự dòng như câu SQL."""
+        if value is None:
+            return []
+        value = fold(value)
+        positions = list(self.like_exact.get(value, ()))
+        positions.extend(position for position, regex in self.patterns if regex.fullmatch(value))
+        return [self.companies[position] for position in sorted(positions)]
+
+    def get(self, company_code):
+        if company_code is None:
+            return None
+        position = self.by_code.get(fold(company_code).rstrip(" "))
+        return None if position is None else self.companies[position]
+
+
+company_state = {"index": CompanyIndex([]), "version": None, "checked_at": 0, "loaded_at": 0, "refreshing": False}
+company_lock = threading.Lock()
+
+
+def is_stale():
+    return time.time() - company_state["checked_at"] > RELOAD_CHECK_INTERVAL
+
+
+def refresh_companies(cursor, force=False):
+    """
+    Nạp lại app_fd_etl_company khi số dòng hoặc MAX(dateModified) thay đổi (kiểm tra tối đa
+    mỗi RELOAD_CHECK_INTERVAL giây). Truy vấn chạy ngoài lock và chỉ một thread nạp; index mới
+    được dựng xong rồi mới thay cho index cũ.
+    """
+    if cursor is None or (not force and not is_stale()):
+        return
+    with company_lock:
+        if company_state["refreshing"] or (not force and not is_stale()):
+            return
+        company_state["refreshing"] = True
+        known_version = company_state["version"]
+    try:
+        cursor.execute(COMPANY_VERSION_QUERY)
+        version = tuple(cursor.fetchall()[0])
+        index = None
+        if force or version != known_version:
+            cursor.execute(COMPANY_QUERY)
+            index = CompanyIndex(cursor.fetchall())
+        with company_lock:
+            if index is not None:
+                company_state["index"] = index
+                company_state["version"] = version
+                company_state["loaded_at"] = time.time()
+            company_state["checked_at"] = time.time()
+        if index is not None:
+            logging.info(f"Company directory: {len(index.companies)} companies, {len(index.patterns)} wildcard codes")
+    except Exception as e:
+        logging.error(f"Error loading company directory: {e}")
+    finally:
+        with company_lock:
+            company_state["refreshing"] = False
+
+
+def invalidate_companies():
+    """Buộc lần tra cứu tiếp theo kiểm tra lại bảng (dùng cho reload nóng)."""
+    company_state["version"] = None
+    company_state["checked_at"] = 0
+
+
+def _query_companies(cursor, query, value):
+    # Index chưa nạp được lần nào: không trả kết quả rỗng mà hỏi thẳng DB (không có cursor thì báo lỗi)
+    if cursor is None:
+        raise RuntimeError("Company directory has never been loaded")
+    cursor.execute(query, (value,))
+    return [Company(*row) for row in cursor.fetchall()]
+
+
+def match_companies(cursor, value):
+    """Thay cho `SELECT ... FROM jwdb.app_fd_etl_company WHERE %s like company_code`."""
+    refresh_companies(cursor)
+    if not company_state["loaded_at"]:
+        return [] if value is None else _query_companies(cursor, COMPANY_LIKE_QUERY, value)
+    return company_state["index"].match(value)
+
+
+def get_company(cursor, company_code):
+    """Thay cho `SELECT ... FROM jwdb.app_fd_etl_company WHERE company_code = %s`."""
+    refresh_companies(cursor)
+    if not company_state["loaded_at"]:
+        if company_code is None:
+            return None
+        companies = _query_companies(cursor, COMPANY_CODE_QUERY, company_code)
+        return companies[0] if companies else None
+    return company_state["index"].get(company_code)
+
+
+def get_loaihinh(cursor, don_vi_gan):
+    """Kết quả như fetchall() của câu `SELECT loaihinh ... WHERE %s like company_code`."""
+    return [(company.loaihinh,) for company in match_companies(cursor, don_vi_gan)]
+
+
+def get_mnemonic(cursor, company_code):
+    company = get_company(cursor, company_code)
+    return company.mnemonic if company else None
+
+
+def get_com_manager(cursor, company_code):
+    company = get_company(cursor, company_code)
+    return company.com_manager if company else None
+
+
+def verify_against_sql(cursor, samples=None):
+    """
+    So sánh index với các câu SQL cũ. Mặc định dùng mã đơn vị, mnemonic và các biến thể
+    (chữ thường, thêm/bớt ký tự, dấu cách cuối) làm tham số. Câu LIKE cũ không có ORDER BY,
+    nên cùng tập kết quả nhưng khác thứ tự được đếm riêng trong "order".
+    """
+    cursor.execute(COMPANY_QUERY)
+    index = CompanyIndex(cursor.fetchall())
+    if samples is None:
+        found = set()
+        for company in index.companies:
+            for value in (company.company_code, company.mnemonic):
+                if value:
+                    found.update([value, value.lower(), value + " ", value[:-1], value + "0", "x" + value])
+        samples = sorted(found)
+
+    report = {"checked": 0, "equal": 0, "order": 0, "mismatches": []}
+    for value in samples:
+        cursor.execute("SELECT loaihinh FROM jwdb.app_fd_etl_company WHERE %s like company_code", (value,))
+        sql_like = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT mnemonic FROM jwdb.app_fd_etl_company WHERE company_code = %s", (value,))
+        sql_equal = [row[0] for row in cursor.fetchall()]
+        memory_like = [company.loaihinh for company in index.match(value)]
+        company = index.get(value)
+        report["checked"] += 1
+        equal_ok = (company.mnemonic if company else None) == (sql_equal[0] if sql_equal else None)
+        if memory_like == sql_like and equal_ok:
+            report["equal"] += 1
+        elif sorted(map(str, memory_like)) == sorted(map(str, sql_like)) and equal_ok:
+            report["order"] += 1
+        else:
+            report["mismatches"].append({"value": value, "sql": (sql_like, sql_equal), "memory": (memory_like, company)})
+    return report
+
+
+if __name__ == "__main__":
+    import os
+    from configparser import ConfigParser
+
+    import mysql.connector
+
+    logging.basicConfig(level=logging.INFO)
+    config = ConfigParser()
+    config.read(os.path.join(os.path.dirname(__file__), "common_config", "config.ini"))
+    db = config["mysql_slave"]
+    conn = mysql.connector.connect(
+        host=db["host"], user=db["user"], password=db["password"], database=db["database"]
+    )
+    try:
+        report = verify_against_sql(conn.cursor())
+        print(f"app_fd_etl_company: {report['checked']} checked, {report['equal']} equal, "
+              f"{report['order']} order only, {len(report['mismatches'])} mismatches")
+        for mismatch in report["mismatches"][:20]:
+            print(mismatch)
+        raise SystemExit(1 if report["mismatches"] else 0)
+    finally:
+        conn.close()
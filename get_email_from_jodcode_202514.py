@@ -1,5 +1,7 @@
-import re
 import logging
+from level_dictionary import get_level_names
+import company_directory
+import recipient_directory
 def get_ticket_by_maticket(cursor, maticket):
     query = """
     SELECT c_DonViGan, c_phanLoai, c_DanhMucYeuCau, c_NhomYeuCau, c_individual
@@ -18,57 +20,17 @@ def get_ticket_by_maticket(cursor, maticket):
     return dict(zip(columns, result))
 
 def fetch_data(cursor, phanloai_id, nhomyeucau_id, danhmucyeucau_id):
-    query_l1 = """
-        SELECT a.c_ten_phan_loai
-        FROM jwdb.app_fd_sp_phanloai a
-        WHERE id = %s
-        """
-    cursor.execute(query_l1, (phanloai_id,))
-    result_1 = cursor.fetchone()
-    l1 = result_1[0] if result_1 else ""
-
-    query_l2 = """
-        SELECT n.c_ten_nhom_yeucau
-        FROM jwdb.app_fd_sp_nhomyeucau n
-        WHERE id = %s
-        """
-    cursor.execute(query_l2, (nhomyeucau_id,))
-    result_2 = cursor.fetchone()
-    l2 = result_2[0] if result_2 else ""
-
-    query_l3 = """
-        SELECT d.c_ten_danh_muc_yeucau
-        FROM jwdb.app_fd_sp_danhmucyeucau d
-        WHERE id = %s
-        """
-    cursor.execute(query_l3, (danhmucyeucau_id,))
-    result_3 = cursor.fetchone()
-    l3 = result_3[0] if result_3 else ""
-
+    l1, l2, l3, _ = get_level_names(cursor, phanloai_id, nhomyeucau_id, danhmucyeucau_id)
     return l1, l2, l3
     
 def get_recipient_emails_no_don_vi_gan(cursor, jobcode, logging):
     """
     Lấy danh sách email của người nhận dựa trên jobcode.
     """
-    # new_don_vi_gan = don_vi_gan.split("-")[0].strip()
-    # logging.info(f"don_vi_gan: {new_don_vi_gan}")
-    cursor.execute("SET SESSION group_concat_max_len = 9999999999;")
     logging.info(f"jobcode:  {jobcode}")
-    jobcode_list = jobcode.split(";")  # Tách thành danh sách
-    placeholders = ",".join(["%s"] * len(jobcode_list))  # Tạo placeholders (%s, %s, ...)
-    logging.info(f"placeholders {placeholders}")
-    query = f"""
-        SELECT GROUP_CONCAT(DISTINCT m.email SEPARATOR ';') AS email
-        FROM jwdb.app_fd_etl_email m
-        WHERE m.jobcode IN ({placeholders}) ;
-    """
-    logging.info(f"placeholders {placeholders}")
-    # params = tuple(jobcode_list) + (new_don_vi_gan,)  
-
-    cursor.execute(query, jobcode_list) 
-    result = cursor.fetchone()    
-    return result[0] if result[0] else None
+    # Đường này xưa nay chỉ tách theo ";"
+    emails = recipient_directory.get_emails(cursor, jobcode, separators=";")
+    return ";".join(emails) if emails else None
 
     
 def get_email_from_SPDV(L1, L2, L3, Nhom, logging):
@@ -105,26 +67,12 @@ def get_email_RR(cursor, logging):
 
 def get_jobcode(donvigan, jodcode_key, cursor, logging):
     new_donvigan = 'Chi nhánh' if donvigan == 'CN'  or donvigan == 'PGDL' else 'Phòng giao dịch' if donvigan == 'PGD' else None
-    query = """
-    SELECT c_tong_hop_jobcode,c_tong_hop_jobcode_cha
-    FROM jwdb.app_fd_sp_jobcode
-    WHERE c_loai_donvi = %s
-    AND c_don_vi = %s
-    LIMIT 1;
-    """
-    
-    # Execute the query with the provided parameters
-    cursor.execute(query, (new_donvigan, jodcode_key))
-    
-    # Fetch the result
-    result = cursor.fetchone()
-    
-    # Check if a result is found and return the value of c_tong_hop_jobcode
+    if new_donvigan is None:
+        return None
+    result = recipient_directory.get_jobcode(cursor, new_donvigan, jodcode_key)
     if result:
         logging.info(f"jobcode: {result[0]}")
-        return result[0], result[1]  # Assuming the jobcode is the first column in the result
-    else:
-        return None  # Or handle it if no result is found
+    return result
 
 def get_email_NPV(L1, L2, logging):
     email_map = {
@@ -144,43 +92,16 @@ def get_recipient_emails(cursor, jobcode, don_vi_gan, logging):
     """
     Lấy danh sách email của người nhận dựa trên jobcode.
     """
-    
-    cursor.execute("SET SESSION group_concat_max_len = 9999999999;")
     logging.info(f"jobcode:  {jobcode}")
-    jobcode_list = re.split(r"[;,]", jobcode) # Tách thành danh sách
-    placeholders = ",".join(["%s"] * len(jobcode_list))  # Tạo placeholders (%s, %s, ...)
-    logging.info(f"placeholders {placeholders}")
-    query = f"""
-        SELECT GROUP_CONCAT(DISTINCT m.email SEPARATOR ';') AS email
-        FROM jwdb.app_fd_etl_company c
-        JOIN jwdb.app_fd_etl_email m ON c.company_code = m.madonvi
-        -- JOIN jwdb.app_fd_etl_cf_jobcode j ON m.jobcode = j.JOBCODE
-        WHERE m.jobcode IN ({placeholders}) AND c.company_code = %s
-    """
-    logging.info(f"placeholders {placeholders}")
-    params = tuple(jobcode_list) + (don_vi_gan,)  
-
-    cursor.execute(query, params) 
-    result = cursor.fetchone()
-    logging.info(f"result {result}")
-    return result[0] if result[0] else ""
+    if don_vi_gan is None:
+        return ""
+    emails = recipient_directory.get_emails(cursor, jobcode, don_vi_gan)
+    logging.info(f"result {emails}")
+    return ";".join(emails)
 
 def get_don_vi_gan_cha(cursor, donvigan ):
     logging.info(f"{donvigan}")
-    query = """
-    select com_manager 
-    from jwdb.app_fd_etl_company where company_code = %s
-    """
-    
-    cursor.execute(query, (donvigan,))
-    
-    # Fetch the result
-    result = cursor.fetchone()
-    
-    if result:
-        return result[0]
-    else:
-        return None  # 
+    return recipient_directory.get_company_manager(cursor, donvigan)
 
 def get_email_TV(Nhom, donvigan, cursor, logging):
     try:
@@ -264,22 +185,40 @@ def get_from_L3(L3, donvigan, cursor, logging):
 
 def get_don_vi_gan(cursor, don_vi_gan):
     don_vi_gan = don_vi_gan.split()[0]
-    query = """
-    SELECT loaihinh
-    FROM jwdb.app_fd_etl_company
-    WHERE %s like company_code
+    return company_directory.get_loaihinh(cursor, don_vi_gan)
+
+TICKET_BATCH_SIZE = 500  # Số mã ticket tối đa trong một câu IN (...)
+
+
+def get_tickets_by_maticket(cursor, matickets):
     """
-    cursor.execute(query, (don_vi_gan,))
-    result = cursor.fetchall()
-    return result
+    Đọc nhiều ticket bằng các câu `c_MaTicket IN (...)`, trả về dict mã (đã chuẩn hoá) -> ticket.
+    Mã trùng trong bảng thì giữ dòng đầu tiên như fetchone().
+    """
+    tickets = {}
+    codes = list(dict.fromkeys(m for m in matickets if m))
+    for start in range(0, len(codes), TICKET_BATCH_SIZE):
+        chunk = codes[start:start + TICKET_BATCH_SIZE]
+        placeholders = ",".join(["%s"] * len(chunk))
+        query = f"""
+        SELECT c_MaTicket, c_DonViGan, c_phanLoai, c_DanhMucYeuCau, c_NhomYeuCau, c_individual
+        FROM jwdb.app_fd_sp_tickets WHERE c_MaTicket IN ({placeholders})
+        """
+        cursor.execute(query, chunk)
+        columns = [col[0] for col in cursor.description]
+        for row in cursor.fetchall():
+            ticket = dict(zip(columns, row))
+            tickets.setdefault(recipient_directory.key(ticket["c_MaTicket"]), ticket)
+    return tickets
 
-def get_email_by_jodcode(cursor, maticket, logging):
-    ticket = get_ticket_by_maticket(cursor, maticket)
-    logging.info(f"data: {ticket.get('c_phanLoai', '')} {ticket.get('c_NhomYeuCau', '')} {ticket.get('c_DanhMucYeuCau', '')}")
+
+def classify_ticket(cursor, ticket):
+    """(L1, L2, L3, Nhom, don_vi_gan) của ticket, dùng để chọn cách lấy email."""
     L1, L2, L3 = fetch_data(cursor, ticket.get("c_phanLoai", ""), ticket.get("c_NhomYeuCau", ""), ticket.get("c_DanhMucYeuCau", "") )
-    Nhom = ticket.get("c_individual", "")
-    # donvigan = ticket.get("c_DonViGan", "")
-    
+    return L1, L2, L3, ticket.get("c_individual", ""), ticket.get("c_DonViGan", "")
+
+
+def resolve_emails(cursor, L1, L2, L3, Nhom, donvigan, logging):
     # get email sản phẩm dịch dụ
     if L1 == "Ngoài phạm vi":
         email = get_email_NPV(L1, L2, logging)
@@ -293,10 +232,39 @@ def get_email_by_jodcode(cursor, maticket, logging):
     
     # get email Tu van
     elif L1 == "Tư vấn" or L1 == "Đặt lịch hẹn":
-        email = get_email_TV(Nhom, ticket.get("c_DonViGan", ""), cursor, logging)
+        email = get_email_TV(Nhom, donvigan, cursor, logging)
     
     # get email theo
     else:
-        email = get_from_L3(L3, ticket.get("c_DonViGan", ""), cursor, logging)
+        email = get_from_L3(L3, donvigan, cursor, logging)
     return email
-      # Trả về email nếu tìm thấy, h
\ No newline at end of file
+
+
+def get_email_by_jodcode(cursor, maticket, logging):
+    ticket = get_ticket_by_maticket(cursor, maticket)
+    logging.info(f"data: {ticket.get('c_phanLoai', '')} {ticket.get('c_NhomYeuCau', '')} {ticket.get('c_DanhMucYeuCau', '')}")
+    return resolve_emails(cursor, *classify_ticket(cursor, ticket), logging)
+
+
+def get_email_by_jodcode_batch(cursor, matickets, logging):
+    """
+    Lấy email cho nhiều mã ticket: đọc ticket theo lô rồi chỉ tính email một lần cho mỗi bộ
+    (L1, L2, L3, Nhom, don_vi_gan). Trả về từng (maticket, email, lỗi) theo thứ tự đầu vào.
+    """
+    tickets = get_tickets_by_maticket(cursor, matickets)
+    resolved = {}
+    for maticket in matickets:
+        ticket = tickets.get(recipient_directory.key(maticket)) if maticket else None
+        if ticket is None:
+            yield maticket, None, "Ticket not found"
+            continue
+        classification = classify_ticket(cursor, ticket)
+        if classification not in resolved:
+            try:
+                resolved[classification] = (resolve_emails(cursor, *classification, logging), None)
+            except Exception as e:
+                logging.error(f"Get email {maticket}: {e}")
+                resolved[classification] = (None, str(e))
+        email, error = resolved[classification]
+        yield maticket, email, error
+    logging.info(f"Resolved {len(matickets)} tickets with {len(resolved)} level combinations")
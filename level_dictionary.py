@@ -0,0 +1,155 @@
+import logging
+import threading
+import time
+
+# Bảng tra cứu tên phân loại L1 - L4: level -> (bảng, cột tên)
+LEVEL_TABLES = {
+    "L1": ("jwdb.app_fd_sp_phanloai", "c_ten_phan_loai"),
+    "L2": ("jwdb.app_fd_sp_nhomyeucau", "c_ten_nhom_yeucau"),
+    "L3": ("jwdb.app_fd_sp_danhmucyeucau", "c_ten_danh_muc_yeucau"),
+    "L4": ("jwdb.app_fd_sp_ql_lv4", "c_ten_level_4"),
+}
+
+REFRESH_INTERVAL = 60  # Check for modified rows at most once a minute
+FULL_RELOAD_INTERVAL = 3600  # Full reload picks up deleted rows
+
+level_lock = threading.Lock()
+level_state = {
+    level: {"names": {}, "ids": {}, "last_modified": None, "checked_at": 0, "loaded_at": 0, "refreshing": False}
+    for level in LEVEL_TABLES
+}
+
+
+def _store(state, level_id, name):
+    old_name = state["names"].get(level_id)
+    if old_name is not None and state["ids"].get(old_name) == level_id:
+        del state["ids"][old_name]
+    state["names"][level_id] = name
+    # Trùng tên thì giữ id đầu tiên
+    state["ids"].setdefault(name, level_id)
+
+
+def _load(cursor, level, full, since):
+    """Đọc bảng level (không giữ lock), trả về các dòng (id, tên, dateModified)."""
+    table, name_column = LEVEL_TABLES[level]
+    query = f"SELECT id, {name_column}, dateModified FROM {table}"
+    params = ()
+    if not full and since is not None:
+        query += " WHERE dateModified >= %s"
+        params = (since,)
+    cursor.execute(query, params)
+    return cursor.fetchall()
+
+
+def _apply(level, rows, full):
+    """Đưa kết quả _load vào bộ nhớ; lần nạp toàn bộ dựng dict mới rồi mới thay."""
+    state = level_state[level]
+    if full:
+        fresh = {"names": {}, "ids": {}}
+        for level_id, name, _ in rows:
+            _store(fresh, level_id, name)
+        last_modified = None
+    else:
+        fresh = state
+        last_modified = state["last_modified"]
+    modified_values = [modified for _, _, modified in rows if modified is not None]
+    if modified_values and (last_modified is None or max(modified_values) > last_modified):
+        last_modified = max(modified_values)
+
+    now = time.time()
+    with level_lock:
+        if full:
+            state["names"], state["ids"] = fresh["names"], fresh["ids"]
+            state["loaded_at"] = now
+        else:
+            for level_id, name, _ in rows:
+                _store(state, level_id, name)
+        state["last_modified"] = last_modified
+        state["checked_at"] = now
+    if full or rows:
+        logging.info(f"Level dictionary {level}: {len(rows)} rows loaded ({'full' if full else 'incremental'})")
+
+
+def refresh_levels(cursor, force=False):
+    """
+    Nạp lại các bảng level đã quá hạn. Lần đầu và mỗi FULL_RELOAD_INTERVAL nạp toàn bộ,
+    các lần khác chỉ lấy dòng có dateModified mới hơn. Truy vấn chạy ngoài lock và chỉ một
+    thread nạp mỗi bảng; các thread khác dùng dữ liệu hiện có trong lúc chờ.
+    """
+    now = time.time()
+    for level, state in level_state.items():
+        with level_lock:
+            if state["refreshing"]:
+                continue
+            if force or now - state["loaded_at"] > FULL_RELOAD_INTERVAL:
+                full = True
+            elif now - state["checked_at"] > REFRESH_INTERVAL:
+                full = False
+            else:
+                continue
+            state["refreshing"] = True
+            since = state["last_modified"]
+        try:
+            _apply(level, _load(cursor, level, full, since), full)
+        except Exception as e:
+            logging.error(f"Error loading level dictionary {level}: {e}")
+        finally:
+            with level_lock:
+                state["refreshing"] = False
+
+
+def _lookup_one(cursor, level, column, value):
+    table, name_column = LEVEL_TABLES[level]
+    select_column, where_column = ("id", name_column) if column == "name" else (name_column, "id")
+    query = f"SELECT id, {name_column} FROM {table} WHERE {where_column} = %s LIMIT 1"
+    cursor.execute(query, (value,))
+    rows = cursor.fetchall()
+    if not rows:
+        return None
+    level_id, name = rows[0]
+    with level_lock:
+        _store(level_state[level], level_id, name)
+    return level_id if select_column == "id" else name
+
+
+def get_level_name(cursor, level, level_id, default=None):
+    """
+    Trả về tên của level (L1 - L4) theo id. Dòng chưa có trong bộ nhớ (mới tạo giữa hai
+    lần refresh) được đọc trực tiếp từ DB và lưu lại.
+    """
+    if not level_id:
+        return default
+    refresh_levels(cursor)
+    with level_lock:
+        name = level_state[level]["names"].get(level_id)
+    if name is None:
+        try:
+            name = _lookup_one(cursor, level, "id", level_id)
+        except Exception as e:
+            logging.error(f"Error: {e}")
+    return default if name is None else name
+
+
+def get_level_id(cursor, level, name, default=None):
+    """Trả về id của level (L1 - L4) theo tên."""
+    if not name:
+        return default
+    refresh_levels(cursor)
+    with level_lock:
+        level_id = level_state[level]["ids"].get(name)
+    if level_id is None:
+        try:
+            level_id = _lookup_one(cursor, level, "name", name)
+        except Exception as e:
+            logging.error(f"Error: {e}")
+    return default if level_id is None else level_id
+
+
+def get_level_names(cursor, l1_id, l2_id, l3_id, l4_id=None):
+    """Trả về (L1, L2, L3, L4) theo id, "" nếu không tìm thấy."""
+    return (
+        get_level_name(cursor, "L1", l1_id, ""),
+        get_level_name(cursor, "L2", l2_id, ""),
+        get_level_name(cursor, "L3", l3_id, ""),
+        get_level_name(cursor, "L4", l4_id, ""),
+    )
@@ -0,0 +1,202 @@
+import logging
+import re
+import threading
+import time
+
+import company_directory
+from sla_rule_matcher import fold
+
+REFRESH_INTERVAL = 60  # Check COUNT(*)/MAX(dateModified) at most once a minute
+FULL_RELOAD_INTERVAL = 3600  # Full reload picks up deleted rows
+
+EMAIL_QUERY = "SELECT id, madonvi, jobcode, email, dateModified FROM jwdb.app_fd_etl_email"
+JOBCODE_QUERY = """
+    SELECT id, c_loai_donvi, c_don_vi, c_tong_hop_jobcode, c_tong_hop_jobcode_cha, dateModified
+    FROM jwdb.app_fd_sp_jobcode
+    """
+VERSION_QUERIES = {
+    "email": "SELECT COUNT(*), MAX(dateModified) FROM jwdb.app_fd_etl_email",
+    "jobcode": "SELECT COUNT(*), MAX(dateModified) FROM jwdb.app_fd_sp_jobcode",
+}
+
+directory_lock = threading.Lock()
+directory_state = {
+    name: {"rows": {}, "index": {}, "last_modified": None, "checked_at": 0, "loaded_at": 0, "refreshing": False}
+    for name in ("email", "jobcode")
+}
+
+
+def key(value):
+    """So sánh giống collation _ci của MySQL: không phân biệt hoa thường và dấu, bỏ dấu cách cuối."""
+    return "" if value is None else fold(value).rstrip(" ")
+
+
+def _email_keys(row):
+    madonvi, jobcode, _ = row
+    return [(key(madonvi), key(jobcode)), (None, key(jobcode))]
+
+
+def _jobcode_keys(row):
+    loai_donvi, don_vi, _, _ = row
+    return [(key(loai_donvi), key(don_vi))]
+
+
+# Mỗi bảng: hàm trả về các khóa tra cứu của một dòng và câu SELECT để nạp
+INDEX_KEYS = {"email": _email_keys, "jobcode": _jobcode_keys}
+QUERIES = {"email": EMAIL_QUERY, "jobcode": JOBCODE_QUERY}
+
+
+def _store(name, state, row_id, row):
+    old_row = state["rows"].get(row_id)
+    if old_row is not None:
+        for index_key in INDEX_KEYS[name](old_row):
+            ids = state["index"].get(index_key)
+            if ids is not None:
+                ids.pop(row_id, None)
+                if not ids:
+                    del state["index"][index_key]
+    state["rows"][row_id] = row
+    for index_key in INDEX_KEYS[name](row):
+        # dict giữ thứ tự nạp, dòng đầu tiên đứng trước như LIMIT 1 / fetchone
+        state["index"].setdefault(index_key, {})[row_id] = None
+
+
+def _load(cursor, name, full, since):
+    """Đọc bảng (không giữ lock), trả về các dòng (id, ..., dateModified)."""
+    query = QUERIES[name]
+    params = ()
+    if not full and since is not None:
+        query += " WHERE dateModified >= %s"
+        params = (since,)
+    cursor.execute(query, params)
+    return cursor.fetchall()
+
+
+def _apply(name, rows, full):
+    """Đưa kết quả _load vào bộ nhớ; lần nạp toàn bộ dựng index mới rồi mới thay."""
+    state = directory_state[name]
+    if full:
+        fresh = {"rows": {}, "index": {}}
+        for row in rows:
+            _store(name, fresh, row[0], tuple(row[1:-1]))
+        last_modified = None
+    else:
+        last_modified = state["last_modified"]
+    modified_values = [row[-1] for row in rows if row[-1] is not None]
+    if modified_values and (last_modified is None or max(modified_values) > last_modified):
+        last_modified = max(modified_values)
+
+    now = time.time()
+    with directory_lock:
+        if full:
+            state["rows"], state["index"] = fresh["rows"], fresh["index"]
+            state["loaded_at"] = now
+        else:
+            for row in rows:
+                _store(name, state, row[0], tuple(row[1:-1]))
+        state["last_modified"] = last_modified
+        state["checked_at"] = now
+        size = len(state["rows"])
+    if full or rows:
+        logging.info(f"Recipient directory {name}: {len(rows)} rows loaded ({'full' if full else 'incremental'})")
+    return size
+
+
+def _refresh(cursor, name, full, since):
+    if not full:
+        # ETL xóa rồi nạp lại bảng: MAX(dateModified) lùi lại hoặc số dòng không khớp -> nạp toàn bộ
+        cursor.execute(VERSION_QUERIES[name])
+        count, max_modified = cursor.fetchall()[0]
+        if since is not None and max_modified is not None and max_modified < since:
+            full = True
+        elif since is None or max_modified is None or max_modified > since:
+            if _apply(name, _load(cursor, name, False, since), False) != count:
+                full = True
+        else:
+            with directory_lock:
+                size = len(directory_state[name]["rows"])
+                directory_state[name]["checked_at"] = time.time()
+            full = size != count
+        if full:
+            logging.info(f"Recipient directory {name}: table was reloaded ({count} rows), loading all rows")
+    if full:
+        _apply(name, _load(cursor, name, True, None), True)
+
+
+def refresh_directory(cursor, force=False):
+    """
+    Nạp lại các bảng email / jobcode đã quá hạn. Lần đầu và mỗi FULL_RELOAD_INTERVAL nạp toàn bộ,
+    các lần khác so COUNT(*)/MAX(dateModified) rồi chỉ lấy dòng có dateModified mới hơn, hoặc nạp
+    toàn bộ khi ETL đã nạp lại bảng. Truy vấn chạy ngoài lock và chỉ một thread nạp mỗi bảng.
+    """
+    now = time.time()
+    for name, state in directory_state.items():
+        with directory_lock:
+            if state["refreshing"]:
+                continue
+            if force or now - state["loaded_at"] > FULL_RELOAD_INTERVAL:
+                full = True
+            elif now - state["checked_at"] > REFRESH_INTERVAL:
+                full = False
+            else:
+                continue
+            state["refreshing"] = True
+            since = state["last_modified"]
+        try:
+            _refresh(cursor, name, full, since)
+        except Exception as e:
+            logging.error(f"Error loading recipient directory {name}: {e}")
+        finally:
+            with directory_lock:
+                state["refreshing"] = False
+
+
+def _ensure_loaded(cursor, name):
+    # Chưa nạp được lần nào thì báo lỗi, không trả về danh sách người nhận rỗng
+    refresh_directory(cursor)
+    if not directory_state[name]["loaded_at"]:
+        raise RuntimeError(f"Recipient directory {name} has never been loaded")
+
+
+def _rows(name, index_key):
+    state = directory_state[name]
+    return [state["rows"][row_id] for row_id in state["index"].get(index_key, ())]
+
+
+def split_jobcodes(jobcode, separators=";,"):
+    return re.split(f"[{re.escape(separators)}]", jobcode or "")
+
+
+def get_jobcode(cursor, loai_donvi, don_vi):
+    """(c_tong_hop_jobcode, c_tong_hop_jobcode_cha) của loại đơn vị / khối, None nếu không có."""
+    _ensure_loaded(cursor, "jobcode")
+    with directory_lock:
+        rows = _rows("jobcode", (key(loai_donvi), key(don_vi)))
+    if not rows:
+        return None
+    return rows[0][2], rows[0][3]
+
+
+def get_company_manager(cursor, company_code):
+    """com_manager của đơn vị, None nếu không có."""
+    return company_directory.get_com_manager(cursor, company_code)
+
+
+def get_emails(cursor, jobcode, madonvi=None, separators=";,"):
+    """
+    Email (không trùng) của các jobcode trong chuỗi `jobcode`, ngăn cách bởi một trong các ký tự
+    `separators` (mặc định ; hoặc ,).
+    Có `madonvi` thì chỉ lấy email thuộc đơn vị đó và đơn vị phải có trong app_fd_etl_company,
+    giống JOIN app_fd_etl_company trong câu GROUP_CONCAT cũ.
+    """
+    if madonvi is not None and company_directory.get_company(cursor, madonvi) is None:
+        return []
+    unit = None if madonvi is None else key(madonvi)
+    _ensure_loaded(cursor, "email")
+    emails = {}
+    with directory_lock:
+        for code in split_jobcodes(jobcode, separators):
+            for row in _rows("email", (unit, key(code))):
+                if row[2]:
+                    emails.setdefault(row[2], None)
+    return list(emails)
@@ -0,0 +1,97 @@
+class Row:
+    """
+    Một dòng kết quả truy vấn, đọc theo tên cột như dict: row["c_maTicket"], row.get("L4", "").
+    Các dòng của cùng một truy vấn dùng chung một bảng tên cột -> vị trí, nên mỗi dòng chỉ
+    giữ một list giá trị.
+    Trước đây các hàm SLA.* nhận pd.Series (assignments.loc[index]), nên Row giữ lại các cách đọc
+    của Series: row.c_maTicket, row.iloc[0], row.index, row.empty. Khác biệt còn lại: cột NULL
+    là None chứ không phải NaN.
+    """
+
+    __slots__ = ("_columns", "_values")
+
+    def __init__(self, columns, values):
+        self._columns = columns
+        self._values = list(values)
+
+    def __getitem__(self, key):
+        return self._values[self._columns[key]]
+
+    def __getattr__(self, name):
+        # Chỉ gọi khi không tìm thấy thuộc tính thường: đọc cột như Series (row.c_maTicket)
+        if name.startswith("_"):
+            raise AttributeError(name)
+        index = self._columns.get(name)
+        if index is None:
+            raise AttributeError(f"Row has no column {name!r}")
+        return self._values[index]
+
+    def __setitem__(self, key, value):
+        index = self._columns.get(key)
+        if index is None:
+            # Thêm cột mới: tách bảng tên cột khỏi các dòng khác
+            self._columns = dict(self._columns)
+            self._columns[key] = len(self._values)
+            self._values.append(value)
+        else:
+            self._values[index] = value
+
+    def __contains__(self, key):
+        return key in self._columns
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def get(self, key, default=None):
+        index = self._columns.get(key)
+        return default if index is None else self._values[index]
+
+    def keys(self):
+        return self._columns.keys()
+
+    def values(self):
+        return [self._values[index] for index in self._columns.values()]
+
+    def items(self):
+        return [(key, self._values[index]) for key, index in self._columns.items()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    @property
+    def iloc(self):
+        """Đọc theo vị trí cột như Series.iloc: row.iloc[0], row.iloc[-1]."""
+        return self.values()
+
+    @property
+    def index(self):
+        """Tên các cột, như Series.index."""
+        return list(self._columns)
+
+    @property
+    def empty(self):
+        return not self._columns
+
+    def __repr__(self):
+        return f"Row({self.to_dict()!r})"
+
+
+def fetch_rows(cursor, query, params=()):
+    """Chạy query và trả về list Row, tên cột lấy từ cursor.description."""
+    cursor.execute(query, params)
+    if cursor.description is None:
+        return []
+    records = cursor.fetchall()
+    columns = {}
+    for position, col in enumerate(cursor.description):
+        # Trùng tên cột thì giữ cột xuất hiện đầu tiên
+        columns.setdefault(col[0], position)
+    return [Row(columns, record) for record in records]
+
+
+def fetch_one(cursor, query, params=()):
+    rows = fetch_rows(cursor, query, params)
+    return rows[0] if rows else None
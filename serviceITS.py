@@ -1,18 +1,24 @@
 import base64
+import bisect
+import functools
 import importlib.util
 import json
 import logging.handlers
 import os
+import queue
+import random
 import re
 import time
 import uuid
+import zlib
 from datetime import datetime, timedelta
-from threading import Thread
+from threading import Condition, Lock, Thread
 from urllib.parse import urlparse
-import pandas as pd
 
 import pika
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from bs4 import BeautifulSoup
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
@@ -20,7 +26,8 @@ from flask_httpauth import HTTPBasicAuth
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, decode_token
 from urllib.parse import urlparse
 
-from get_email_from_jodcode import get_email_by_jodcode
+from get_email_from_jodcode import get_email_by_jodcode, get_email_by_jodcode_batch
+import company_directory
 
 # Đường dẫn đến py_common.py
 # lib_file_path = "./py_common.py"
@@ -63,6 +70,12 @@ def load_config():
             "USERNAME": config_1["rabbitmq"]["username"],
             "PASSWORD": config_1["rabbitmq"]["password"],
             "QUEUE_NAME": config_1["rabbitmq"]["lpbQueue"],
+            "PUBLISH_QUEUE_SIZE": int(config_1["rabbitmq"].get("publish_queue_size", "10000")),
+            "PUBLISH_BATCH_SIZE": int(config_1["rabbitmq"].get("publish_batch_size", "100")),
+            # block | drop_oldest | spool
+            "OVERLOAD_POLICY": config_1["rabbitmq"].get("publish_overload_policy", "spool").lower(),
+            # Fanout exchange đánh thức worker xuly_luong_ticket khi app_fd_sp_tickets thay đổi
+            "OUTBOX_EXCHANGE": config_1["rabbitmq"].get("outbox_exchange", "outbox_changed"),
         }
         api_its = config_1["api_its"]
         api_ho = config_1["api_ho"]
@@ -168,8 +181,6 @@ def create_app(secret_key, time_expired):
 try:
     proxies = {"http": None, "https": None}
 
-    cached_token = None
-    token_timestamp = None
     (
         API_HOST, TOKEN_CREDENTIAL, AUTH_CREDENTIAL, SETTINGS, RABBITMQ_CONFIG, ENV, LOG_CURL, API_PATH,
         config) = load_config()
@@ -178,11 +189,33 @@ try:
     CRM_HOST_FILE_TICKET = config["its_config"]["CRM_HOST_FILE_TICKET"]
     CRM_TEXT_REPLACE = config["its_config"]["CRM_TEXT_REPLACE"]
     # CRM_HOST_IMAGE_TICKET_TMP = config["its_config"]["CRM_HOST_IMAGE_TICKET_TMP"]
+    # DIRECT: tạo ticket ngay trong request | OUTBOX: ghi outbox_ticket_websites, chờ job outbox_insert_ticket.py
+    WEBSITE_CREATE_MODE = config["its_config"].get("WEBSITE_CREATE_MODE", "DIRECT").upper()
+    WEBSITE_MAPPING_TTL = int(config["its_config"].get("WEBSITE_MAPPING_TTL", "300"))
+    TEMPLATE_INDEX_REFRESH = int(config["its_config"].get("TEMPLATE_INDEX_REFRESH", "3600"))
+    MAIL_BATCH_MAX_TICKETS = int(config["its_config"].get("MAIL_BATCH_MAX_TICKETS", "1000"))
+    REFERENCE_CACHE_CONFIG = {
+        "TTL": int(config["its_config"].get("REFERENCE_CACHE_TTL", "3600")),
+        "MAX_STALE": int(config["its_config"].get("REFERENCE_CACHE_MAX_STALE", "86400")),
+    }
+    HTTP_CONFIG = {
+        "POOL_SIZE": int(config["its_config"].get("HTTP_POOL_SIZE", "20")),
+        "CONNECT_TIMEOUT": float(config["its_config"].get("HTTP_CONNECT_TIMEOUT", "5")),
+        "READ_TIMEOUT": float(config["its_config"].get("HTTP_READ_TIMEOUT", "30")),
+        "MAX_RETRIES": int(config["its_config"].get("HTTP_MAX_RETRIES", "2")),
+        "RETRY_BACKOFF": float(config["its_config"].get("HTTP_RETRY_BACKOFF", "0.5")),
+    }
+    # Làm mới token trước khi hết hạn REFRESH_AHEAD giây; ngừng dùng token khi còn dưới EXPIRY_SKEW giây
+    TOKEN_CONFIG = {
+        "REFRESH_AHEAD": int(config["its_config"].get("TOKEN_REFRESH_AHEAD", "60")),
+        "EXPIRY_SKEW": int(config["its_config"].get("TOKEN_EXPIRY_SKEW", "15")),
+    }
 
     app, jwt, basic_auth, cors = create_app(AUTH_CREDENTIAL["SECRET_KEY"], AUTH_CREDENTIAL["TIME_EXPIRED"])
     logger = config_log()
     logger.info("Application started")
     logger.info(f"LOG_CURL: {LOG_CURL}")
+    logger.info(f"WEBSITE_CREATE_MODE: {WEBSITE_CREATE_MODE}")
 
     id_file = "/home/Python/OutBoxTrigger/ITS/id_web.txt"
 
@@ -315,23 +348,260 @@ def create_connection_to_rabbitmq():
         return None, None
 
 
+audit_queue = None  # Created by start_audit_publisher() with rabbitmq publish_queue_size
+audit_publisher = {"thread": None, "connected": False}
+audit_publisher_lock = Lock()
+audit_stats = {"queued": 0, "published": 0, "spooled": 0, "dropped": 0, "replayed": 0, "outbox_notified": 0}
+audit_stats_lock = Lock()
+audit_spool_path = os.path.join(base_dir, "logs", "audit_spool.jsonl")
+audit_spool_lock = Lock()
+OUTBOX_CHANGED = object()  # Marker in audit_queue: publish an outbox-changed notification
+outbox_notify = {"pending": False}
+
+
+def count_audit(name, value=1):
+    with audit_stats_lock:
+        audit_stats[name] += value
+
+
+def start_audit_publisher():
+    global audit_queue
+    if audit_publisher["thread"] is None:
+        with audit_publisher_lock:
+            if audit_publisher["thread"] is None:
+                audit_queue = queue.Queue(maxsize=RABBITMQ_CONFIG["PUBLISH_QUEUE_SIZE"])
+                audit_publisher["thread"] = Thread(target=publish_audit_loop, name="audit-publisher", daemon=True)
+                audit_publisher["thread"].start()
+
+
+def notify_outbox_changed():
+    """
+    Wake the xuly_luong_ticket workers after a write to app_fd_sp_tickets. Notifications are
+    coalesced: at most one is waiting in audit_queue at a time, and a full queue is ignored
+    because the workers still poll the outbox as a safety net.
+    """
+    if outbox_notify["pending"]:
+        return
+    start_audit_publisher()
+    outbox_notify["pending"] = True
+    try:
+        audit_queue.put_nowait(OUTBOX_CHANGED)
+    except queue.Full:
+        outbox_notify["pending"] = False
+
+
 def send_message_to_rabbitmq(message):
+    """
+    Hand an audit message to the process-wide publisher thread without waiting for the broker.
+    When the in-memory queue is full the rabbitmq publish_overload_policy applies:
+    block until there is room, drop the oldest queued message, or spool to a local file
+    that is replayed once the broker is healthy again.
+    """
+    start_audit_publisher()
     try:
-        connection, channel = create_connection_to_rabbitmq()
-        channel.queue_declare(queue=RABBITMQ_CONFIG["QUEUE_NAME"], durable=True)
+        audit_queue.put_nowait(message)
+        count_audit("queued")
+        return
+    except queue.Full:
+        pass
+
+    policy = RABBITMQ_CONFIG["OVERLOAD_POLICY"]
+    if policy == "block":
+        audit_queue.put(message)
+        count_audit("queued")
+
+    elif policy == "drop_oldest":
+        try:
+            if audit_queue.get_nowait() is OUTBOX_CHANGED:
+                outbox_notify["pending"] = False
+            else:
+                count_audit("dropped")
+        except queue.Empty:
+            pass
+        try:
+            audit_queue.put_nowait(message)
+            count_audit("queued")
+        except queue.Full:
+            count_audit("dropped")
 
-        channel.basic_publish(
-            exchange='',
-            routing_key=RABBITMQ_CONFIG["QUEUE_NAME"],
-            body=message)
+    else:
+        spool_audit_message(message)
 
-        logger.info(f"Message sent to RabbitMQ: {message[:255] + '...' if len(message) > 255 else message}")
+
+def spool_audit_message(message):
+    try:
+        with audit_spool_lock:
+            with open(audit_spool_path, "a", encoding="utf-8") as file:
+                file.write(message.replace("\n", " ") + "\n")
+        count_audit("spooled")
 
+    except Exception as e:
+        count_audit("dropped")
+        logging.error(f"Error spooling audit message: {e}")
+
+
+def read_replay_offset(offset_path):
+    try:
+        with open(offset_path, "r", encoding="utf-8") as file:
+            return int(file.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_replay_offset(offset_path, offset):
+    tmp_path = offset_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        file.write(str(offset))
+    os.replace(tmp_path, offset_path)
+
+
+def replay_audit_spool(channel):
+    """
+    Publish up to PUBLISH_BATCH_SIZE spooled messages on the publisher's channel. The spool file
+    is first moved aside to audit_spool.jsonl.replay; the byte offset of the last confirmed line
+    is checkpointed after every publish, so a crash during replay re-sends at most one message.
+    Returns the number of messages published.
+    """
+    replay_path = audit_spool_path + ".replay"
+    offset_path = replay_path + ".offset"
+    if not os.path.exists(replay_path):
+        if not os.path.exists(audit_spool_path) or audit_queue.qsize() > audit_queue.maxsize // 2:
+            return 0
+        with audit_spool_lock:
+            os.replace(audit_spool_path, replay_path)
+        write_replay_offset(offset_path, 0)
+
+    published = 0
+    with open(replay_path, "rb") as file:
+        file.seek(read_replay_offset(offset_path))
+        while published < RABBITMQ_CONFIG["PUBLISH_BATCH_SIZE"]:
+            raw = file.readline()
+            if not raw:
+                os.remove(replay_path)
+                os.remove(offset_path)
+                logger.info("Audit spool replay finished")
+                break
+            line = raw.decode("utf-8").rstrip("\n")
+            if line:
+                try:
+                    channel.basic_publish(
+                        exchange='',
+                        routing_key=RABBITMQ_CONFIG["QUEUE_NAME"],
+                        body=line,
+                        properties=pika.BasicProperties(delivery_mode=2))
+                    published += 1
+                except pika.exceptions.NackError:
+                    logger.error(f"Spooled message rejected by RabbitMQ, spooled again: {line[:255]}")
+                    spool_audit_message(line)
+            write_replay_offset(offset_path, file.tell())
+    count_audit("replayed", published)
+    return published
+
+
+def audit_spool_pending():
+    return os.path.exists(audit_spool_path) or os.path.exists(audit_spool_path + ".replay")
+
+
+def open_audit_channel():
+    connection, channel = create_connection_to_rabbitmq()
+    if channel is None:
+        return None, None
+
+    channel.queue_declare(queue=RABBITMQ_CONFIG["QUEUE_NAME"], durable=True)
+    channel.exchange_declare(exchange=RABBITMQ_CONFIG["OUTBOX_EXCHANGE"], exchange_type="fanout", durable=True)
+    channel.confirm_delivery()
+    logger.info("Audit publisher connected to RabbitMQ")
+    return connection, channel
+
+
+def close_audit_connection(connection):
+    try:
+        if connection and connection.is_open:
+            connection.close()
     except Exception as e:
         logging.error(f"Error: {e}")
 
-    finally:
-        connection.close()
+
+def publish_audit_loop():
+    """
+    Publisher thread: owns the only RabbitMQ connection used for audit messages.
+    Messages are drained from audit_queue in batches of PUBLISH_BATCH_SIZE. The channel is in
+    confirm mode, so on this BlockingChannel each basic_publish waits for its own broker confirm;
+    batching only saves queue round trips. Messages nacked by the broker are spooled; on
+    connection errors the unpublished part of the batch is kept and retried after reconnecting.
+    """
+    connection, channel = None, None
+    batch = []
+    while True:
+        if not batch:
+            try:
+                batch.append(audit_queue.get(timeout=5))
+            except queue.Empty:
+                # Giữ heartbeat khi không có message
+                try:
+                    if connection and connection.is_open:
+                        connection.process_data_events(time_limit=0)
+                    elif audit_spool_pending():
+                        # Kết nối lại để replay spool dù chưa có message mới
+                        close_audit_connection(connection)
+                        connection, channel = open_audit_channel()
+                        audit_publisher["connected"] = channel is not None
+                    if channel is not None and channel.is_open and audit_spool_pending():
+                        replay_audit_spool(channel)
+                except Exception as e:
+                    logging.error(f"Error: {e}")
+                    close_audit_connection(connection)
+                    connection, channel = None, None
+                    audit_publisher["connected"] = False
+                continue
+
+            while len(batch) < RABBITMQ_CONFIG["PUBLISH_BATCH_SIZE"]:
+                try:
+                    batch.append(audit_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+        try:
+            if channel is None or channel.is_closed or connection.is_closed:
+                close_audit_connection(connection)
+                connection, channel = open_audit_channel()
+                audit_publisher["connected"] = channel is not None
+                if channel is None:
+                    time.sleep(RETRY_DELAY)
+                    continue
+
+            while batch:
+                message = batch[0]
+                if message is OUTBOX_CHANGED:
+                    outbox_notify["pending"] = False
+                    channel.basic_publish(
+                        exchange=RABBITMQ_CONFIG["OUTBOX_EXCHANGE"], routing_key="", body=b"outbox-changed")
+                    count_audit("outbox_notified")
+                    batch.pop(0)
+                    continue
+                try:
+                    channel.basic_publish(
+                        exchange='',
+                        routing_key=RABBITMQ_CONFIG["QUEUE_NAME"],
+                        body=message,
+                        properties=pika.BasicProperties(delivery_mode=2))
+                    logger.info(f"Message sent to RabbitMQ: {message[:255] + '...' if len(message) > 255 else message}")
+                    count_audit("published")
+                except pika.exceptions.NackError:
+                    logger.error(f"Message rejected by RabbitMQ, spooled: {message[:255]}")
+                    spool_audit_message(message)
+                batch.pop(0)
+
+            # Xen kẽ replay spool với message mới để spool không bị bỏ đói
+            if audit_spool_pending():
+                replay_audit_spool(channel)
+
+        except Exception as e:
+            logging.error(f"Error publishing to RabbitMQ ({len(batch)} messages pending): {e}")
+            close_audit_connection(connection)
+            connection, channel = None, None
+            audit_publisher["connected"] = False
+            time.sleep(RETRY_DELAY)
 
 
 def parse_uri(uri):
@@ -349,14 +619,97 @@ def parse_uri(uri):
         return None, None, None
 
 
-def get_jwt_token():
-    global cached_token, token_timestamp
+gateway_sessions = {}
+gateway_sessions_lock = Lock()
+gateway_stats = {}
+gateway_stats_lock = Lock()
 
-    # Check if token is cached and not expired
-    if cached_token and token_timestamp and datetime.now() - token_timestamp < timedelta(minutes=5):
-        logger.info("Returning cached JWT token.")
-        return cached_token
 
+def get_gateway_session(url):
+    """
+    Return the keep-alive session shared by all calls to the host of `url`.
+    """
+    host = urlparse(url).netloc
+    session = gateway_sessions.get(host)
+    if session is None:
+        with gateway_sessions_lock:
+            session = gateway_sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_CONFIG["POOL_SIZE"])
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                gateway_sessions[host] = session
+    return session
+
+
+def record_gateway_call(method, url, status_code, elapsed_ms):
+    # Gom các path có id (update_request/123, sub_category/45) về cùng một key
+    path = re.sub(r"/\d+(?=/|$)", "/{id}", urlparse(url).path)
+    key = f"{method} {path}"
+    with gateway_stats_lock:
+        stats = gateway_stats.setdefault(key, {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "last_ms": 0.0})
+        stats["count"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        stats["last_ms"] = elapsed_ms
+        if status_code is None or status_code >= 500:
+            stats["errors"] += 1
+    logger.info(f"[gateway] {key} - status: {status_code} - {elapsed_ms:.0f} ms")
+
+
+def gateway_request(method, url, **kwargs):
+    """
+    Send a request to the ITS/HO gateway through the pooled session of its host.
+    Every call gets connect/read timeouts; idempotent GETs are retried with jittered
+    exponential backoff on connection errors, timeouts and 502/503/504.
+    Returns:
+        requests.Response: The last response received.
+    """
+    session = get_gateway_session(url)
+    kwargs.setdefault("timeout", (HTTP_CONFIG["CONNECT_TIMEOUT"], HTTP_CONFIG["READ_TIMEOUT"]))
+    attempts = HTTP_CONFIG["MAX_RETRIES"] + 1 if method == "GET" else 1
+
+    for attempt in range(attempts):
+        start = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            record_gateway_call(method, url, None, (time.perf_counter() - start) * 1000)
+            if attempt + 1 >= attempts:
+                raise
+            logger.warning(f"[gateway] {method} {url} failed (attempt {attempt + 1}/{attempts}): {e}")
+        else:
+            record_gateway_call(method, url, response.status_code, (time.perf_counter() - start) * 1000)
+            if response.status_code not in (502, 503, 504) or attempt + 1 >= attempts:
+                return response
+            logger.warning(f"[gateway] {method} {url} returned {response.status_code} (attempt {attempt + 1}/{attempts})")
+
+        time.sleep(random.uniform(0, HTTP_CONFIG["RETRY_BACKOFF"] * (2 ** attempt)))
+
+
+jwt_token_state = {"token": None, "fetched_at": None, "expires_at": None, "in_flight": False, "generation": 0}
+jwt_token_condition = Condition()
+
+
+def decode_jwt_expiry(token):
+    """
+    Read the `exp` claim of a JWT without verifying its signature.
+    Returns:
+        datetime: The expiry time, or None if the token has no readable `exp`.
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        return datetime.fromtimestamp(int(exp)) if exp else None
+
+    except Exception as e:
+        logger.warning(f"Cannot decode JWT expiry: {e}")
+        return None
+
+
+def request_jwt_token():
     request_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     is_send_message = False
     headers = {
@@ -374,7 +727,8 @@ def get_jwt_token():
         "ResponseDate": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
     }
     try:
-        response = requests.post(
+        response = gateway_request(
+            "POST",
             TOKEN_CREDENTIAL["URL"],
             json={"username": TOKEN_CREDENTIAL["USERNAME"], "password": TOKEN_CREDENTIAL["PASSWORD"]},
             headers=headers,
@@ -387,15 +741,18 @@ def get_jwt_token():
         is_send_message = True
 
         if response.status_code == 200:
-            logger.info("JWT token retrieved successfully")
-            cached_token = response.json().get("token")
-            token_timestamp = datetime.now()
-            return cached_token
+            token = response.json().get("token")
+            # Token không có exp thì giữ mặc định 5 phút như trước
+            expires_at = decode_jwt_expiry(token) if token else None
+            if expires_at is None:
+                expires_at = datetime.now() + timedelta(minutes=5)
+            logger.info(f"JWT token retrieved successfully, expires at {expires_at}")
+            return token, expires_at
         else:
             logger.error(
                 f"Failed to get JWT token: {response.status_code} {response.text}"
             )
-            return None
+            return None, None
     except Exception as e:
         if (is_send_message == False):
             message["Response"] = str(e)
@@ -404,6 +761,78 @@ def get_jwt_token():
         raise e
 
 
+def get_jwt_token(force=False):
+    """
+    Return a valid gateway token, fetching a new one only when needed.
+    At most one token request is in flight; concurrent callers wait for its result.
+    Args:
+        force (bool): Fetch a new token even if the cached one is still valid.
+    Returns:
+        str: The token, or None if it could not be retrieved.
+    """
+    with jwt_token_condition:
+        while True:
+            expires_at = jwt_token_state["expires_at"]
+            if (not force and jwt_token_state["token"] and expires_at
+                    and datetime.now() < expires_at - timedelta(seconds=TOKEN_CONFIG["EXPIRY_SKEW"])):
+                return jwt_token_state["token"]
+
+            if not jwt_token_state["in_flight"]:
+                jwt_token_state["in_flight"] = True
+                break
+
+            generation = jwt_token_state["generation"]
+            jwt_token_condition.wait(timeout=HTTP_CONFIG["CONNECT_TIMEOUT"] + HTTP_CONFIG["READ_TIMEOUT"])
+            if jwt_token_state["generation"] != generation:
+                expires_at = jwt_token_state["expires_at"]
+                return jwt_token_state["token"] if expires_at and datetime.now() < expires_at else None
+
+    token, expires_at = None, None
+    try:
+        token, expires_at = request_jwt_token()
+        return token
+
+    finally:
+        with jwt_token_condition:
+            if token:
+                jwt_token_state["token"] = token
+                jwt_token_state["fetched_at"] = datetime.now()
+                jwt_token_state["expires_at"] = expires_at
+            jwt_token_state["in_flight"] = False
+            jwt_token_state["generation"] += 1
+            jwt_token_condition.notify_all()
+
+
+def refresh_jwt_token_loop():
+    """
+    Background job: renew the gateway token REFRESH_AHEAD seconds before it expires,
+    so request threads and the consumer never wait for a token fetch.
+    """
+    while True:
+        try:
+            with jwt_token_condition:
+                fetched_at = jwt_token_state["fetched_at"]
+                expires_at = jwt_token_state["expires_at"]
+
+            wait = 0
+            if expires_at:
+                # Không làm mới sớm hơn nửa vòng đời token (tránh lặp liên tục với token ngắn hạn)
+                refresh_at = max(
+                    expires_at - timedelta(seconds=TOKEN_CONFIG["REFRESH_AHEAD"]),
+                    fetched_at + (expires_at - fetched_at) / 2)
+                wait = (refresh_at - datetime.now()).total_seconds()
+            if wait > 0:
+                time.sleep(min(wait, 60))
+                continue
+
+            if get_jwt_token(force=True) is None:
+                time.sleep(SETTINGS["RETRY_DELAY"])
+
+        except Exception as e:
+            logger.error(f"Error refreshing JWT token: {e}")
+            time.sleep(SETTINGS["RETRY_DELAY"])
+
+
 def insert_khachhang_and_get_id(name, phone_number, email, address, company, group):
     try:
         conn = py_common.connect_to_database(read=False)
@@ -450,25 +879,29 @@ def insert_khachhang_and_get_id(name, phone_number, email, address, company, gro
         return None
 
 
-def getmnemonic(company_code):
+def read_mnemonic(company_code):
+    """
+    mnemonic của đơn vị từ danh mục trong bộ nhớ. Chỉ mở một kết nối đọc riêng khi danh mục
+    cần kiểm tra lại (hoặc chưa nạp được, khi đó đọc thẳng từ DB); lỗi thì raise.
+    """
+    if not company_directory.is_stale():
+        return company_directory.get_mnemonic(None, company_code)
+    conn = py_common.connect_to_database(read=True)
+    if conn is None:
+        raise RuntimeError("Error connecting to MySQL")
     try:
-        conn = py_common.connect_to_database(read=True)
-        if conn is None:
-            logger.error("Error connecting to MySQL")
-            return None
-
-        select_query = """
-            SELECT mnemonic
-            FROM jwdb.app_fd_etl_company
-            WHERE company_code = %s
-            """
         cursor = conn.cursor()
-        cursor.execute(select_query, (company_code,))
-        data = cursor.fetchone()
-        cursor.close()
+        try:
+            return company_directory.get_mnemonic(cursor, company_code)
+        finally:
+            cursor.close()
+    finally:
         conn.close()
 
-        return data[0] if data else None
+
+def getmnemonic(company_code):
+    try:
+        return read_mnemonic(company_code)
     except Exception as e:
         logger.error(f"Error getting mnemonic: {e}")
         return None
@@ -529,6 +962,141 @@ def save_ticket(id, name, email, phone_number, address, company, group, l1, l2,
         return False
 
 
+def get_or_create_khachhang(cursor, name, phone_number, email, address, company, group):
+    """
+    Resolve the customer of a website ticket on the caller's cursor (no commit).
+    Returns:
+        tuple: (idkh, cif) - a new app_fd_sp_khachhang row is inserted when the phone number is unknown.
+    """
+    select_query = """
+        SELECT id, c_cif
+        FROM jwdb.app_fd_sp_khachhang
+        WHERE MATCH(c_all_phones) AGAINST (%s IN BOOLEAN MODE)
+        LIMIT 1
+        """
+    cursor.execute(select_query, (phone_number,))
+    all_data = cursor.fetchall()
+    if all_data:
+        return all_data[0][0], all_data[0][1]
+
+    insert_query = """
+        INSERT INTO jwdb.app_fd_sp_khachhang
+        (id, c_tenDN, c_sdt_cif, c_email, c_diaChi,c_companyName, dateCreated, dateModified,
+        c_individual, c_nhom_kh)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """
+    date_handle = datetime.now()
+    idkh = generate_uuid()
+    cursor.execute(
+        insert_query,
+        (idkh, name, phone_number, email, address, company, date_handle, date_handle, group, group,),
+    )
+    return idkh, None
+
+
+def save_ticket_direct(id, name, email, phone_number, address, company, group, l1, l2, l3, l4, l5, description):
+    """
+    Create a website ticket inside a single transaction: allocate c_MaTicket, resolve the customer,
+    insert into app_fd_sp_tickets and record the request in outbox_ticket_websites as DONE
+    so the outbox job does not pick it up again.
+    Returns:
+        str: The generated c_MaTicket, or None if the transaction was rolled back.
+    """
+    # Đọc danh mục đơn vị bằng kết nối đọc riêng, trước khi mở transaction ghi
+    try:
+        mnemonic = read_mnemonic(company) if company else None
+    except Exception as e:
+        logger.error(f"Error getting mnemonic for {company}: {e}", exc_info=True)
+        return None
+
+    conn = py_common.connect_to_database(read=False)
+    if conn is None:
+        logger.error("Error connecting to MySQL")
+        return None
+
+    cursor = None
+    try:
+        conn.start_transaction()
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT msb_api.counter_maticket()")
+        result = cursor.fetchone()
+        cursor.fetchall()
+        if not result or not result[0]:
+            raise ValueError("Failed to generate ticket from database.")
+        ma_ticket = result[0]
+
+        idkh, cif = get_or_create_khachhang(cursor, name, phone_number, email, address, company, group)
+
+        don_vi_gan = company + " - " + mnemonic if company and mnemonic else company
+
+        date_handle = datetime.now()
+        insert_ticket_query = """
+            INSERT INTO jwdb.app_fd_sp_tickets
+            (id, dateCreated,
+            c_tenDN,
+            c_email,
+            c_Phone,
+            c_diaChi,
+            c_DonViGan,
+            c_individual, -- (c_nhom_kh)
+            c_phanLoai,
+            c_NhomYeuCau,
+            c_DanhMucYeuCau,
+            c_ChiTietYeuCau,
+            c_level5,
+            c_content,
+            c_trangThai,
+            c_source,
+            c_MucDo,
+            c_PhanHangKH, c_CapDoXuLy, dateModified,c_MaTicket, c_fkKH,web_id, c_CIF,createdBy, createdByName, modifiedBy, modifiedByName)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,%s,%s, %s,%s,%s,%s,%s)
+            """
+        cursor.execute(
+            insert_ticket_query,
+            (
+                id, date_handle, name, email, phone_number, address,
+                don_vi_gan,
+                group,
+                l1, l2, l3, l4, l5,
+                description, 'Mới', 'Website', 'Trung bình', 'Mass', 'Xử lý lần đầu', date_handle, ma_ticket, idkh,
+                ma_ticket, cif, 'Web', 'Web', 'Web', 'Web'
+            ),
+        )
+
+        insert_outbox_query = """
+            INSERT INTO jwdb.outbox_ticket_websites
+            (ticket_id, dateCreated, c_tenDN, c_email, c_Phone, c_diaChi, c_DonViGan, c_individual,
+            c_phanLoai, c_NhomYeuCau, c_DanhMucYeuCau, c_ChiTietYeuCau, c_level5, c_content, c_trangThai,
+            c_MaTicket, c_source, c_MucDo, c_PhanHangKH, c_CapDoXuLy, dateModified, c_fkKH, c_status)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,%s)
+            """
+        cursor.execute(
+            insert_outbox_query,
+            (
+                id, date_handle, name, email, phone_number, address, don_vi_gan, group,
+                l1, l2, l3, l4, l5,
+                description, 'Mới', ma_ticket, 'Website', 'Trung bình', 'Mass', 'Xử lý lần đầu', date_handle,
+                idkh, 'DONE'
+            ),
+        )
+
+        conn.commit()
+        notify_outbox_changed()
+        logger.info(f"Ticket {ma_ticket} created directly - khachhang: {idkh}")
+        return ma_ticket
+
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Error saving ticket directly, rollback executed: {e}", exc_info=True)
+        return None
+
+    finally:
+        if cursor:
+            cursor.close()
+        conn.close()
+
+
 def update_request_id(ticket_id, request_id):
     """
     Update the request ID for a ticket in the database.
@@ -553,6 +1121,7 @@ def update_request_id(ticket_id, request_id):
         """
         cursor.execute(update_query, (request_id, ticket_id))
         conn.commit()
+        notify_outbox_changed()
         cursor.close()
         conn.close()
         return True
@@ -659,6 +1228,7 @@ def handle_update_its(its_id, data):
         )
         cursor_update.execute("SET SQL_SAFE_UPDATES = 1;")
         conn.commit()
+        notify_outbox_changed()
         conn.close()
         cursor_update.close()
 
@@ -734,7 +1304,7 @@ def send_api_create_ticket(
         json_data = json.dumps(data, ensure_ascii=False)
         url = API_HOST + path
 
-        response = requests.post(url, headers=headers, proxies=proxies, data=json_data, )
+        response = gateway_request("POST", url, headers=headers, proxies=proxies, data=json_data, )
         message["ResponseDate"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         message["StatusCode"] = response.status_code
         message["Response"] = response.text
@@ -771,7 +1341,7 @@ def send_api_update_ticket(token, description, phone_number, attachments, path):
         json_data = json.dumps(data, ensure_ascii=False)
         url = API_HOST + path
 
-        response = requests.put(url, headers=headers, proxies=proxies, data=json_data, )
+        response = gateway_request("PUT", url, headers=headers, proxies=proxies, data=json_data, )
         message["ResponseDate"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         message["StatusCode"] = response.status_code
         message["Response"] = response.text
@@ -786,11 +1356,16 @@ def send_api_update_ticket(token, description, phone_number, attachments, path):
         raise e
 
 
-def send_api_get_info(route, path):
+def fetch_api_info(route, path):
+    """
+    Call a GET reference-data API of the ITS/HO gateway.
+    Returns:
+        tuple: (payload, status_code) - the JSON body and HTTP status to answer the client with.
+    """
     token = get_jwt_token()
     if not token:
         logger.error(f"API: {route} - Error: No token available.")
-        return jsonify({"error": "Failed to get token"}), 500
+        return {"error": "Failed to get token"}, 500
 
     headers = {
         "Content-Type": "application/json",
@@ -808,7 +1383,7 @@ def send_api_get_info(route, path):
         if LOG_CURL == True:
             log_curl(url, "GET", headers, None)
 
-        response = requests.get(url, headers=headers, proxies=proxies)
+        response = gateway_request("GET", url, headers=headers, proxies=proxies)
 
         message["ResponseDate"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         message["StatusCode"] = response.status_code
@@ -818,21 +1393,97 @@ def send_api_get_info(route, path):
         content = response.json()
         if content.get("res_code", {}).get("error_code") == "00":
             data = content.get("data", {}).get("details", [])
-            return jsonify({"code": "0", "message": "Success", "data": data}), 200
+            return {"code": "0", "message": "Success", "data": data}, 200
 
         logger.error(f"API: {route} - Error: {content}")
-        return (jsonify(
+        return (
             {
                 "message": content.get("res_code", {}).get("error_desc") if content.get("res_code") else
                 (content.get("message") if content.get("message") else str(response.content)),
                 "url": url,
                 "data": None,
                 "code": "1"
-            }), 400 if content and content.get("res_code") and content.get("res_code").get("error_code") != '99'
+            }, 400 if content and content.get("res_code") and content.get("res_code").get("error_code") != '99'
                 else 500)
     except Exception as e:
         logger.error(f"API: {route} - Error: {e}", exc_info=True)
-        return jsonify({"code": "2", "message": f"{str(e)}", "data": None}), 500
+        return {"code": "2", "message": f"{str(e)}", "data": None}, 500
+
+
+def send_api_get_info(route, path):
+    payload, status = fetch_api_info(route, path)
+    return jsonify(payload), status
+
+
+reference_cache = {}
+reference_cache_lock = Lock()
+reference_cache_refreshing = set()
+reference_cache_stats = {"hits": 0, "stale_hits": 0, "misses": 0, "fallbacks": 0, "refreshes": 0, "refresh_errors": 0}
+
+
+def count_reference_cache(name):
+    with reference_cache_lock:
+        reference_cache_stats[name] += 1
+
+
+def refresh_reference_entry(key, route, path):
+    payload, status = fetch_api_info(route, path)
+    with reference_cache_lock:
+        if status == 200:
+            reference_cache[key] = {"payload": payload, "fetched_at": time.time()}
+            reference_cache_stats["refreshes"] += 1
+        else:
+            reference_cache_stats["refresh_errors"] += 1
+    return payload, status
+
+
+def refresh_reference_entry_background(key, route, path):
+    try:
+        refresh_reference_entry(key, route, path)
+    except Exception as e:
+        count_reference_cache("refresh_errors")
+        logger.error(f"API: {route} - Background refresh error: {e}", exc_info=True)
+    finally:
+        with reference_cache_lock:
+            reference_cache_refreshing.discard(key)
+
+
+def get_reference_info(route, type_service, api_name, item_id=None):
+    """
+    Serve an ITS/HO reference-data API (service category, template, category, ...) from cache.
+    Fresh entries are returned directly; entries older than REFERENCE_CACHE_TTL are returned while a
+    background refresh runs; if the gateway fails, the last good copy is returned instead of the error.
+    """
+    service = "ITS" if type_service == "ITS" else "HO"
+    path = API_PATH[f"API_{service}"][api_name] + (f"/{item_id}" if item_id else "")
+    key = (service, api_name, str(item_id) if item_id else None)
+
+    with reference_cache_lock:
+        entry = reference_cache.get(key)
+
+    if entry:
+        age = time.time() - entry["fetched_at"]
+        if age < REFERENCE_CACHE_CONFIG["TTL"]:
+            count_reference_cache("hits")
+            return jsonify(entry["payload"]), 200
+
+        if age < REFERENCE_CACHE_CONFIG["MAX_STALE"]:
+            count_reference_cache("stale_hits")
+            with reference_cache_lock:
+                start_refresh = key not in reference_cache_refreshing
+                reference_cache_refreshing.add(key)
+            if start_refresh:
+                Thread(target=refresh_reference_entry_background, args=(key, route, path), daemon=True).start()
+            return jsonify(entry["payload"]), 200
+
+    count_reference_cache("misses")
+    payload, status = refresh_reference_entry(key, route, path)
+    if status != 200 and entry:
+        count_reference_cache("fallbacks")
+        logger.warning(f"API: {route} - Gateway error {status}, serving cached copy of {key}")
+        return jsonify(entry["payload"]), 200
+
+    return jsonify(payload), status
 
 
 def get_data(route, path):
@@ -857,7 +1508,7 @@ def get_data(route, path):
         if LOG_CURL == True:
             log_curl(url, "GET", headers, None)
 
-        response = requests.get(url, headers=headers, proxies=proxies)
+        response = gateway_request("GET", url, headers=headers, proxies=proxies)
 
         message["ResponseDate"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         message["StatusCode"] = response.status_code
@@ -919,6 +1570,29 @@ def login():
         return None, None
     
 
+@app.route("/api/v1/its/audit-stats", methods=["GET"])
+@basic_auth.login_required
+def endpoint_audit_stats():
+    with audit_stats_lock:
+        data = dict(audit_stats)
+    data["pending"] = audit_queue.qsize() if audit_queue is not None else 0
+    data["connected"] = audit_publisher["connected"]
+    data["policy"] = RABBITMQ_CONFIG["OVERLOAD_POLICY"]
+    data["spoolBytes"] = os.path.getsize(audit_spool_path) if os.path.exists(audit_spool_path) else 0
+    return jsonify({"code": "0", "message": "Success", "data": data}), 200
+
+
+@app.route("/api/v1/its/gateway-stats", methods=["GET"])
+@basic_auth.login_required
+def endpoint_gateway_stats():
+    with gateway_stats_lock:
+        data = {
+            key: dict(stats, avg_ms=round(stats["total_ms"] / stats["count"], 1) if stats["count"] else 0)
+            for key, stats in gateway_stats.items()
+        }
+    return jsonify({"code": "0", "message": "Success", "data": data}), 200
+
+
 @app.route("/health", methods=["GET"])
 def health_check():
     try:
@@ -1113,6 +1787,102 @@ def generate_ticket():
         return None
 
 
+website_mapping = {"index": {}, "version": None, "checked_at": 0}
+website_mapping_lock = Lock()
+
+
+def reload_website_mapping(force=False):
+    """
+    Rebuild the in-memory index of jwdb.app_fd_website_mapping.
+    The table is only re-read when COUNT(*)/MAX(dateModified) changed since the last load, or when forced.
+    Returns:
+        bool: True if the index is up to date, False if the database could not be read.
+    """
+    conn = py_common.connect_to_database(read=False)
+    if conn is None:
+        logger.error("Error connecting to MySQL")
+        return False
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT COUNT(*), MAX(dateModified) FROM jwdb.app_fd_website_mapping")
+        version = cursor.fetchone()
+        if not force and website_mapping["index"] and version == website_mapping["version"]:
+            website_mapping["checked_at"] = time.time()
+            return True
+
+        query = """
+           SELECT c_nhom as nhom, c_l1 as l1, c_l2 as l2, c_l3 as l3
+            , c_l1_CRM as l1_crm , c_l2_CRM as l2_crm, c_l3_CRM as l3_crm, c_l4_CRM as l4_crm
+            FROM jwdb.app_fd_website_mapping
+           """
+        cursor.execute(query)
+        index = {}
+        for nhom, l1, l2, l3, l1_crm, l2_crm, l3_crm, l4_crm in cursor.fetchall():
+            # Cột NULL không bao giờ khớp (df["nhom"] == group trả False với None), bỏ qua dòng
+            if None in (nhom, l1, l2, l3):
+                continue
+            # Giữ dòng đầu tiên nếu trùng key, giống df[condition].iloc[0]
+            index.setdefault(
+                (nhom, l1, l2, l3),
+                {
+                    "nhom": nhom, "l1": l1, "l2": l2, "l3": l3,
+                    "l1_crm": l1_crm, "l2_crm": l2_crm, "l3_crm": l3_crm, "l4_crm": l4_crm
+                })
+
+        website_mapping["index"] = index
+        website_mapping["version"] = version
+        website_mapping["checked_at"] = time.time()
+        logger.info(f"Website mapping loaded: {len(index)} keys - version {version}")
+        return True
+
+    except Exception as e:
+        logger.error(f"Error loading website mapping: {e}", exc_info=True)
+        return False
+
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def get_website_mapping(group, l1, l2, l3):
+    """
+    Look up the CRM level IDs for a website (nhom, l1, l2, l3) selection.
+    Returns:
+        dict: l1_crm..l4_crm of the matching mapping row, or None if there is no match.
+    """
+    if time.time() - website_mapping["checked_at"] >= WEBSITE_MAPPING_TTL:
+        with website_mapping_lock:
+            if time.time() - website_mapping["checked_at"] >= WEBSITE_MAPPING_TTL:
+                if not reload_website_mapping():
+                    if not website_mapping["index"]:
+                        raise RuntimeError("Website mapping is not available")
+                    # Giữ index cũ và chờ hết TTL mới thử lại, không kết nối DB ở mọi request khi DB lỗi
+                    website_mapping["checked_at"] = time.time()
+
+    # Như bộ lọc pandas cũ: giá trị None không khớp dòng nào
+    if None in (group, l1, l2, l3):
+        return None
+    return website_mapping["index"].get((group, l1, l2, l3))
+
+
+@app.route("/api/v1/its/reload-website-mapping", methods=["POST"])
+@basic_auth.login_required
+def endpoint_reload_website_mapping():
+    with website_mapping_lock:
+        success = reload_website_mapping(force=True)
+
+    if success:
+        return jsonify(
+            {
+                "code": "0", "message": "Success", "data": {
+                "total": len(website_mapping["index"]),
+                "loadedAt": datetime.fromtimestamp(website_mapping["checked_at"]).strftime("%Y-%m-%d %H:%M:%S")
+            }
+            }), 200
+    return jsonify({"code": "1", "message": "Failed to reload website mapping"}), 500
+
+
 @app.route("/api/v1/its/create-ticket-website", methods=["POST"])
 @jwt_required()
 def endpoint_create_tickets_website():
@@ -1175,28 +1945,9 @@ def endpoint_create_tickets_website():
             amount = l3
             l3 = ''
 
-        conn = py_common.connect_to_database(read=False)
-        cursor = conn.cursor()
-        query = """
-           SELECT c_nhom as nhom, c_l1 as l1, c_l2 as l2, c_l3 as l3
-            , c_l1_CRM as l1_crm , c_l2_CRM as l2_crm, c_l3_CRM as l3_crm, c_l4_CRM as l4_crm
-            FROM jwdb.app_fd_website_mapping
-           """
-        df = pd.read_sql(query, conn)
-            
-        conn.close()
-        cursor.close()
-
-        condition = (
-                (df["nhom"] == group)
-                & (df["l1"] == l1)
-                & (df["l2"] == l2)
-                & (df["l3"] == l3)
-        )
+        list_id = get_website_mapping(group, l1, l2, l3)
 
-        result = df[condition]
-        
-        if result.empty:
+        if list_id is None:
             logging.error(f"No matching data found for {group},{l1},{l2},{l3},{l4}")
             response = {"code": "1", "message": f"No matching data found for {group},{l1},{l2},{l3},{l4}"}
             data_log["StatusCode"] = "400"
@@ -1208,7 +1959,6 @@ def endpoint_create_tickets_website():
             return jsonify(response), 400
             # return jsonify({"code": "1", "message": f"No matching data found for {group},{l1},{l2},{l3},{l4}"}), 400
         
-        list_id = result.iloc[0].to_dict()
         logging.info(f"Data matching: {group},{l1},{l2},{l3},{l4}")
         l1_id = list_id.get('l1_crm', "")
         l2_id = list_id.get('l2_crm', "")
@@ -1228,13 +1978,19 @@ def endpoint_create_tickets_website():
                 l4 = amount
         
         id = generate_uuid()
-        #ticket_id = generate_ticket() # generate_id_web()
-        ticket_id =""
-        success = save_ticket(
-            id, name, email, phone_number, address, company, group,
-            l1_id, l2_id, l3_id, l4 if l4_id else l4_id, l5, description, ticket_id)
-            
-        ticket_id = fetch_ma_ticket(id)
+        if WEBSITE_CREATE_MODE == "OUTBOX":
+            #ticket_id = generate_ticket() # generate_id_web()
+            ticket_id =""
+            success = save_ticket(
+                id, name, email, phone_number, address, company, group,
+                l1_id, l2_id, l3_id, l4 if l4_id else l4_id, l5, description, ticket_id)
+
+            ticket_id = fetch_ma_ticket(id)
+        else:
+            ticket_id = save_ticket_direct(
+                id, name, email, phone_number, address, company, group,
+                l1_id, l2_id, l3_id, l4 if l4_id else l4_id, l5, description)
+            success = ticket_id is not None
         logger.info(f"Generated ticket ID: {id} - {ticket_id}")
         if success:
             # return jsonify({"code": "0", "message": "Success", "data": {"ticketId": ticket_id}}), 200
@@ -1328,9 +2084,6 @@ def endpoint_get_service_categories():
     try:
         type_service = request.json.get("type", "ITS")
 
-        path = API_PATH["API_ITS"]["GET_SERVICE_CATEGORY"] if type_service == "ITS" else API_PATH["API_HO"][
-            "GET_SERVICE_CATEGORY"]
-
         if ENV == "DEV":
             data = read_json_data(SETTINGS["PATH_DATA"])
             if not data or not data.get("service-category"):
@@ -1338,7 +2091,7 @@ def endpoint_get_service_categories():
 
             return jsonify({"code": "0", "message": "Success", "data": data.get("service-category")}), 200
 
-        return send_api_get_info(request.path, path)
+        return get_reference_info(request.path, type_service, "GET_SERVICE_CATEGORY")
     
     except Exception as e:
         logging.error(f"Error: {e}")
@@ -1351,9 +2104,6 @@ def endpoint_get_template_by_service_cate():
     try:
         type_service = request.json.get("type", "ITS")
 
-        path = API_PATH["API_ITS"]["GET_TEMPLATE_BY_SERVICE_CATE"] if type_service == "ITS" else API_PATH["API_HO"][
-            "GET_TEMPLATE_BY_SERVICE_CATE"]
-
         if ENV == "DEV":
             data = read_json_data(SETTINGS["PATH_DATA"])
             if not data or not data.get("service-template"):
@@ -1361,7 +2111,7 @@ def endpoint_get_template_by_service_cate():
 
             return jsonify({"code": "0", "message": "Success", "data": data["service-template"]}), 200
 
-        return send_api_get_info(request.path, path)
+        return get_reference_info(request.path, type_service, "GET_TEMPLATE_BY_SERVICE_CATE")
     
     except Exception as e:
         logging.error(f"Error: {e}")
@@ -1374,8 +2124,6 @@ def endpoint_get_templates():
     try:
         type_service = request.json.get("type", "ITS")
 
-        path = API_PATH["API_ITS"]["GET_TEMPLATE"] if type_service == "ITS" else API_PATH["API_HO"]["GET_TEMPLATE"]
-
         if ENV == "DEV":
             data = read_json_data(SETTINGS["PATH_DATA"])
             if not data or not data.get("template"):
@@ -1383,7 +2131,7 @@ def endpoint_get_templates():
 
             return jsonify({"code": "0", "message": "Success", "data": data.get("template")}), 200
 
-        return send_api_get_info(request.path, path)
+        return get_reference_info(request.path, type_service, "GET_TEMPLATE")
 
     except Exception as e:
         logging.error(f"Error: {e}")
@@ -1396,7 +2144,6 @@ def endpoint_get_categories():
     try:
         type_service = request.json.get("type", "ITS")
 
-        path = API_PATH["API_ITS"]["GET_CATEGORY"] if type_service == "ITS" else API_PATH["API_HO"]["GET_CATEGORY"]
         # DEV environment
         if ENV == "DEV":
             data = read_json_data(SETTINGS["PATH_DATA"])
@@ -1408,7 +2155,7 @@ def endpoint_get_categories():
 
             return jsonify({"code": "0", "message": "Success", "data": data.get("category")}), 200
 
-        return send_api_get_info(request.path, path)
+        return get_reference_info(request.path, type_service, "GET_CATEGORY")
 
     except Exception as e:
         logging.error(f"Error: {e}")
@@ -1421,8 +2168,6 @@ def endpoint_get_sub_categories():
     try:
         type_service = request.json.get("type", "ITS")
 
-        path = API_PATH["API_ITS"]["GET_SUB_CATEGORY"] if type_service == "ITS" else API_PATH["API_HO"]["GET_SUB_CATEGORY"]
-
         category_id = request.json.get("categoryId")
         if not category_id:
             logger.error(f"API: {request.path} - Error: Missing categoryId")
@@ -1451,7 +2196,7 @@ def endpoint_get_sub_categories():
 
             return jsonify({"code": "0", "message": "Success", "data": []}), 200
 
-        return send_api_get_info(request.path, path + "/" + category_id)
+        return get_reference_info(request.path, type_service, "GET_SUB_CATEGORY", category_id)
     
     except Exception as e:
         logging.error(f"Error: {e}")
@@ -1464,8 +2209,6 @@ def endpoint_get_items():
     try:
         type_service = request.json.get("type", "ITS")
 
-        path = API_PATH["API_ITS"]["GET_ITEM"] if type_service == "ITS" else API_PATH["API_HO"]["GET_ITEM"]
-
         sub_category_id = request.json.get("subCategoryId")
         if not sub_category_id:
             logger.error(f"API: {request.path} - Error: Missing subCategoryId")
@@ -1493,12 +2236,37 @@ def endpoint_get_items():
                             }), 200
             return jsonify({"code": "0", "message": "Success", "data": []}), 200
 
-        return send_api_get_info(request.path, path + "/" + sub_category_id)
+        return get_reference_info(request.path, type_service, "GET_ITEM", sub_category_id)
 
     except Exception as e:
         logging.error(f"Error: {e}")
         return None, None
 
+@app.route("/api/v1/its/reference-cache", methods=["GET"])
+@basic_auth.login_required
+def endpoint_reference_cache_stats():
+    now = time.time()
+    with reference_cache_lock:
+        stats = dict(reference_cache_stats)
+        entries = [
+            {"type": key[0], "api": key[1], "id": key[2], "age": round(now - entry["fetched_at"])}
+            for key, entry in reference_cache.items()
+        ]
+    return jsonify({"code": "0", "message": "Success", "data": {"stats": stats, "entries": entries}}), 200
+
+
+@app.route("/api/v1/its/reference-cache/purge", methods=["POST"])
+@basic_auth.login_required
+def endpoint_reference_cache_purge():
+    type_service = (request.get_json(silent=True) or {}).get("type")
+    with reference_cache_lock:
+        keys = [key for key in reference_cache if not type_service or key[0] == type_service]
+        for key in keys:
+            reference_cache.pop(key, None)
+    logger.info(f"Reference cache purged: {len(keys)} entries - type: {type_service}")
+    return jsonify({"code": "0", "message": "Success", "data": {"purged": len(keys)}}), 200
+
+
 def process_api_create_ticket(path, request):
     token = get_jwt_token()
     if token is None:
@@ -1658,17 +2426,16 @@ def get_by_jodcode():
     conn = py_common.connect_to_database(read=False)
     if conn is None:
         logger.error("Error connecting to MySQL")
-        return False
+        return jsonify({"code": "1", "message": "Error connecting to MySQL"}), 500
 
-    cursor = conn.cursor()
+    cursor = None
     request_data = request.json
     try:
+        cursor = conn.cursor()
         ma_ticket = request_data.get("maticket")
         email = get_email_by_jodcode(cursor, ma_ticket, logger)
         logging.info(f"{email}")
         conn.commit()
-        cursor.close()
-        conn.close()
         return jsonify(
             {
                 "message": "success", "data": {
@@ -1681,6 +2448,55 @@ def get_by_jodcode():
         logger.error(f"Get info data: {str(e)}", exc_info=True)
         return jsonify({"code": "1", "message": str(e)}), 500
 
+    finally:
+        if cursor:
+            cursor.close()
+        conn.close()
+
+
+@app.route("/api/v1/ho/get-mail-by-jodcode-batch", methods=["POST"])
+@basic_auth.login_required
+def get_by_jodcode_batch():
+    """
+    Bản theo lô của get-mail-by-jodcode: body {"matickets": [...]}, trả về NDJSON,
+    mỗi dòng một ticket theo thứ tự gửi lên, dòng cuối {"done": true, "count": n}.
+    """
+    request_data = request.json or {}
+    matickets = request_data.get("matickets")
+    if not isinstance(matickets, list) or not matickets:
+        return jsonify({"code": "1", "message": "matickets must be a non-empty list"}), 400
+    if len(matickets) > MAIL_BATCH_MAX_TICKETS:
+        return jsonify({"code": "1", "message": f"At most {MAIL_BATCH_MAX_TICKETS} matickets per request"}), 400
+
+    conn = py_common.connect_to_database(read=False)
+    if conn is None:
+        logger.error("Error connecting to MySQL")
+        return jsonify({"code": "1", "message": "Error connecting to MySQL"}), 500
+
+    def generate():
+        cursor = None
+        count = 0
+        try:
+            cursor = conn.cursor()
+            for ma_ticket, email, error in get_email_by_jodcode_batch(cursor, matickets, logger):
+                count += 1
+                if error:
+                    line = {"maticket": ma_ticket, "code": "1", "message": error}
+                else:
+                    line = {"maticket": ma_ticket, "code": "0", "email": email}
+                yield json.dumps(line, ensure_ascii=False, default=str) + "\n"
+            conn.commit()
+            yield json.dumps({"done": True, "count": count}) + "\n"
+        except Exception as e:
+            logger.error(f"Get mail batch: {str(e)}", exc_info=True)
+            yield json.dumps({"done": False, "count": count, "code": "1", "message": str(e)}, ensure_ascii=False) + "\n"
+        finally:
+            if cursor:
+                cursor.close()
+            conn.close()
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
 
 @app.route("/api/v1/its/create-ticket-hos-tmp", methods=["POST"])
 @basic_auth.login_required
@@ -1721,23 +2537,195 @@ def endpoint_create_ticket_hos_tmp():
         return jsonify({"code": "1", "message": str(e)}), 500
 
 
-def callback(ch, method, properties, body):
-    message_str = body.decode()  # Decode byte body to string
+template_index = {
+    "ITS": {"names": [], "entries": [], "source": None},
+    "HO": {"names": [], "entries": [], "source": None},
+}
+template_index_lock = Lock()
+template_miss_lock = Lock()
+template_miss_refreshed = {"ITS": 0, "HO": 0}
+TEMPLATE_MISS_REFRESH_INTERVAL = 60  # At most one gateway reload per service per minute on a miss
+
+
+def build_template_index(templates, source):
+    """
+    Sort templates by name so that every name starting with a code is one contiguous range.
+    The upstream position is kept to return the same template as a linear startswith scan.
+    """
+    entries = sorted(
+        (str(template.get("template_name") or ""), position, str(template.get("template_id")))
+        for position, template in enumerate(templates))
+    return {"names": [entry[0] for entry in entries], "entries": entries, "source": source}
+
+
+def seed_template_index():
+    data_template = read_json_data("template.json")
+    if not data_template:
+        return
+
+    with template_index_lock:
+        for service in ("ITS", "HO"):
+            if data_template.get(service) and not template_index[service]["entries"]:
+                template_index[service] = build_template_index(data_template.get(service), "template.json")
+    logger.info("Template index seeded from template.json")
+
+
+def refresh_template_index(service):
+    response_data = get_data("/api/v1/its/get-template", API_PATH[f"API_{service}"]["GET_TEMPLATE_BY_SERVICE_CATE"])
+    if not response_data:
+        logger.error(f"Empty response data - keep template index {service} from {template_index[service]['source']}")
+        return
+
+    index = build_template_index(response_data, "gateway")
+    with template_index_lock:
+        template_index[service] = index
+    logger.info(f"Template index {service} refreshed: {len(index['entries'])} templates")
+
+
+def refresh_template_index_loop():
+    """
+    Background job: seed the template index from template.json, then reload it from the
+    gateway every TEMPLATE_INDEX_REFRESH seconds.
+    """
+    seed_template_index()
+    while True:
+        for service in ("ITS", "HO"):
+            try:
+                refresh_template_index(service)
+            except Exception as e:
+                logger.error(f"Error refreshing template index {service}: {e}", exc_info=True)
+        time.sleep(TEMPLATE_INDEX_REFRESH)
+
+
+def resolve_template_id(service, code):
+    """
+    Find the id of the first template (in upstream order) whose name starts with `code`.
+    On a miss the index is reloaded from the gateway once (single-flight, at most every
+    TEMPLATE_MISS_REFRESH_INTERVAL seconds) so that newly added templates resolve right away.
+    Returns:
+        str: The template id, or "" if no template matches.
+    """
+    template_id = lookup_template_id(service, code)
+    if template_id:
+        return template_id
+
+    with template_miss_lock:
+        # Thread khác vừa nạp lại trong lúc chờ lock thì chỉ cần tra lại
+        if time.time() - template_miss_refreshed[service] >= TEMPLATE_MISS_REFRESH_INTERVAL:
+            template_miss_refreshed[service] = time.time()
+            logger.info(f"Template code {code} not in index {service}, reloading from gateway")
+            try:
+                refresh_template_index(service)
+            except Exception as e:
+                logger.error(f"Error refreshing template index {service}: {e}", exc_info=True)
+    return lookup_template_id(service, code)
+
+
+def lookup_template_id(service, code):
+    with template_index_lock:
+        index = template_index[service]
+
+    names = index["names"]
+    start = bisect.bisect_left(names, code)
+    end = bisect.bisect_right(names, code + "\U0010ffff", lo=start)
+    if start == end:
+        return ""
+
+    return min(index["entries"][start:end], key=lambda entry: entry[1])[2]
+
+
+def request_not_sent(error):
+    """Lỗi xảy ra trước khi gateway nhận được request (không mở được kết nối): gửi lại an toàn."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], "reason", None), NewConnectionError)
+    return False
+
+
+def send_gateway_request(ticket_id, send):
+    """
+    Gọi `send()` (POST tạo/cập nhật request) và trả về response.
+    Returns:
+        tuple: (response, None) khi có phản hồi; (None, True) khi request chưa tới gateway và có thể
+            gửi lại; (None, False) khi không biết gateway đã nhận hay chưa (read timeout, mất kết nối
+            giữa chừng) - gửi lại có thể tạo trùng nên bỏ message và ghi log để kiểm tra tay.
+    """
+    try:
+        return send(), None
+    except Exception as e:
+        if request_not_sent(e):
+            logger.error(f"Gateway unreachable for ticket {ticket_id}, will retry: {e}")
+            return None, True
+        logger.error(f"[MANUAL CHECK] Request for ticket {ticket_id} may have reached the gateway, "
+                     f"not resent: {e}", exc_info=True)
+        return None, False
+
+
+def finish_gateway_request(ticket_id, response, action, previous_ids=None):
+    """
+    Đọc phản hồi của gateway và lưu request id. Gateway từ chối rõ ràng (error_code khác "00") thì
+    chưa có request nào được tạo, trả về False để gửi lại. Các lỗi còn lại (phản hồi không phải JSON,
+    thiếu request id, không lưu được id) xảy ra khi request có thể đã được tạo: chỉ ghi log để kiểm
+    tra tay, không gửi lại.
+    """
+    try:
+        content = response.json()
+    except ValueError:
+        logger.error(f"[MANUAL CHECK] Non-JSON reply to {action} for ticket {ticket_id} "
+                     f"(status {response.status_code}): {response.text[:255]}")
+        return True
+
+    if content.get("res_code", {}).get("error_code") != "00":
+        logger.error(f"Failed to {action} request: {content}")
+        return False
+
+    request_id = content.get("data", {}).get("request", {}).get("id")
+    if request_id is None:
+        logger.error(f"[MANUAL CHECK] No request ID in reply to {action} for ticket {ticket_id}: {content}")
+        return True
+
+    if previous_ids:
+        request_id = previous_ids + ";" + request_id
+    if not store_request_id(ticket_id, request_id):
+        logger.error(f"[MANUAL CHECK] Request {request_id} exists on the gateway but was not stored "
+                     f"for ticket {ticket_id}")
+        return True
+    logger.info(f"Request created successfully: {request_id} - Ticket ID: {ticket_id}")
+    return True
+
+
+def process_ticket_message(body):
+    """
+    Handle one Ticket_API message: create (or update, for forwarded tickets) the ITS/HO request
+    and store its id on app_fd_sp_tickets. Errors are logged, never raised.
+    Returns True when the message is finished (request id stored, nothing to do, the message itself
+    is invalid, or the request may already exist on the gateway) and False when it can safely be
+    handled again (nothing was sent, or the gateway rejected it).
+    """
+    message_str = body.decode(errors="replace")  # Decode byte body to string
     truncated_message = message_str[:255]  # Truncate to 255 characters
     logger.info(f"[>] Received message: {truncated_message}")
 
     # Assuming the message is a JSON string
     try:
         data = json.loads(body)
-        ticket_id = data.get("ticket")
-        template_id = data.get("template")
-        info = data.get("message")
-        type = data.get("type")
-        subject = data.get("subject")
-        description = data.get("description")
-        attachments = data.get("attachments")
-        phone_number = data.get("phone_number")
+        if not isinstance(data, dict):
+            raise ValueError("Message is not a JSON object")
+    except ValueError as e:
+        logger.error(f"Invalid Ticket_API message, dropped: {e}")
+        return True
+
+    ticket_id = data.get("ticket")
+    template_id = data.get("template")
+    info = data.get("message")
+    type = data.get("type")
+    subject = data.get("subject")
+    description = data.get("description")
+    attachments = data.get("attachments")
+    phone_number = data.get("phone_number")
 
+    try:
         connection = py_common.connect_to_database(read=False)
         cursor = connection.cursor()
         cursor.execute(
@@ -1750,13 +2738,12 @@ def callback(ch, method, properties, body):
 
         token = get_jwt_token()
         if token is None:
-            raise ValueError("No token available. Exiting callback")
+            raise RuntimeError("No token available. Exiting callback")
 
         if ticket_data:
             if ticket_data[0] and ticket_data[2] != "Đã chuyển tiếp":
                 logger.warning(f"Ticket ID: {ticket_id} has call create request with ITsId: {ticket_data[0]}.")
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-                return
+                return True
 
             if ticket_data[0] and ticket_data[2] == "Đã chuyển tiếp":
                 logger.warning(f"Ticket ID: {ticket_id} has been forwarded to another department.")
@@ -1767,80 +2754,57 @@ def callback(ch, method, properties, body):
                 path = API_PATH["API_ITS"]["UPDATE_REQUEST"] if type == "ITS" else (API_PATH["API_HO"]["UPDATE_REQUEST"]
                                                                                     + its_id)
 
-                response = send_api_update_ticket(
+                response, retry = send_gateway_request(ticket_id, lambda: send_api_update_ticket(
                     token,
                     description,
                     phone_number,
                     attachments,
                     path
-                )
-
-                content = response.json()
-                if content.get("res_code", {}).get("error_code") == "00":
-                    request_id = content.get("data", {}).get("request", {}).get("id")
-                    if request_id is None:
-                        raise ValueError("No request ID found in response")
-
-                    request_id = ticket_data[0] + ";" + request_id
-                    update_request_id(ticket_id, request_id)
-                    logger.info(f"Request created successfully: {request_id} - Ticket ID: {ticket_id}")
-
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-                return
+                ))
+                if response is None:
+                    return not retry
+                return finish_gateway_request(ticket_id, response, "update", previous_ids=ticket_data[0])
 
         requester_id = 13502  # id của CALL CENTER
         login_name = "cskh"  # id của CALL CENTER
 
-        if not info:
-            raise ValueError("No info found in message")
-        info_id = info.split(";")
-
-        if len(info_id) < 3:
-            raise ValueError(f"Invalid message format - {info}")
-
-        category = info_id[0].split("+")
-        sub_category = info_id[1].split("+")
-        item = info_id[2].split("+")
-
-        sub_code = sub_category[1].split(".")[0]
-        template_item = ''
-        template_code = ''
-        if len(info_id) >= 4:
-            template_item = info_id[3]
-            template_code = template_item.split(".")[0]
+        # Kiểm tra nội dung message: sai định dạng thì gửi lại cũng không thành công
+        try:
+            if not info:
+                raise ValueError("No info found in message")
+            info_id = info.split(";")
+
+            if len(info_id) < 3:
+                raise ValueError(f"Invalid message format - {info}")
+
+            category = info_id[0].split("+")
+            sub_category = info_id[1].split("+")
+            item = info_id[2].split("+")
+            if len(sub_category) < 2:
+                raise ValueError(f"Invalid sub category - {info_id[1]}")
+
+            sub_code = sub_category[1].split(".")[0]
+            template_item = ''
+            template_code = ''
+            if len(info_id) >= 4:
+                template_item = info_id[3]
+                template_code = template_item.split(".")[0]
+
+            if not ticket_id:
+                raise ValueError("No ticket ID found in message")
+        except ValueError as e:
+            logger.error(f"Invalid Ticket_API message, dropped: {e}")
+            return True
 
         if template_id == "" and (sub_code or template_code):
             code_for_template = template_code if template_code else sub_code
 
             if ENV != "DEV":
-                response_data = get_data(
-                    "/api/v1/its/get-template",
-                    API_PATH["API_ITS"]["GET_TEMPLATE_BY_SERVICE_CATE"] if type == "ITS" else API_PATH["API_HO"][
-                        "GET_TEMPLATE_BY_SERVICE_CATE"])
-                if response_data:
-                    for template in response_data:
-                        if template["template_name"].startswith(code_for_template):
-                            template_id = str(template["template_id"])
-                            break
-                    logger.info(f"Template searched: {template_id}")
-                else:
-                    logger.error(f"Empty response data - Get ID From Fixed Code - {code_for_template}")
-                    data_template = read_json_data("template.json")
-
-                    # ITs:
-                    if type == "ITS":
-                        if data_template and data_template.get("ITS"):
-                            for template in data_template.get("ITS"):
-                                if template.get("template_name").startswith(code_for_template):
-                                    template_id = template.get("template_id")
-                                    break
-                    # HO:
-                    else:
-                        if data_template and data_template.get("HO"):
-                            for template in data_template.get("HO"):
-                                if template.get("template_name").startswith(code_for_template):
-                                    template_id = template.get("template_id")
-                                    break
+                template_id = resolve_template_id("ITS" if type == "ITS" else "HO", code_for_template)
+                logger.info(f"Template searched: {template_id}")
+                if not template_id:
+                    # Gateway chưa có template hoặc chưa nạp được: gửi lại message sau
+                    raise RuntimeError(f"Template not found for code {code_for_template}")
             else:
                 template_id = code_for_template
         # map attachments to ticket_id
@@ -1849,7 +2813,7 @@ def callback(ch, method, properties, body):
             attachs = attachments.split(";")
 
             attach_handle = [f"{CRM_HOST_FILE_TICKET}/{ticket_id}/{attach}" for attach in attachs]
-        description = description.replace(CRM_TEXT_REPLACE, CRM_HOST_FILE_TICKET)
+        description = description.replace(CRM_TEXT_REPLACE, CRM_HOST_FILE_TICKET) if description else description
 
         logger.info(
             f"Received data: ticket_id = {ticket_id}"
@@ -1857,65 +2821,110 @@ def callback(ch, method, properties, body):
             f"\n\t> subject={subject} "
             f"\n\t> assignments={attach_handle}"
             f"\n\t> description={description[:255] if description else ''}")
-        if not ticket_id:
-            raise ValueError("No ticket ID found in message")
 
         if ticket_id == "" or template_id == "" or category[0] == "" or sub_category[0] == "" or item[0] == "":
-            raise ValueError("Missing required fields")
+            logger.error(f"Invalid Ticket_API message, dropped: Missing required fields")
+            return True
 
         if (ENV == "DEV"):
             logger.info(f"DEV environment, skipping API call.")
-            raise ValueError("DEV environment, skipping API call.")
+            return True
 
         path = API_PATH["API_ITS"]["CREATE_REQUEST"] if type == "ITS" else API_PATH["API_HO"]["CREATE_REQUEST"]
 
-        if type == "ITS":
-            response = send_api_create_ticket(
-                token,
-                subject,
-                description,
-                requester_id,
-                phone_number,
-                template_id=template_id,
-                cat_id=category[0],
-                sub_cat_id=sub_category[0],
-                item_id=item[0],
-                attachments=attach_handle,
-                login_name=login_name,
-                complain_id="",
-                path=path)
-        else:
-            response = send_api_create_ticket(
-                token,
-                subject,
-                description,
-                requester_id,
-                phone_number,
-                template_id=template_id,
-                cat_id=category[0],
-                sub_cat_id=sub_category[0],
-                item_id=item[0],
-                attachments=attach_handle,
-                login_name=login_name,
-                complain_id="",
-                path=path)
-
-        content = response.json()
-        if content.get("res_code", {}).get("error_code") == "00":
-            request_id = content.get("data", {}).get("request", {}).get("id")
-            if request_id is None:
-                raise ValueError("No request ID found in response")
-
-            update_request_id(ticket_id, request_id)
-            logger.info(f"Request created successfully: {request_id} - Ticket ID: {ticket_id}")
-        else:
-            logger.error(f"Failed to create request: {content}")
+        response, retry = send_gateway_request(ticket_id, lambda: send_api_create_ticket(
+            token,
+            subject,
+            description,
+            requester_id,
+            phone_number,
+            template_id=template_id,
+            cat_id=category[0],
+            sub_cat_id=sub_category[0],
+            item_id=item[0],
+            attachments=attach_handle,
+            login_name=login_name,
+            complain_id="",
+            path=path))
+        if response is None:
+            return not retry
+        return finish_gateway_request(ticket_id, response, "create")
 
     except Exception as e:
+        # Lỗi trước khi gửi request (DB, token, template): xử lý lại an toàn
         logger.error(e, exc_info=True)
+        return False
+
+
+def store_request_id(ticket_id, request_id):
+    """
+    The request already exists on the gateway, so retry the DB update here before giving up:
+    a redelivered message would create the request a second time.
+    """
+    for attempt in range(1, SETTINGS["MAX_RETRIES"] + 1):
+        if update_request_id(ticket_id, request_id):
+            return True
+        logger.error(f"Storing request id {request_id} for ticket {ticket_id} failed (attempt {attempt})")
+        time.sleep(SETTINGS["RETRY_DELAY"])
+    return False
+
 
-    # Acknowledge the message
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+def ack_message(channel, delivery_tag):
+    if channel.is_open:
+        channel.basic_ack(delivery_tag=delivery_tag)
+    else:
+        logger.warning(f"Channel closed, message {delivery_tag} will be redelivered")
+
+
+def nack_message(channel, delivery_tag, requeue):
+    if channel.is_open:
+        channel.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
+    else:
+        logger.warning(f"Channel closed, message {delivery_tag} will be redelivered")
+
+
+def ticket_worker(work_queue):
+    """
+    Worker thread of the Ticket_API consumer. Messages of one partition are handled in arrival
+    order and acked (on the connection thread) only after the request id has been committed.
+    A failed message is retried here, blocking its partition so later messages of the same ticket
+    wait, up to SETTINGS["MAX_RETRIES"] times; then it is rejected without requeue, which
+    dead-letters it when the queue has a dead-letter exchange policy. Messages of a connection
+    that has closed are skipped: the broker delivers them again on the new connection.
+    """
+    while True:
+        connection, channel, delivery_tag, body = work_queue.get()
+        attempt = 0
+        while True:
+            if not (connection.is_open and channel.is_open):
+                logger.warning(f"Connection closed, message {delivery_tag} skipped (it will be redelivered)")
+                settle = None
+                break
+            if process_ticket_message(body):
+                settle = functools.partial(ack_message, channel, delivery_tag)
+                break
+            attempt += 1
+            if attempt >= SETTINGS["MAX_RETRIES"]:
+                logger.error(f"Message {delivery_tag} failed {attempt} times, rejected")
+                settle = functools.partial(nack_message, channel, delivery_tag, False)
+                break
+            logger.error(f"Message {delivery_tag} failed (attempt {attempt}), retrying")
+            time.sleep(SETTINGS["RETRY_DELAY"] * attempt)
+        if settle is None:
+            continue
+        try:
+            connection.add_callback_threadsafe(settle)
+        except Exception as e:
+            logger.error(f"Cannot settle message {delivery_tag}, it will be redelivered: {e}")
+
+
+def message_partition(body, partitions):
+    # Cùng một ticket luôn vào cùng một worker để giữ thứ tự xử lý
+    try:
+        ticket_id = json.loads(body).get("ticket") or ""
+    except Exception:
+        ticket_id = ""
+    return zlib.crc32(str(ticket_id).encode("utf-8")) % partitions
 
 
 MAX_RETRIES = 5  # Maximum retry attempts
@@ -1925,6 +2934,13 @@ RETRY_DELAY = 5  # Delay (in seconds) between retries
 def start_consuming():
     config = py_common.read_config(os.path.join(dir_config, "common_config", "config.ini"))
     rabbitmq_config = config['rabbitmq']
+    workers = int(rabbitmq_config.get("consumer_workers", "4"))
+    prefetch_count = int(rabbitmq_config.get("consumer_prefetch", str(workers * 5)))
+
+    work_queues = [queue.Queue() for _ in range(workers)]
+    for index, work_queue in enumerate(work_queues):
+        Thread(target=ticket_worker, args=(work_queue,), name=f"ticket-worker-{index}", daemon=True).start()
+    logger.info(f"Ticket_API consumer: {workers} workers, prefetch {prefetch_count}")
 
     retries = 0
     while retries < MAX_RETRIES:
@@ -1939,10 +2955,16 @@ def start_consuming():
             channel = connection.channel()
 
             # Declare the queue
-            channel.queue_declare(queue=rabbitmq_config['ticketQueue'])
+            channel.queue_declare(queue=rabbitmq_config['ticketQueue'],
+                                  durable=rabbitmq_config.getboolean('durable_queues', fallback=False))
+
+            def dispatch(ch, method, properties, body, connection=connection):
+                work_queue = work_queues[message_partition(body, workers)]
+                work_queue.put((connection, ch, method.delivery_tag, body))
 
             # Consume messages from the queue
-            channel.basic_consume(queue=rabbitmq_config['ticketQueue'], on_message_callback=callback, auto_ack=True)
+            channel.basic_qos(prefetch_count=prefetch_count)
+            channel.basic_consume(queue=rabbitmq_config['ticketQueue'], on_message_callback=dispatch, auto_ack=False)
 
             logger.info(' [*] Waiting for messages. To exit press CTRL+C')
             channel.start_consuming()
@@ -1962,5 +2984,8 @@ def main():
 
 
 if __name__ == "__main__":
+    Thread(target=refresh_jwt_token_loop, daemon=True).start()
+    if ENV != "DEV":
+        Thread(target=refresh_template_index_loop, daemon=True).start()
     Thread(target=main).start()
     app.run(host="0.0.0.0", port=8082)
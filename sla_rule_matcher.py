@@ -0,0 +1,347 @@
+import logging
+import math
+import re
+import threading
+import time
+import unicodedata
+
+SLA_TABLE = "jwdb.app_fd_su_sla_ticket"
+RELOAD_INTERVAL = 60  # Check the SLA table for changes at most once a minute
+
+# Câu truy vấn gốc, giữ lại để đối chiếu kết quả với bộ so khớp trong bộ nhớ
+SLA_QUERY = """
+    SELECT
+        COALESCE(c_tgian_xuly * 1, 0) + COALESCE(c_tgian_dong * 1, 0) + COALESCE(c_tgian_chuyentiep * 1, 0) AS sla,
+        COALESCE(c_tgian_xuly, 0) AS sla_xuly,
+        COALESCE(c_tong_ngay, 0) AS tong_ngay
+    FROM
+        {table}
+    WHERE
+        COALESCE(c_PhanLoai, '') LIKE CONCAT('%', %s, '%')
+        AND (
+            COALESCE(c_NhomYeuCau, '') LIKE CONCAT('%', %s, '%')
+            OR c_NhomYeuCau = ''
+        )
+        AND (
+            COALESCE(c_DanhMucYeuCau, '') LIKE CONCAT('%', %s, '%')
+            OR c_DanhMucYeuCau = ''
+        )
+        AND COALESCE(c_loai_sla, '') LIKE CONCAT('%', %s, '%')
+        AND COALESCE(c_douutien_tk, '') LIKE CONCAT('%', %s, '%')
+    ORDER BY
+        CASE WHEN COALESCE(c_NhomYeuCau, '') LIKE CONCAT('%', %s, '%')
+        AND COALESCE(c_DanhMucYeuCau, '') LIKE CONCAT('%', %s, '%') THEN 0 ELSE 1 END
+    LIMIT 1;
+    """
+
+RULE_COLUMNS = (
+    "c_PhanLoai", "c_NhomYeuCau", "c_DanhMucYeuCau", "c_loai_sla", "c_douutien_tk",
+    "c_tgian_xuly", "c_tgian_dong", "c_tgian_chuyentiep", "c_tong_ngay",
+)
+
+NUMERIC_PREFIX = re.compile(r"\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?")
+
+sla_rules = {"rules": [], "version": None, "checked_at": 0, "cache": {}, "refreshing": False}
+sla_rules_lock = threading.Lock()
+
+
+def mysql_number(value):
+    """Giống `value * 1` của MySQL: lấy phần số ở đầu chuỗi, không có thì 0, NULL giữ NULL."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = NUMERIC_PREFIX.match(str(value))
+    return float(match.group(0)) if match else 0.0
+
+
+def is_blank(value):
+    # c_X = '' trong MySQL: NULL không bằng '', khoảng trắng cuối bị bỏ qua (PAD SPACE)
+    return value is not None and str(value).rstrip(" ") == ""
+
+
+def fold(value):
+    """Chuẩn hoá chuỗi như collation *_ci của MySQL: không phân biệt hoa/thường và dấu."""
+    value = unicodedata.normalize("NFD", str(value).lower())
+    return "".join(ch for ch in value if not unicodedata.combining(ch))
+
+
+def compile_contains(param):
+    """
+    Biên dịch `LIKE CONCAT('%', param, '%')` thành hàm kiểm tra chuỗi (đã fold()).
+    Tham số NULL thì không khớp dòng nào, giống MySQL.
+    """
+    if param is None or (isinstance(param, float) and math.isnan(param)):
+        return None
+    pattern = "%" + fold(param) + "%"
+    if not any(ch in pattern[1:-1] for ch in "%_\\"):
+        needle = pattern[1:-1]
+        return lambda value: needle in value
+
+    parts = []
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == "\\" and i + 1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        elif ch == "%":
+            parts.append(".*")
+        elif ch == "_":
+            parts.append(".")
+        else:
+            parts.append(re.escape(ch))
+        i += 1
+    regex = re.compile("".join(parts), re.S)
+    return lambda value: regex.fullmatch(value) is not None
+
+
+def compile_params(phan_loai, nhom_yeu_cau, danh_muc, cap_do_xu_ly, muc_do):
+    return (
+        compile_contains(phan_loai),
+        compile_contains(nhom_yeu_cau),
+        compile_contains(danh_muc),
+        compile_contains(cap_do_xu_ly),
+        compile_contains(muc_do),
+    )
+
+
+def rule_rank(rule, matchers):
+    """0/1 giống ORDER BY CASE của SLA_QUERY, None nếu dòng không thỏa WHERE."""
+    match_l1, match_l2, match_l3, match_loai, match_douutien = matchers
+    if match_l1 is None or match_loai is None or match_douutien is None:
+        return None
+    if not (match_l1(rule["phan_loai"]) and match_loai(rule["loai_sla"]) and match_douutien(rule["douutien"])):
+        return None
+    l2_ok = match_l2 is not None and match_l2(rule["nhom"])
+    l3_ok = match_l3 is not None and match_l3(rule["danh_muc"])
+    if not (l2_ok or rule["nhom_blank"]) or not (l3_ok or rule["danh_muc_blank"]):
+        return None
+    return 0 if l2_ok and l3_ok else 1
+
+
+def build_rule(row):
+    phan_loai, nhom, danh_muc, loai_sla, douutien, xuly, dong, chuyentiep, tong_ngay = row
+    parts = [mysql_number(xuly), mysql_number(dong), mysql_number(chuyentiep)]
+    return {
+        "phan_loai": "" if phan_loai is None else fold(phan_loai),
+        "nhom": "" if nhom is None else fold(nhom),
+        "danh_muc": "" if danh_muc is None else fold(danh_muc),
+        "loai_sla": "" if loai_sla is None else fold(loai_sla),
+        "douutien": "" if douutien is None else fold(douutien),
+        "nhom_blank": is_blank(nhom),
+        "danh_muc_blank": is_blank(danh_muc),
+        "result": (
+            sum(0.0 if part is None else part for part in parts),
+            "0" if xuly is None else xuly,
+            "0" if tong_ngay is None else tong_ngay,
+        ),
+    }
+
+
+def load_sla_rules(cursor, table=SLA_TABLE):
+    # Thứ tự duyệt theo khóa chính giống thứ tự full scan của InnoDB
+    cursor.execute(f"SELECT {', '.join(RULE_COLUMNS)} FROM {table} ORDER BY id")
+    return [build_rule(row) for row in cursor.fetchall()]
+
+
+def reload_sla_rules(cursor, force=False):
+    """
+    Nạp lại bảng SLA khi số dòng hoặc MAX(dateModified) thay đổi. Truy vấn chạy ngoài lock và chỉ
+    một thread nạp; các thread khác vẫn tra bằng bộ luật hiện có trong lúc chờ.
+    """
+    if not force and time.time() - sla_rules["checked_at"] < RELOAD_INTERVAL:
+        return
+    with sla_rules_lock:
+        if sla_rules["refreshing"] or (not force and time.time() - sla_rules["checked_at"] < RELOAD_INTERVAL):
+            return
+        sla_rules["refreshing"] = True
+        known_version = sla_rules["version"]
+    try:
+        cursor.execute(f"SELECT COUNT(*), MAX(dateModified) FROM {SLA_TABLE}")
+        version = tuple(cursor.fetchall()[0])
+        rules = None
+        if force or version != known_version:
+            rules = load_sla_rules(cursor)
+        with sla_rules_lock:
+            if rules is not None:
+                sla_rules["rules"] = rules
+                sla_rules["cache"] = {}
+                sla_rules["version"] = version
+            sla_rules["checked_at"] = time.time()
+        if rules is not None:
+            logging.info(f"Loaded {len(rules)} SLA rules")
+    except Exception as e:
+        logging.error(f"Error loading SLA rules: {e}")
+    finally:
+        with sla_rules_lock:
+            sla_rules["refreshing"] = False
+
+
+def match_rule(rules, phan_loai, nhom_yeu_cau, danh_muc, cap_do_xu_ly, muc_do):
+    """
+    Trả về dòng SLA đầu tiên khớp: ưu tiên dòng khớp cả nhóm và danh mục (rank 0),
+    sau đó đến dòng đầu tiên khớp nhờ nhóm/danh mục để trống.
+    """
+    matchers = compile_params(phan_loai, nhom_yeu_cau, danh_muc, cap_do_xu_ly, muc_do)
+    if matchers[0] is None or matchers[3] is None or matchers[4] is None:
+        return None
+    fallback = None
+    for rule in rules:
+        rank = rule_rank(rule, matchers)
+        if rank == 0:
+            return rule
+        if rank == 1 and fallback is None:
+            fallback = rule
+    return fallback
+
+
+def find_sla(cursor, phan_loai, nhom_yeu_cau, danh_muc, cap_do_xu_ly, muc_do):
+    """Trả về (sla, sla_xuly, tong_ngay) như query SLA_QUERY, hoặc None nếu không khớp."""
+    reload_sla_rules(cursor)
+    key = (phan_loai, nhom_yeu_cau, danh_muc, cap_do_xu_ly, muc_do)
+    cache = sla_rules["cache"]
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+    except TypeError:
+        key = None
+    rule = match_rule(sla_rules["rules"], phan_loai, nhom_yeu_cau, danh_muc, cap_do_xu_ly, muc_do)
+    result = rule["result"] if rule else None
+    if key is not None:
+        cache[key] = result
+    return result
+
+
+def find_sla_sql(cursor, phan_loai, nhom_yeu_cau, danh_muc, cap_do_xu_ly, muc_do, table=SLA_TABLE):
+    cursor.execute(
+        SLA_QUERY.format(table=table),
+        (phan_loai, nhom_yeu_cau, danh_muc, cap_do_xu_ly, muc_do, nhom_yeu_cau, danh_muc),
+    )
+    rows = cursor.fetchall()
+    return tuple(rows[0]) if rows else None
+
+
+def same_result(sql_result, rule_result):
+    if sql_result is None or rule_result is None:
+        return sql_result is None and rule_result is None
+    return (
+        math.isclose(float(sql_result[0]), rule_result[0])
+        and str(sql_result[1]) == str(rule_result[1])
+        and str(sql_result[2]) == str(rule_result[2])
+    )
+
+
+def verify_against_sql(cursor, table=SLA_TABLE, samples=None):
+    """
+    So sánh bộ so khớp trong bộ nhớ với SLA_QUERY trên `table`. Nếu không truyền samples,
+    dùng các giá trị có trong bảng, chuỗi con của chúng, '' và NULL làm tham số.
+    MySQL không quy định thứ tự giữa các dòng cùng rank, nên khác biệt chỉ do thứ tự đó
+    được đếm riêng trong "tie_order".
+    """
+    rules = load_sla_rules(cursor, table)
+    if samples is None:
+        cursor.execute(f"SELECT c_PhanLoai, c_NhomYeuCau, c_DanhMucYeuCau, c_loai_sla, c_douutien_tk FROM {table}")
+        rows = [tuple("" if v is None else str(v) for v in row) for row in cursor.fetchall()]
+        found = set()
+        for i, (l1, l2, l3, loai, douutien) in enumerate(rows):
+            next_l2, next_l3 = rows[(i + 1) % len(rows)][1:3]
+            found.update([
+                (l1, l2, l3, loai, douutien),
+                (l1[:5], l2, l3, loai, douutien),
+                (l1, "", l3, loai, douutien),
+                (l1, None, l3, loai, douutien),
+                (l1, l2, None, loai, douutien),
+                (l1, l2, "", loai, douutien),
+                (l1, next_l2, next_l3, loai, douutien),
+                (l1.upper(), l2.lower(), l3, loai[:3], ""),
+            ])
+        samples = sorted(found, key=lambda params: tuple((v is None, v or "") for v in params))
+
+    report = {"checked": 0, "equal": 0, "tie_order": 0, "mismatches": []}
+    for params in samples:
+        sql_result = find_sla_sql(cursor, *params, table=table)
+        rule = match_rule(rules, *params)
+        rule_result = rule["result"] if rule else None
+        report["checked"] += 1
+        if same_result(sql_result, rule_result):
+            report["equal"] += 1
+            continue
+        # Kết quả SQL là một dòng khác cùng rank với dòng đã chọn
+        matchers = compile_params(*params)
+        best = rule_rank(rule, matchers) if rule else None
+        tied = [candidate["result"] for candidate in rules if best is not None and rule_rank(candidate, matchers) == best]
+        if any(same_result(sql_result, result) for result in tied):
+            report["tie_order"] += 1
+        else:
+            report["mismatches"].append({"params": params, "sql": sql_result, "memory": rule_result})
+    return report
+
+
+# Bảng mẫu chứa các trường hợp biên: NULL, '', khoảng trắng, ký tự đại diện LIKE, chữ hoa/thường
+FIXTURE_ROWS = [
+    ("r01", "Log-Lv1-000265", "Log-Lv2-000001", "Log-Lv3-000001", "Xử lý lần 1", "Cao", "2", "1", "0", "3"),
+    ("r02", "Log-Lv1-000265", "", "", "Xử lý lần 1", "Cao", "4", None, "1", "5"),
+    ("r03", "Log-Lv1-000265", None, "Log-Lv3-000002", "Xử lý lần 1", "Thấp", "1.5", "abc", "", None),
+    ("r04", "log-lv1-000268", "Log-Lv2-000002", "  ", "Xử lý lần 2", "Trung bình", "3 ngày", "1", "1", "4"),
+    ("r05", "Log-Lv1-000268;Log-Lv1-000273", "Log-Lv2-000002", "Log-Lv3-000003", "Xử lý lần 2;Xử lý lần 3", "Cao", "1", "1", "1", "2"),
+    ("r06", "Log_Lv1%000273", "", "Log-Lv3-000004", "Xử lý lần 1", "Cao", None, None, None, None),
+    ("r07", None, "", "", "Xử lý lần 1", "Cao", "9", "9", "9", "9"),
+    ("r08", "Log-Lv1-000273", "Log-Lv2-000003", "Log-Lv3-000005", "", "", "6", "0", "0", "6"),
+]
+
+
+def run_fixture_check(conn):
+    """Tạo bảng tạm từ FIXTURE_ROWS và chạy verify_against_sql trên đó."""
+    cursor = conn.cursor()
+    cursor.execute("DROP TEMPORARY TABLE IF EXISTS tmp_sla_ticket_fixture")
+    cursor.execute(f"CREATE TEMPORARY TABLE tmp_sla_ticket_fixture LIKE {SLA_TABLE}")
+    cursor.executemany(
+        f"INSERT INTO tmp_sla_ticket_fixture (id, {', '.join(RULE_COLUMNS)}) "
+        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+        FIXTURE_ROWS,
+    )
+    extra = [
+        ("LOG-LV1-000265", "log-lv2-000001", "LOG-LV3-000001", "xử lý lần 1", "cao"),
+        ("Log-Lv1-000273", "", "Log-Lv3-000004", "Xử lý lần 1", "Cao"),
+        ("Log-Lv1-000265", None, None, "Xử lý lần 1", "Cao"),
+        ("Lv1", "Lv2", "Lv3", "lần", ""),
+        ("%", "_", "%", "%", "%"),
+        ("Log-Lv1-000268", "Log-Lv2-000002", "Log-Lv3-000003", "Xử lý lần 3", "Cao"),
+    ]
+    report = verify_against_sql(cursor, table="tmp_sla_ticket_fixture")
+    extra_report = verify_against_sql(cursor, table="tmp_sla_ticket_fixture", samples=extra)
+    cursor.execute("DROP TEMPORARY TABLE IF EXISTS tmp_sla_ticket_fixture")
+    cursor.close()
+    for key in ("checked", "equal", "tie_order"):
+        report[key] += extra_report[key]
+    report["mismatches"] += extra_report["mismatches"]
+    return report
+
+
+if __name__ == "__main__":
+    import os
+    from configparser import ConfigParser
+
+    import mysql.connector
+
+    logging.basicConfig(level=logging.INFO)
+    config = ConfigParser()
+    config.read(os.path.join(os.path.dirname(__file__), "common_config", "config.ini"))
+    db = config["mysql_slave"]
+    conn = mysql.connector.connect(
+        host=db["host"], user=db["user"], password=db["password"], database=db["database"]
+    )
+    try:
+        fixture = run_fixture_check(conn)
+        print(f"Fixture: {fixture['checked']} checked, {fixture['equal']} equal, "
+              f"{fixture['tie_order']} tie order, {len(fixture['mismatches'])} mismatches")
+        live = verify_against_sql(conn.cursor())
+        print(f"{SLA_TABLE}: {live['checked']} checked, {live['equal']} equal, "
+              f"{live['tie_order']} tie order, {len(live['mismatches'])} mismatches")
+        for mismatch in (fixture["mismatches"] + live["mismatches"])[:20]:
+            print(mismatch)
+        raise SystemExit(1 if fixture["mismatches"] or live["mismatches"] else 0)
+    finally:
+        conn.close()
@@ -0,0 +1,12 @@
+-- Claim của xuly_luong_ticket trên từng dòng outbox_sp_tickets:
+-- node đang giữ, thời điểm claim, số lần thử và thời điểm được thử lại (backoff khi lỗi).
+CREATE TABLE IF NOT EXISTS jwdb.outbox_claims (
+    outbox_id BIGINT NOT NULL PRIMARY KEY,
+    owner VARCHAR(128) NULL,
+    claimed_at DATETIME(3) NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    retry_at DATETIME(3) NULL,
+    last_error VARCHAR(1000) NULL,
+    KEY idx_outbox_claims_owner (owner),
+    KEY idx_outbox_claims_retry_at (retry_at)
+);
@@ -0,0 +1,17 @@
+-- Lease bucket của các node xuly_luong_ticket: ticket_id được băm vào LEASE_BUCKETS bucket,
+-- mỗi bucket do một node giữ tới expires_at. Các dòng bucket (0 .. LEASE_BUCKETS - 1) do worker
+-- tự thêm bằng INSERT IGNORE khi khởi động.
+CREATE TABLE IF NOT EXISTS jwdb.worker_leases (
+    bucket INT NOT NULL PRIMARY KEY,
+    owner VARCHAR(128) NULL,
+    expires_at DATETIME(3) NULL,
+    heartbeat_at DATETIME(3) NULL
+);
+
+-- Các node đang sống (heartbeat), dùng để chia đều bucket. Dòng hết hạn được node khác xóa.
+CREATE TABLE IF NOT EXISTS jwdb.worker_nodes (
+    node_id VARCHAR(128) NOT NULL PRIMARY KEY,
+    expires_at DATETIME(3) NOT NULL,
+    started_at DATETIME(3) NOT NULL,
+    KEY idx_worker_nodes_expires_at (expires_at)
+);
@@ -0,0 +1,100 @@
+"""
+CompanyIndex trên bảng mẫu, kết quả mong đợi theo ngữ nghĩa của `%s like company_code` và
+`company_code = %s` trên MySQL (collation _ci, PAD SPACE cho =, LIKE không bỏ dấu cách cuối).
+"""
+import pytest
+
+import company_directory
+from company_directory import CompanyIndex
+
+# (company_code, loaihinh, mnemonic, com_manager), theo thứ tự id
+COMPANY_ROWS = [
+    ("001", "HO", "HOI SO", None),
+    ("1__", "CN", "CN 1XX", "001"),
+    ("10%", "PGD", "PGD 10X", "1__"),
+    ("Hà Nội", "CN", "HN", "001"),
+    ("ABC ", "PGD", "ABC", "001"),
+    ("50\\%", "CN", "50 PCT", None),
+    (None, "CN", "NULL CODE", None),
+    ("001", "CN", "DUPLICATE", None),
+]
+
+INDEX = CompanyIndex(COMPANY_ROWS)
+
+
+def loaihinh(value):
+    return [company.loaihinh for company in INDEX.match(value)]
+
+
+@pytest.mark.parametrize("value, expected", [
+    # Mã cố định và ký tự đại diện, theo thứ tự dòng
+    ("001", ["HO", "CN"]),
+    ("100", ["CN", "PGD"]),
+    ("10", ["PGD"]),
+    ("1000", ["PGD"]),
+    ("199", ["CN"]),
+    ("19", []),
+    # Không phân biệt hoa/thường và dấu
+    ("ha noi", ["CN"]),
+    ("HÀ NỘI", ["CN"]),
+    # LIKE không bỏ dấu cách cuối
+    ("ABC", []),
+    ("ABC ", ["PGD"]),
+    ("001 ", []),
+    # Ký tự escape: 50\% chỉ khớp "50%"
+    ("50%", ["CN"]),
+    ("500", []),
+    # Tham số NULL không khớp dòng nào
+    (None, []),
+])
+def test_match(value, expected):
+    assert loaihinh(value) == expected
+
+
+@pytest.mark.parametrize("code, mnemonic", [
+    ("001", "HOI SO"),
+    ("001 ", "HOI SO"),
+    ("ha noi", "HN"),
+    ("ABC", "ABC"),
+    ("1__", "CN 1XX"),
+    ("100", None),
+    (None, None),
+])
+def test_get(code, mnemonic):
+    company = INDEX.get(code)
+    assert (company.mnemonic if company else None) == mnemonic
+
+
+class FakeCursor:
+    """Cursor trả về lỗi khi nạp index, để thử đường đọc thẳng từ DB."""
+
+    def __init__(self):
+        self.queries = []
+
+    def execute(self, query, params=()):
+        self.queries.append((query, params))
+        if query == company_directory.COMPANY_VERSION_QUERY:
+            raise RuntimeError("database is down")
+        self.result = [COMPANY_ROWS[0]]
+
+    def fetchall(self):
+        return self.result
+
+
+@pytest.fixture
+def unloaded(monkeypatch):
+    monkeypatch.setattr(company_directory, "company_state", {
+        "index": CompanyIndex([]), "version": None, "checked_at": 0, "loaded_at": 0, "refreshing": False,
+    })
+
+
+def test_never_loaded_falls_back_to_sql(unloaded):
+    cursor = FakeCursor()
+    assert company_directory.get_mnemonic(cursor, "001") == "HOI SO"
+    assert company_directory.get_loaihinh(cursor, "001") == [("HO",)]
+    assert cursor.queries[-1] == (company_directory.COMPANY_LIKE_QUERY, ("001",))
+
+
+def test_never_loaded_without_cursor_raises(unloaded):
+    with pytest.raises(RuntimeError):
+        company_directory.get_mnemonic(None, "001")
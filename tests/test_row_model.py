@@ -0,0 +1,61 @@
+"""Row thay cho pd.Series của assignment: đọc như dict và như Series."""
+import pytest
+
+from row_model import Row, fetch_one, fetch_rows
+
+
+class FakeCursor:
+    def __init__(self, columns, records):
+        self.description = [(col,) for col in columns]
+        self.records = records
+
+    def execute(self, query, params=()):
+        pass
+
+    def fetchall(self):
+        return self.records
+
+
+COLUMNS = ["ticket_index", "id", "c_maTicket", "c_status"]
+RECORDS = [(1, "t-1", "MT001", "Inserted"), (2, "t-2", None, "Updated")]
+
+
+def test_fetch_rows_reads_by_name():
+    rows = fetch_rows(FakeCursor(COLUMNS, RECORDS), "")
+    assert [row["ticket_index"] for row in rows] == [1, 2]
+    assert rows[1]["c_maTicket"] is None
+    assert rows[0].get("missing", "") == ""
+
+
+def test_duplicate_column_keeps_first():
+    row = fetch_one(FakeCursor(["c_cif", "c_cif"], [("a", "b")]), "")
+    assert row["c_cif"] == "a"
+    assert len(row) == 1
+
+
+def test_fetch_one_empty():
+    assert fetch_one(FakeCursor(COLUMNS, []), "") is None
+
+
+def test_setitem_does_not_leak_into_other_rows():
+    first, second = fetch_rows(FakeCursor(COLUMNS, RECORDS), "")
+    first["extra"] = 1
+    first["c_status"] = "Done"
+    assert first["extra"] == 1 and "extra" not in second
+    assert second["c_status"] == "Updated"
+
+
+def test_series_compatible_access():
+    row = fetch_rows(FakeCursor(COLUMNS, RECORDS), "")[0]
+    assert row.c_maTicket == "MT001"
+    assert row.iloc[0] == 1 and row.iloc[-1] == "Inserted"
+    assert row.index == COLUMNS
+    assert not row.empty and Row({}, []).empty
+    assert row.to_dict() == dict(zip(COLUMNS, RECORDS[0]))
+
+
+def test_missing_attribute_raises():
+    row = fetch_rows(FakeCursor(COLUMNS, RECORDS), "")[0]
+    with pytest.raises(AttributeError):
+        row.missing
+    assert not hasattr(row, "_missing")
@@ -0,0 +1,72 @@
+"""
+So khớp SLA trong bộ nhớ trên bảng mẫu FIXTURE_ROWS, kết quả mong đợi tính theo ngữ nghĩa
+của SLA_QUERY trên MySQL (LIKE không phân biệt hoa/thường và dấu, NULL, PAD SPACE).
+"""
+import pytest
+
+from sla_rule_matcher import FIXTURE_ROWS, build_rule, compile_contains, match_rule, mysql_number
+
+RULES = [build_rule(row[1:]) for row in FIXTURE_ROWS]
+
+
+def find(*params):
+    rule = match_rule(RULES, *params)
+    return rule["result"] if rule else None
+
+
+@pytest.mark.parametrize("params, expected", [
+    # Khớp đầy đủ nhóm và danh mục (rank 0)
+    (("Log-Lv1-000265", "Log-Lv2-000001", "Log-Lv3-000001", "Xử lý lần 1", "Cao"), (3.0, "2", "3")),
+    # Không phân biệt hoa/thường và dấu
+    (("LOG-LV1-000265", "log-lv2-000001", "LOG-LV3-000001", "xu ly lan 1", "CAO"), (3.0, "2", "3")),
+    # Không có dòng rank 0: lấy dòng đầu tiên khớp nhờ nhóm/danh mục để trống
+    (("Log-Lv1-000265", "Log-Lv2-000009", "Log-Lv3-000009", "Xử lý lần 1", "Cao"), (5.0, "4", "5")),
+    # Tham số NULL: LIKE CONCAT('%', NULL, '%') là NULL, chỉ dòng để trống còn khớp
+    (("Log-Lv1-000265", None, None, "Xử lý lần 1", "Cao"), (5.0, "4", "5")),
+    # Cột NULL khớp tham số '' qua COALESCE; c_tgian_dong 'abc' và '' tính là 0
+    (("Log-Lv1-000265", "", "Log-Lv3-000002", "Xử lý lần 1", "Thấp"), (1.5, "1.5", "0")),
+    # Danh mục chỉ có khoảng trắng bằng '' (PAD SPACE); '3 ngày' * 1 = 3
+    (("Log-Lv1-000268", "Log-Lv2-000002", "Log-Lv3-000003", "Xử lý lần 2", "Trung bình"), (5.0, "3 ngày", "4")),
+    # Giá trị nằm trong danh sách phân cách bởi dấu chấm phẩy
+    (("Log-Lv1-000273", "Log-Lv2-000002", "Log-Lv3-000003", "Xử lý lần 3", "Cao"), (3.0, "1", "2")),
+    # '_' trong tham số là ký tự đại diện; dòng rank 0 thắng dòng rank 1 đứng trước
+    (("Log_Lv1", "", "Log-Lv3-000004", "Xử lý lần 1", "Cao"), (0.0, "0", "0")),
+    # Toàn ký tự đại diện: dòng đầu tiên
+    (("%", "_", "%", "%", "%"), (3.0, "2", "3")),
+    # Phân loại '' khớp mọi dòng, kể cả cột NULL; giữ thứ tự dòng
+    (("", "x", "y", "Xử lý lần 1", "Cao"), (5.0, "4", "5")),
+    # Loại SLA / độ ưu tiên '' khớp dòng để trống
+    (("Log-Lv1-000273", "Log-Lv2-000003", "Log-Lv3-000005", "", ""), (6.0, "6", "6")),
+])
+def test_match_rule(params, expected):
+    assert find(*params) == expected
+
+
+@pytest.mark.parametrize("params", [
+    (None, "Log-Lv2-000001", "Log-Lv3-000001", "Xử lý lần 1", "Cao"),
+    ("Log-Lv1-000265", "Log-Lv2-000001", "Log-Lv3-000001", None, "Cao"),
+    ("Log-Lv1-000265", "Log-Lv2-000001", "Log-Lv3-000001", "Xử lý lần 1", None),
+    ("Log-Lv1-999999", "", "", "Xử lý lần 1", "Cao"),
+    ("Log-Lv1-000265", "Log-Lv2-000001", "Log-Lv3-000001", "Xử lý lần 9", "Cao"),
+])
+def test_no_match(params):
+    assert find(*params) is None
+
+
+def test_escaped_wildcard_is_literal():
+    matcher = compile_contains("a\\%b")
+    assert matcher("xa%by")
+    assert not matcher("xazzby")
+
+
+def test_trailing_space_in_parameter_is_significant():
+    # LIKE so từng ký tự, không bỏ khoảng trắng cuối như phép '='
+    assert compile_contains("cao ")("cao thấp")
+    assert not compile_contains("cao ")("cao")
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None), ("3 ngày", 3.0), ("abc", 0.0), ("", 0.0), (" 1.5x", 1.5), ("-2e1", -20.0), (4, 4.0),
+])
+def test_mysql_number(value, expected):
+    assert mysql_number(value) == expected
@@ -5,19 +5,42 @@ import uuid
 from datetime import datetime
 from configparser import ConfigParser
 import mysql.connector
-import pandas as pd
 import json
+import html
 import time
-import fcntl
+import traceback
+import socket
+import signal
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, wait
+from row_model import fetch_rows
 import pika
 from SLA.get_list_email import get_list_email
+from level_dictionary import get_level_name
+from company_directory import get_loaihinh, invalidate_companies
+from sla_rule_matcher import find_sla
+from action_routing import ROUTE_TTL, expiring_route_keys, get_action_route, invalidate_action_routes, warm_action_routes
 from SLA.handle_luong_xuly import handle_automatic_ticket, handle_manual_ticket
 from SLA.sla import update_followup_processing, update_sla_manual
 from SLA.handle_luong_ho_auto import handle_ho_auto
 
-LOCK_FILE = "/tmp/create_luong_ticket.lockfile"
-LOCK_TIMEOUT = 600  # Timeout 10 minutes
-SLEEP_INTERVAL = 5  # Sleep interval between each check in seconds
+LEASE_BUCKETS = 16  # ticket_id is hashed into this many buckets; must match on every node
+LEASE_TTL = 30  # Seconds a bucket lease stays valid without a heartbeat
+LEASE_HEARTBEAT = 10  # Seconds between lease renewals
+NODE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+SLEEP_INTERVAL = 5  # Wait before retrying after an error
+SAFETY_POLL_INTERVAL = 60  # Claim even without a wake-up signal, as a safety net
+OUTBOX_PROBE_INTERVAL = 20  # Seconds between MAX(id) probes of outbox_sp_tickets (0 disables)
+BATCH_SIZE = 50  # Number of outbox rows claimed per cycle
+CLAIM_TIMEOUT = 900  # Seconds after which a row still '-Claimed' is returned to the queue
+CLAIM_RETRY_BASE = 30  # Backoff after the first failed attempt, doubled per attempt
+CLAIM_RETRY_MAX = 3600  # Upper bound of the retry backoff
+WORKER_THREADS = 4  # Number of tickets processed in parallel
+PUBLISH_BATCH_SIZE = 100  # Messages the publisher thread takes from its queue per round
+PUBLISH_QUEUE_SIZE = 10000  # Messages waiting for the publisher thread
+PUBLISH_CONFIRM_TIMEOUT = 30  # Seconds to wait for broker confirms before marking a row Done
+LEVEL_COLUMNS = {"c_PhanLoai": "L1", "c_NhomYeuCau": "L2", "c_DanhMucYeuCau": "L3", "c_ChiTietYeuCau": "L4"}
 
 
 # Load config
@@ -39,19 +62,177 @@ def read_config(config_path):
         # Bắt các lỗi không xác định khác
         logging.error(f"Error: {e}")
 
+class PooledConnection:
+    """Connection borrowed from a ConnectionPool; close() returns it to the pool."""
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+
+    def close(self):
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._pool.release(self, raw)
+
+    def __getattr__(self, name):
+        raw = self.__dict__.get("_raw")
+        if raw is None:
+            raise mysql.connector.InterfaceError("Connection already returned to pool")
+        return getattr(raw, name)
+
+    def __del__(self):
+        # Kết nối bị quên close(): trả lại pool và ghi log để tìm chỗ rò rỉ
+        raw = self.__dict__.get("_raw")
+        if raw is not None:
+            self._raw = None
+            self._pool.release(self, raw, leaked=True)
+
+
+class ConnectionPool:
+    """Thread-safe pool of mysql.connector connections for one config section."""
+
+    def __init__(self, name, db_config, size, max_lifetime, idle_ping, wait_timeout, leak_timeout):
+        self.name = name
+        self.db_config = db_config
+        self.size = size
+        self.max_lifetime = max_lifetime
+        self.idle_ping = idle_ping
+        self.wait_timeout = wait_timeout
+        self.leak_timeout = leak_timeout
+        self.idle = []  # [(raw, created_at, idle_since)]
+        self.borrowed = {}  # id(proxy) -> (created_at, borrowed_at, stack, reported)
+        self.created = {}  # id(raw) -> created_at
+        self.total = 0
+        self.condition = threading.Condition(threading.RLock())
+
+    def _connect(self):
+        return mysql.connector.connect(
+            host=self.db_config["host"],
+            user=self.db_config["user"],
+            password=self.db_config["password"],
+            database=self.db_config["database"],
+        )
+
+    def _discard(self, raw):
+        self.created.pop(id(raw), None)
+        self.total -= 1
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def _healthy(self, raw, created_at, idle_since):
+        now = time.time()
+        if now - created_at > self.max_lifetime:
+            return False
+        if now - idle_since > self.idle_ping:
+            try:
+                raw.ping(reconnect=False)
+            except Exception:
+                return False
+        return True
+
+    def acquire(self):
+        deadline = time.time() + self.wait_timeout
+        with self.condition:
+            while True:
+                while self.idle:
+                    raw, created_at, idle_since = self.idle.pop()
+                    if self._healthy(raw, created_at, idle_since):
+                        return self._lend(raw)
+                    self._discard(raw)
+                if self.total < self.size:
+                    self.total += 1
+                    break
+                self.check_leaks()
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logging.error(f"Pool {self.name}: no free connection after {self.wait_timeout}s")
+                    return None
+                self.condition.wait(remaining)
+        # Mở kết nối mới ngoài lock để không chặn các luồng khác
+        try:
+            raw = self._connect()
+        except mysql.connector.Error:
+            with self.condition:
+                self.total -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.created[id(raw)] = time.time()
+            return self._lend(raw)
+
+    def _lend(self, raw):
+        proxy = PooledConnection(self, raw)
+        self.borrowed[id(proxy)] = [
+            self.created.get(id(raw), time.time()),
+            time.time(),
+            "".join(traceback.format_stack(limit=6)[:-2]),
+            False,
+        ]
+        return proxy
+
+    def release(self, proxy, raw, leaked=False):
+        with self.condition:
+            info = self.borrowed.pop(id(proxy), None)
+            if leaked and info is not None:
+                logging.warning(f"Pool {self.name}: connection was never closed, borrowed at:\n{info[2]}")
+            created_at = info[0] if info else time.time()
+            try:
+                # Bỏ transaction dở dang trước khi cho mượn lại
+                raw.rollback()
+                self.idle.append((raw, created_at, time.time()))
+            except Exception:
+                self._discard(raw)
+            self.condition.notify()
+
+    def check_leaks(self):
+        now = time.time()
+        with self.condition:
+            for info in self.borrowed.values():
+                if not info[3] and now - info[1] > self.leak_timeout:
+                    info[3] = True
+                    logging.warning(
+                        f"Pool {self.name}: connection held for {int(now - info[1])}s, borrowed at:\n{info[2]}"
+                    )
+
+    def stats(self):
+        with self.condition:
+            return {"size": self.size, "open": self.total, "idle": len(self.idle), "borrowed": len(self.borrowed)}
+
+
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(read=True):
+    db_config = "mysql_slave" if read else "mysql_master"
+    pool = connection_pools.get(db_config)
+    if pool is not None:
+        return pool
+    with connection_pools_lock:
+        pool = connection_pools.get(db_config)
+        if pool is None:
+            config = read_config(
+                os.path.join(os.path.dirname(__file__), "common_config", "config.ini")
+            )
+            pool_config = config["pool"] if config.has_section("pool") else {}
+            pool = ConnectionPool(
+                db_config,
+                dict(config[db_config]),
+                size=int(pool_config.get("size", WORKER_THREADS * 3)),
+                max_lifetime=int(pool_config.get("max_lifetime", 1800)),
+                idle_ping=int(pool_config.get("idle_ping", 30)),
+                wait_timeout=int(pool_config.get("wait_timeout", 30)),
+                leak_timeout=int(pool_config.get("leak_timeout", 300)),
+            )
+            connection_pools[db_config] = pool
+    return pool
+
+
 def connect_to_database(read=True):
     try:
-        config = read_config(
-            os.path.join(os.path.dirname(__file__), "common_config", "config.ini")
-        )
-        db_config = "mysql_slave" if read else "mysql_master"
-        connection = mysql.connector.connect(
-            host=config[db_config]["host"],
-            user=config[db_config]["user"],
-            password=config[db_config]["password"],
-            database=config[db_config]["database"],
-        )
-        return connection
+        return get_connection_pool(read).acquire()
     except mysql.connector.Error as err:
         logging.error(f"Error connecting to database: {err}")
         return None
@@ -91,163 +272,119 @@ def setup_logging():
         logging.error(f"Error: {e}")
 
 # Hàm thiết lập RabbitMQ
+def create_rabbitmq_parameters(config):
+    rabbitmq_config = config["rabbitmq"]
+    credentials = pika.PlainCredentials(
+        rabbitmq_config["username"], rabbitmq_config["password"]
+    )
+    return pika.ConnectionParameters(
+        host=rabbitmq_config["host"],
+        port=int(rabbitmq_config["port"]),
+        virtual_host=rabbitmq_config.get("vhost", "/"),
+        credentials=credentials,
+        connection_attempts=3,
+        retry_delay=5,
+        socket_timeout=10,
+        heartbeat=60,
+    )
+
+
 def setup_rabbitmq_connection(config):
     try:
-        rabbitmq_config = config["rabbitmq"]
-        credentials = pika.PlainCredentials(
-            rabbitmq_config["username"], rabbitmq_config["password"]
-        )
-        parameters = pika.ConnectionParameters(
-            host=rabbitmq_config["host"],
-            port=int(rabbitmq_config["port"]),
-            virtual_host=rabbitmq_config.get("vhost", "/"),
-            credentials=credentials,
-            connection_attempts=3,
-            retry_delay=5,
-            socket_timeout=10,
-            heartbeat=60,
-        )
+        parameters = create_rabbitmq_parameters(config)
         connection = pika.BlockingConnection(parameters)
         channel = connection.channel()
-        # Khai báo queue 'Test' nếu chưa tồn tại
-        channel.queue_declare(queue="Ticket_API")
-        channel.queue_declare(queue="Ticket_Mail")
+        # Khai báo queue nếu chưa tồn tại; durable phải khớp với queue đã có trên broker
+        durable = config["rabbitmq"].getboolean("durable_queues", fallback=False)
+        channel.queue_declare(queue="Ticket_API", durable=durable)
+        channel.queue_declare(queue="Ticket_Mail", durable=durable)
         logging.info("RabbitMQ connection and channel setup completed successfully.")
         return connection, channel
     except pika.exceptions.AMQPError as err:
         logging.error(f"Error setting up RabbitMQ connection: {err}")
         return None, None
 
-import pandas as pd
-
-def get_ticket(ticket_id):
-    conn = connect_to_database(read=True)
-    query = """
-    SELECT * FROM jwdb.outbox_sp_tickets
-    WHERE id = %s
-    ORDER BY dateModified ASC LIMIT 1
-    """
 
-    try:
-        df = pd.read_sql(query, conn, params=(ticket_id,))  # Truyền ticket_id vào query
-    finally:
-        conn.close()  # Đóng kết nối dù có lỗi hay không
+table_layouts = {}
+table_layouts_lock = threading.Lock()
+
+
+def get_table_columns(cursor, table):
+    """Danh sách cột của bảng, đọc một lần bằng SELECT ... LIMIT 0 rồi cache."""
+    columns = table_layouts.get(table)
+    if columns is None:
+        cursor.execute(f"SELECT * FROM {table} LIMIT 0")
+        columns = [col[0] for col in cursor.description]
+        cursor.fetchall()
+        with table_layouts_lock:
+            table_layouts[table] = columns
+    return columns
+
+
+# Cột nguồn (app_fd_sp_tickets) -> cột đích trong app_fd_sp_tickets_data, "uuid" là id mới
+TICKET_DATA_COLUMNS = [
+    ("uuid", "id"),
+    ("c_trangThai", "c_trangThai"),
+    ("modifiedByName", "modifiedByName"),
+    ("dateModified", "dateModified"),
+    ("c_huongxl", "c_huongxl"),
+    ("c_content", "c_content"),
+    ("c_handle_time", "c_handle_time"),
+    ("c_ngayDenHenYeuCau", "c_ngayDenHenYeuCau"),
+    ("c_trangThaiPHKH", "c_trangThaiPHKH"),
+    ("c_fileUpload", "c_fileUpload"),
+    ("c_pheDuyet", "c_pheDuyet"),
+    ("c_user_pheDuyet", "c_user_pheDuyet"),
+    ("c_mail_to", "c_to"),
+    ("c_mail_from", "c_from"),
+    ("c_fileUpload_xl", "c_fileUpload_xl"),
+    ("id", "c_fkTicket"),
+    ("c_messageId", "c_messageId"),
+]
+
+
+def copy_ticket_to_report(cursor, ticket_index):
+    """Sao chép dòng outbox_sp_tickets sang outbox_sp_ticket_report ngay trên server."""
+    report_columns = set(get_table_columns(cursor, "outbox_sp_ticket_report"))
+    columns = ", ".join(col for col in get_table_columns(cursor, "jwdb.outbox_sp_tickets") if col in report_columns)
+    cursor.execute(
+        f"""
+        INSERT INTO outbox_sp_ticket_report ({columns})
+        SELECT {columns} FROM jwdb.outbox_sp_tickets
+        WHERE id = %s
+        """,
+        (ticket_index,),
+    )
+    return cursor.rowcount
 
-    return df
 
-def get_ticket_data_from(ticket_id):
-    conn = connect_to_database(read=True)
-    query = """
-    SELECT * FROM jwdb.app_fd_sp_tickets_data
-    WHERE c_fkTicket = %s
-    ORDER BY dateModified ASC LIMIT 1
+def copy_ticket_data(cursor, ma_ticket, only_if_missing=False):
     """
-
-    try:
-        df = pd.read_sql(query, conn, params=(ticket_id,))  # Truyền ticket_id vào query
-    finally:
-        conn.close()  # Đóng kết nối dù có lỗi hay không
-
-    if df.empty:
-        return None
-    return df
-
-def get_ticket_data(ticket_id):
-    conn = connect_to_database(read=True)
-    query = """
-    SELECT * FROM jwdb.app_fd_sp_tickets
-    WHERE c_MaTicket = %s
-    ORDER BY dateModified ASC LIMIT 1
+    Ghi lịch sử app_fd_sp_tickets -> app_fd_sp_tickets_data bằng INSERT ... SELECT.
+    only_if_missing: chỉ ghi khi ticket chưa có dòng lịch sử nào (ticket mới).
     """
-
-    try:
-        df = pd.read_sql(query, conn, params=(ticket_id,))  # Truyền ticket_id vào query
-    finally:
-        conn.close()  # Đóng kết nối dù có lỗi hay không
-
-    return df
-
-
-def insert_ticket(df):
-    try:
-        conn = connect_to_database(read=False)
-        cursor = conn.cursor()
-
-        for _, row in df.iterrows():
-            placeholders = ', '.join(['%s'] * len(row))
-            columns = ', '.join(row.index)
-            sql = f"INSERT INTO outbox_sp_ticket_report ({columns}) VALUES ({placeholders})"
-            cursor.execute(sql, tuple(row))
-
-        conn.commit()  # Quan trọng: lưu thay đổi vào database
-
-    except Exception as e:
-        logging.error(f"Error: {e}")
-   
-    finally:
-        cursor.close()
-        conn.close()  # Dùng close() thay vì dispose()
-    
-
-def insert_ticket_data(df):
-    try:
-        df["uuid"] = [str(uuid.uuid4()) for _ in range(len(df))]
-        selected_columns = [
-            "uuid",
-            "c_trangThai",
-            "modifiedByName",
-            "dateModified",
-            "c_huongxl",
-            "c_content",
-            "c_handle_time",
-            "c_ngayDenHenYeuCau",
-            "c_trangThaiPHKH",
-            "c_fileUpload",
-            "c_pheDuyet",
-            "c_user_pheDuyet",
-            "c_mail_to",
-            "c_mail_from",
-            "c_fileUpload_xl",
-            "id",
-            "c_messageId"
-        ]
-
-        df_select = df[selected_columns]
-        conn = connect_to_database(read=False)
-        cursor = conn.cursor()
-
-        # for _, row in df.iterrows():
-        #     placeholders = ', '.join(['%s'] * len(row))
-        #     columns = ', '.join(row.index)
-        #     sql = f"INSERT INTO jwdb.app_fd_sp_tickets_data ({columns}) VALUES ({placeholders})"
-        #     cursor.execute(sql, tuple(row))
-
-        placeholders = ', '.join(['%s'] * len(df_select.columns))
-        columns = 'id, c_trangThai, modifiedByName, dateModified, c_huongxl, c_content, c_handle_time, ' \
-                'c_ngayDenHenYeuCau, c_trangThaiPHKH, c_fileUpload, c_pheDuyet, c_user_pheDuyet, ' \
-                'c_to, c_from, c_fileUpload_xl, c_fkTicket , c_messageId'
-
-        sql = f"INSERT INTO jwdb.app_fd_sp_tickets_data ({columns}) VALUES ({placeholders})"
-        data = [tuple(row) for row in df_select.to_numpy()]
-
-        cursor.executemany(sql, data)
-        conn.commit()  # Quan trọng: lưu thay đổi vào database
-
-    except Exception as e:
-        logging.error(f"Error: {e}")
-
-    finally:
-        cursor.close()
-        conn.close()  # Dùng close() thay vì dispose()
+    source_columns = ", ".join(f"t.{source}" for source, _ in TICKET_DATA_COLUMNS[1:])
+    target_columns = ", ".join(target for _, target in TICKET_DATA_COLUMNS)
+    query = f"""
+        INSERT INTO jwdb.app_fd_sp_tickets_data ({target_columns})
+        SELECT %s, {source_columns}
+        FROM (
+            SELECT * FROM jwdb.app_fd_sp_tickets
+            WHERE c_MaTicket = %s
+            ORDER BY dateModified ASC LIMIT 1
+        ) t
+        """
+    if only_if_missing:
+        query += """
+        WHERE NOT EXISTS (
+            SELECT 1 FROM jwdb.app_fd_sp_tickets_data d WHERE d.c_fkTicket = t.id
+        )
+        """
+    cursor.execute(query, (str(uuid.uuid4()), ma_ticket))
+    return cursor.rowcount
 
 
-# Get outbox_sp_tickets
-def fetch_assignments():
-    try:
-        conn = connect_to_database(read=True)
-        if conn is None:
-            return pd.DataFrame()
-        query = """
+ASSIGNMENT_SELECT = """
         SELECT
         id as ticket_index,
         ticket_id as id,
@@ -299,77 +436,443 @@ def fetch_assignments():
         c_trangThai
         -- ,c_companyCode,c_tenDn,c_noidung_denghi,c_Phone,c_thoigian_hoiketqua,dateCreated,c_ChiTietYeuCau,c_cif,c_content,c_DanhMucYeuCau,c_date_change_time,c_DonViGan,c_donViXuLy,c_fileUpload,c_handle_time,c_huongxl,c_individual,c_maTicket,c_nd_pheDuyet,c_ngayDenHenYeuCau,c_NhomYeuCau,c_pakh_time,c_PhanLoai,c_pheDuyet,c_phongBanXyLy,c_sla_dvxl,c_sla_phanHoiKH,c_source,c_time_xl,c_trangThai,c_trangThaiPHKH,c_user_pheDuyet
         FROM jwdb.outbox_sp_tickets
+"""
+ASSIGNMENT_PENDING = """
     WHERE c_status in ('Inserted','Updated') and coalesce(c_field2,'')<>'1' and coalesce(c_PhanLoai,'')<>'' and c_trangThai <> 'Đóng' and modifiedBy not in ('AI Nhỡ', 'AI BlockCard', 'AI Resetpass')
+"""
+# Giữ thứ tự theo ticket: bỏ qua dòng khi chính nó hoặc một dòng cũ hơn của cùng ticket_id đang chờ
+# retry_at (backoff sau lỗi) hoặc vẫn '-Claimed' (bảng: sql/outbox_claims.sql)
+CLAIM_BACKOFF = """
+    AND NOT EXISTS (
+        SELECT 1 FROM jwdb.outbox_sp_tickets b
+        LEFT JOIN jwdb.outbox_claims c ON c.outbox_id = b.id
+        WHERE b.ticket_id = jwdb.outbox_sp_tickets.ticket_id
+        AND b.dateModified <= jwdb.outbox_sp_tickets.dateModified
+        AND (b.c_status IN ('Inserted-Claimed', 'Updated-Claimed') OR c.retry_at > NOW(3))
+    )
+"""
+
+
+# Get outbox_sp_tickets
+def fetch_assignments():
+    try:
+        conn = connect_to_database(read=True)
+        if conn is None:
+            return []
+        query = ASSIGNMENT_SELECT + ASSIGNMENT_PENDING + """
         ORDER BY dateModified ASC LIMIT 1
         """
-        assignments = pd.read_sql(query, conn)
+        cursor = conn.cursor()
+        assignments = fetch_rows(cursor, query)
+        cursor.close()
         conn.close()
         return assignments
     except mysql.connector.Error as err:
         logging.error(f"Error fetching assignments: {err}")
-        return pd.DataFrame()
+        return []
+
+
+def bucket_filter(buckets):
+    # Điều kiện lọc các dòng outbox thuộc những bucket node này đang giữ lease
+    placeholders = ", ".join(["%s"] * len(buckets))
+    return f" AND MOD(CRC32(ticket_id), {LEASE_BUCKETS}) IN ({placeholders})", [int(bucket) for bucket in buckets]
+
+
+def claim_assignments(limit, buckets=None):
+    """
+    Claim up to `limit` pending outbox rows on the master, oldest first, restricted to `buckets` when given.
+    Rows locked by another transaction are skipped; claimed rows get the '-Claimed' suffix on c_status
+    so no other cycle picks them up, and update_assignment_status turns it into '-Done'.
+    The claim (owner, time, attempt count) is recorded in outbox_claims; rows in retry backoff are skipped.
+    """
+    conn = connect_to_database(read=False)
+    if conn is None:
+        return []
+    try:
+        conn.start_transaction()
+        condition, params = bucket_filter(buckets) if buckets is not None else ("", [])
+        query = ASSIGNMENT_SELECT + ASSIGNMENT_PENDING + CLAIM_BACKOFF + condition + """
+        ORDER BY dateModified ASC LIMIT %s
+        FOR UPDATE SKIP LOCKED
+        """
+        cursor = conn.cursor()
+        assignments = fetch_rows(cursor, query, params + [limit])
+        if assignments:
+            ids = [int(assignment["ticket_index"]) for assignment in assignments]
+            placeholders = ", ".join(["%s"] * len(ids))
+            cursor.execute(
+                f"UPDATE jwdb.outbox_sp_tickets SET c_status = CONCAT(c_status, '-Claimed') WHERE id IN ({placeholders})",
+                ids)
+            values = ", ".join(["(%s, %s, NOW(3), 1)"] * len(ids))
+            cursor.execute(f"""
+                INSERT INTO jwdb.outbox_claims (outbox_id, owner, claimed_at, attempts)
+                VALUES {values}
+                ON DUPLICATE KEY UPDATE
+                    owner = VALUES(owner), claimed_at = VALUES(claimed_at), attempts = attempts + 1, retry_at = NULL
+                """, [value for ticket_index in ids for value in (ticket_index, NODE_ID)])
+        cursor.close()
+        conn.commit()
+        return assignments
+    except mysql.connector.Error as err:
+        conn.rollback()
+        logging.error(f"Error claiming assignments: {err}")
+        return []
+    finally:
+        conn.close()
+
+
+def release_claimed_assignments(buckets=None):
+    """
+    Return rows left in '-Claimed' by the previous owner of `buckets` (lease expired) to the pending state.
+    Rows the previous owner is finishing right now are locked by its fence (lock_claim) and skipped.
+    The claim owner of the released rows is cleared, so a slow node that reaches its fence later
+    drops the row instead of sending its messages a second time.
+    """
+    conn = connect_to_database(read=False)
+    if conn is None:
+        return
+    try:
+        condition, params = bucket_filter(buckets) if buckets is not None else ("", [])
+        conn.start_transaction()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT o.id FROM jwdb.outbox_sp_tickets o
+            LEFT JOIN jwdb.outbox_claims c ON c.outbox_id = o.id
+            WHERE o.c_status IN ('Inserted-Claimed', 'Updated-Claimed')
+            """ + condition + " FOR UPDATE SKIP LOCKED", params)
+        ids = [row[0] for row in cursor.fetchall()]
+        if ids:
+            placeholders = ", ".join(["%s"] * len(ids))
+            cursor.execute(f"""
+                UPDATE jwdb.outbox_sp_tickets SET c_status = REPLACE(c_status, '-Claimed', '')
+                WHERE id IN ({placeholders})
+                """, ids)
+            cursor.execute(
+                f"UPDATE jwdb.outbox_claims SET owner = NULL WHERE outbox_id IN ({placeholders})", ids)
+            logging.info(f"Released {len(ids)} claimed assignments: {ids}")
+        conn.commit()
+        cursor.close()
+    except mysql.connector.Error as err:
+        conn.rollback()
+        logging.error(f"Error releasing claimed assignments: {err}")
+    finally:
+        conn.close()
+
+
+# Khóa dòng outbox và claim của nó tới khi commit; trả về owner của claim và bucket của dòng
+CLAIM_FENCE = f"""
+    SELECT c.owner, MOD(CRC32(o.ticket_id), {LEASE_BUCKETS})
+    FROM jwdb.outbox_sp_tickets o
+    JOIN jwdb.outbox_claims c ON c.outbox_id = o.id
+    WHERE o.id = %s AND o.c_status IN ('Inserted-Claimed', 'Updated-Claimed')
+    FOR UPDATE
+"""
+
+
+def lock_claim(cursor, ticket_index):
+    """
+    Fence trước khi gửi message và đánh dấu Done: khóa dòng (giữ tới commit) và kiểm tra node này
+    vẫn giữ claim và lease của bucket. Trong lúc khóa, takeover (SKIP LOCKED) không trả dòng về
+    hàng chờ; nếu takeover đã chạy trước thì owner đã bị xóa và hàm trả về False.
+    """
+    cursor.execute(CLAIM_FENCE, (ticket_index,))
+    row = cursor.fetchone()
+    if row is None or row[0] != NODE_ID:
+        return False
+    return int(row[1]) in owned_buckets()
+
+
+def fail_claim(ticket_index, error):
+    """
+    Xử lý một dòng bị lỗi: trả dòng về hàng chờ và lùi lần thử tiếp theo
+    CLAIM_RETRY_BASE * 2^(attempts - 1) giây (tối đa CLAIM_RETRY_MAX). Chỉ áp dụng khi node này
+    vẫn đang giữ claim của dòng.
+    """
+    conn = connect_to_database(read=False)
+    if conn is None:
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE jwdb.outbox_sp_tickets o
+            JOIN jwdb.outbox_claims c ON c.outbox_id = o.id AND c.owner = %s
+            SET o.c_status = REPLACE(o.c_status, '-Claimed', ''),
+                c.owner = NULL,
+                c.retry_at = NOW(3) + INTERVAL LEAST(%s * POW(2, c.attempts - 1), %s) SECOND,
+                c.last_error = LEFT(%s, 1000)
+            WHERE o.id = %s AND o.c_status IN ('Inserted-Claimed', 'Updated-Claimed')
+            """, (NODE_ID, CLAIM_RETRY_BASE, CLAIM_RETRY_MAX, str(error), ticket_index))
+        cursor.execute("SELECT attempts, retry_at FROM jwdb.outbox_claims WHERE outbox_id = %s", (ticket_index,))
+        row = cursor.fetchone()
+        conn.commit()
+        cursor.close()
+        if row:
+            logging.error(f"Assignment {ticket_index} failed (attempt {row[0]}), retry at {row[1]}: {error}")
+    except mysql.connector.Error as err:
+        logging.error(f"Error releasing failed assignment {ticket_index}: {err}")
+    finally:
+        conn.close()
+
+
+def release_claims(ticket_indexes):
+    """
+    Trả về hàng chờ các dòng node này đã claim nhưng chưa xử lý (không tính là một lần thử lỗi).
+    Dùng khi một dòng cũ hơn của cùng ticket bị lỗi: CLAIM_BACKOFF giữ các dòng này lại
+    cho tới khi dòng lỗi được xử lý xong.
+    """
+    if not ticket_indexes:
+        return
+    conn = connect_to_database(read=False)
+    if conn is None:
+        return
+    try:
+        placeholders = ", ".join(["%s"] * len(ticket_indexes))
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            UPDATE jwdb.outbox_sp_tickets o
+            JOIN jwdb.outbox_claims c ON c.outbox_id = o.id AND c.owner = %s
+            SET o.c_status = REPLACE(o.c_status, '-Claimed', ''),
+                c.owner = NULL,
+                c.attempts = GREATEST(c.attempts - 1, 0)
+            WHERE o.id IN ({placeholders}) AND o.c_status IN ('Inserted-Claimed', 'Updated-Claimed')
+            """, [NODE_ID] + list(ticket_indexes))
+        conn.commit()
+        cursor.close()
+        logging.info(f"Released assignments {list(ticket_indexes)} behind a failed row of the same ticket")
+    except mysql.connector.Error as err:
+        logging.error(f"Error releasing assignments {list(ticket_indexes)}: {err}")
+    finally:
+        conn.close()
+
+
+def reclaim_stale_claims(buckets=None):
+    """
+    Trả về hàng chờ các dòng đã '-Claimed' quá CLAIM_TIMEOUT giây (thread treo, lỗi không bắt được)
+    hoặc không có claim trong outbox_claims (claim từ phiên bản cũ), có tính như một lần thử lỗi.
+    """
+    conn = connect_to_database(read=False)
+    if conn is None:
+        return
+    try:
+        condition, params = bucket_filter(buckets) if buckets is not None else ("", [])
+        conn.start_transaction()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id FROM jwdb.outbox_sp_tickets
+            WHERE c_status IN ('Inserted-Claimed', 'Updated-Claimed')
+            AND NOT EXISTS (
+                SELECT 1 FROM jwdb.outbox_claims c
+                WHERE c.outbox_id = jwdb.outbox_sp_tickets.id AND c.claimed_at >= NOW(3) - INTERVAL %s SECOND
+            )
+            """ + condition + " FOR UPDATE SKIP LOCKED", [CLAIM_TIMEOUT] + params)
+        ids = [row[0] for row in cursor.fetchall()]
+        if ids:
+            placeholders = ", ".join(["%s"] * len(ids))
+            cursor.execute(f"""
+                UPDATE jwdb.outbox_sp_tickets SET c_status = REPLACE(c_status, '-Claimed', '')
+                WHERE id IN ({placeholders})
+                """, ids)
+            cursor.execute(f"""
+                UPDATE jwdb.outbox_claims
+                SET owner = NULL,
+                    retry_at = NOW(3) + INTERVAL LEAST(%s * POW(2, attempts - 1), %s) SECOND,
+                    last_error = 'claim timed out'
+                WHERE outbox_id IN ({placeholders})
+                """, [CLAIM_RETRY_BASE, CLAIM_RETRY_MAX] + ids)
+            logging.error(f"Reclaimed {len(ids)} assignments claimed for more than {CLAIM_TIMEOUT}s: {ids}")
+        conn.commit()
+        cursor.close()
+    except mysql.connector.Error as err:
+        conn.rollback()
+        logging.error(f"Error reclaiming stale assignments: {err}")
+    finally:
+        conn.close()
+
+
+# Bảng do DBA tạo trước (sql/worker_leases.sql, sql/outbox_claims.sql), worker không chạy DDL
+WORKER_TABLES = {
+    "jwdb.worker_leases": "sql/worker_leases.sql",
+    "jwdb.worker_nodes": "sql/worker_leases.sql",
+    "jwdb.outbox_claims": "sql/outbox_claims.sql",
+}
+
+lease_state = {"buckets": frozenset(), "valid_until": 0.0}
+lease_lock = threading.Lock()
+
+
+def check_worker_tables():
+    """Kiểm tra các bảng lease/claim đã có và thêm các dòng bucket còn thiếu."""
+    conn = connect_to_database(read=False)
+    if conn is None:
+        raise RuntimeError("Cannot connect to database to check worker lease tables")
+    try:
+        cursor = conn.cursor()
+        for table, script in WORKER_TABLES.items():
+            try:
+                cursor.execute(f"SELECT 1 FROM {table} LIMIT 0")
+                cursor.fetchall()
+            except mysql.connector.Error as err:
+                raise RuntimeError(f"Table {table} is not available, run {script} first: {err}")
+        cursor.executemany(
+            "INSERT IGNORE INTO jwdb.worker_leases (bucket) VALUES (%s)",
+            [(bucket,) for bucket in range(LEASE_BUCKETS)],
+        )
+        conn.commit()
+        cursor.close()
+    finally:
+        conn.close()
+
+
+def maintain_leases(rebalance=False):
+    """
+    Gia hạn lease của node, nhận thêm bucket trống/hết hạn cho đủ phần chia đều
+    ceil(LEASE_BUCKETS / số node đang sống); khi rebalance=True thì trả bớt phần dư.
+    Chỉ gọi với rebalance=True giữa hai batch, lúc node không còn dòng nào đang xử lý.
+    """
+    with lease_lock:
+        conn = connect_to_database(read=False)
+        if conn is None:
+            return lease_state["buckets"]
+        try:
+            started = time.monotonic()
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO jwdb.worker_nodes (node_id, expires_at, started_at)
+                VALUES (%s, NOW(3) + INTERVAL %s SECOND, NOW(3))
+                ON DUPLICATE KEY UPDATE expires_at = VALUES(expires_at)
+                """, (NODE_ID, LEASE_TTL))
+            cursor.execute("""
+                UPDATE jwdb.worker_leases
+                SET expires_at = NOW(3) + INTERVAL %s SECOND, heartbeat_at = NOW(3)
+                WHERE owner = %s
+                """, (LEASE_TTL, NODE_ID))
+            # Dọn các node đã chết (hết hạn quá LEASE_TTL giây)
+            cursor.execute(
+                "DELETE FROM jwdb.worker_nodes WHERE expires_at < NOW(3) - INTERVAL %s SECOND", (LEASE_TTL,))
+            cursor.execute("SELECT COUNT(*) FROM jwdb.worker_nodes WHERE expires_at > NOW(3)")
+            nodes = max(cursor.fetchall()[0][0], 1)
+            target = -(-LEASE_BUCKETS // nodes)
+            cursor.execute("SELECT bucket FROM jwdb.worker_leases WHERE owner = %s", (NODE_ID,))
+            owned = {row[0] for row in cursor.fetchall()}
+            conn.commit()
+
+            acquired = []
+            if len(owned) < target:
+                conn.start_transaction()
+                cursor.execute("""
+                    SELECT bucket FROM jwdb.worker_leases
+                    WHERE owner IS NULL OR expires_at < NOW(3)
+                    ORDER BY bucket LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                    """, (target - len(owned),))
+                acquired = [row[0] for row in cursor.fetchall()]
+                if acquired:
+                    placeholders = ", ".join(["%s"] * len(acquired))
+                    cursor.execute(f"""
+                        UPDATE jwdb.worker_leases
+                        SET owner = %s, expires_at = NOW(3) + INTERVAL %s SECOND, heartbeat_at = NOW(3)
+                        WHERE bucket IN ({placeholders})
+                        """, [NODE_ID, LEASE_TTL] + acquired)
+                conn.commit()
+            elif rebalance and len(owned) > target:
+                released = sorted(owned)[target:]
+                placeholders = ", ".join(["%s"] * len(released))
+                cursor.execute(f"""
+                    UPDATE jwdb.worker_leases SET owner = NULL, expires_at = NULL
+                    WHERE owner = %s AND bucket IN ({placeholders})
+                    """, [NODE_ID] + released)
+                conn.commit()
+                owned -= set(released)
+                logging.info(f"Released buckets {released} ({nodes} nodes, target {target})")
+            cursor.close()
+
+            if acquired:
+                # Bucket nhận lại từ node đã chết: trả các dòng nó đang claim dở về hàng chờ
+                release_claimed_assignments(acquired)
+                owned |= set(acquired)
+                logging.info(f"Acquired buckets {acquired} ({nodes} nodes, target {target})")
+                outbox_wakeup.set()
+
+            lease_state["buckets"] = frozenset(owned)
+            lease_state["valid_until"] = started + LEASE_TTL - LEASE_HEARTBEAT
+        except mysql.connector.Error as err:
+            logging.error(f"Error maintaining worker leases: {err}")
+        finally:
+            conn.close()
+        return lease_state["buckets"]
+
+
+def owned_buckets():
+    # Lease không gia hạn kịp thì coi như đã mất, không claim thêm
+    if time.monotonic() > lease_state["valid_until"]:
+        return frozenset()
+    return lease_state["buckets"]
+
+
+def lease_heartbeat_loop():
+    while True:
+        time.sleep(LEASE_HEARTBEAT)
+        maintain_leases()
+
+
+def release_leases():
+    conn = connect_to_database(read=False)
+    if conn is None:
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE jwdb.worker_leases SET owner = NULL, expires_at = NULL WHERE owner = %s", (NODE_ID,))
+        cursor.execute("DELETE FROM jwdb.worker_nodes WHERE node_id = %s", (NODE_ID,))
+        conn.commit()
+        cursor.close()
+        lease_state["buckets"] = frozenset()
+        logging.info(f"Released worker leases of {NODE_ID}")
+    except mysql.connector.Error as err:
+        logging.error(f"Error releasing worker leases: {err}")
+    finally:
+        conn.close()
+
 
 def get_don_vi_gan(cursor, don_vi_gan):
     try:
         don_vi_gan = don_vi_gan.split()[0]
-        query = """
-        SELECT loaihinh
-        FROM jwdb.app_fd_etl_company
-        WHERE %s like company_code
-        """
-        cursor.execute(query, (don_vi_gan,))
-        result = cursor.fetchall()
-        return result
+        return get_loaihinh(cursor, don_vi_gan)
 
     except Exception as e:
         logging.error(f"Error: {e}")
 # SLA_ALL_LV3 =
 
+def to_number(value):
+    # Giống pd.to_numeric(errors="coerce"): không chuyển được thì NaN
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
 # Match and return status in Excel
-def match_and_fetch_status(rabbitmq_channel, assignment):
+def match_and_fetch_status(rabbitmq_channel, assignment, conn=None):
+    # Có `conn`: ghi trong transaction fence của process_assignment, người gọi commit
+    own_conn = conn is None
     try:
-        conn = connect_to_database(read=False)
-        if conn is None:
-            logging.error("Không thể kết nối tới cơ sở dữ liệu để cập nhật.")
-            return
+        if own_conn:
+            conn = connect_to_database(read=False)
+            if conn is None:
+                logging.error("Không thể kết nối tới cơ sở dữ liệu để cập nhật.")
+                return
         cursor = conn.cursor()
-        query_sla = """
-            SELECT
-                COALESCE(c_tgian_xuly * 1, 0) + COALESCE(c_tgian_dong * 1, 0) + COALESCE(c_tgian_chuyentiep * 1, 0) AS sla,
-                COALESCE(c_tgian_xuly, 0) AS sla_xuly,
-                COALESCE(c_tong_ngay, 0) AS tong_ngay
-            FROM
-                jwdb.app_fd_su_sla_ticket
-            WHERE
-                COALESCE(c_PhanLoai, '') LIKE CONCAT('%', %s, '%')
-                AND (
-                    COALESCE(c_NhomYeuCau, '') LIKE CONCAT('%', %s, '%')
-                    OR c_NhomYeuCau = ''
-                )
-                AND (
-                    COALESCE(c_DanhMucYeuCau, '') LIKE CONCAT('%', %s, '%')
-                    OR c_DanhMucYeuCau = ''
-                )
-                AND COALESCE(c_loai_sla, '') LIKE CONCAT('%', %s, '%')
-                AND COALESCE(c_douutien_tk, '') LIKE CONCAT('%', %s, '%')
-            ORDER BY
-                CASE WHEN COALESCE(c_NhomYeuCau, '') LIKE CONCAT('%', %s, '%')
-                AND COALESCE(c_DanhMucYeuCau, '') LIKE CONCAT('%', %s, '%') THEN 0 ELSE 1 END
-            LIMIT 1;
-            """
         logging.info(
             f"{assignment['L1']}, {assignment['L2']}, {assignment['L3']}, {assignment['c_CapDoXuLy']}, {assignment['c_MucDo']}")
         logging.info("-------------------------------------------")
-        cursor.execute(
-            query_sla,
-            (assignment["L1"], assignment["L2"], assignment["L3"], assignment["c_CapDoXuLy"], assignment["c_MucDo"], assignment['L2'], assignment['L3']))
-        result = cursor.fetchone()
+        result = find_sla(
+            cursor, assignment["L1"], assignment["L2"], assignment["L3"], assignment["c_CapDoXuLy"], assignment["c_MucDo"])
         
         if result:
             columns = ["sla", "sla_xuly", "tong_ngay"]
             result_dict = dict(zip(columns, result))
             logging.info(f"Found SLA data: {result_dict}")
-            sla = pd.to_numeric(result_dict["sla"], errors="coerce")
+            sla = to_number(result_dict["sla"])
             sla_xuly = result_dict["sla_xuly"]
             tong_ngay = result_dict["tong_ngay"]
             logging.info(f"Found SLA: {sla}")
@@ -421,31 +924,15 @@ def match_and_fetch_status(rabbitmq_channel, assignment):
         # logging.info(
         #     f"{assignment['Nhom']},{assignment['L1']},{assignment['L2']},{assignment['L3']},{assignment['L4']}")
         # # logging.info(f"{condition}")
-        cursor.close()
-        cursor = conn.cursor()
+        result_dicts = []
         try:
-            procedure_call = "CALL msb_api.tk_get_action_by_level(%s, %s, %s, %s);"
-            params = (assignment["L1"], assignment["L2"], assignment["L3"], '')
-            logging.info(f"params{params}")
-            cursor.execute(procedure_call, params)
-            
-            result_rows = cursor.fetchone()
-
-            logging.info(f"abc {cursor.description}")
-            columns = [col[0] for col in cursor.description]
-            logging.info(f"result_rows {result_rows}")
-            result_dicts = [dict(zip(columns,result_rows))]
-        
-
+            route = get_action_route(cursor, assignment["L1"], assignment["L2"], assignment["L3"])
+            if route:
+                result_dicts = [route]
             logging.info(f"result_dict {result_dicts}")
         except Exception as e:
             logging.error(f"get databasse error: {e}")
-        
-        _ = cursor.fetchall()
-        # conn.commit()
-        cursor.close()
-        conn.close()
-       
+
         if result_dicts:
             first_row = result_dicts[0]
             status = first_row.get("Status")
@@ -472,13 +959,6 @@ def match_and_fetch_status(rabbitmq_channel, assignment):
             #         break
             list_email = []
             try:
-                conn = connect_to_database(read=False)
-                if conn is None:
-                    logging.error("Không thể kết nối tới cơ sở dữ liệu để cập nhật.")
-                    return
-                cursor = conn.cursor()
-                while cursor.nextset():
-                    cursor.fetchall()  
                 logging.info(f"{first_row.get('Nhom')} {first_row.get('L1')} {first_row.get('L2')} {first_row.get('L3')}")
                 list_email = get_list_email(
                     assignment['Nhom'],
@@ -493,11 +973,13 @@ def match_and_fetch_status(rabbitmq_channel, assignment):
                 )
                 # test
                 logging.info(f"list_email:{list_email}")
-                conn.commit()
-                cursor.close()
-                conn.close()
+                if own_conn:
+                    conn.commit()
             except Exception as e:
                 logging.error(f"get list_mail error: {e}")
+            cursor.close()
+            if own_conn:
+                conn.close()
 
             update_ticket_status_main(
                 ticket_id=assignment["id"],
@@ -516,15 +998,19 @@ def match_and_fetch_status(rabbitmq_channel, assignment):
                 sla=sla,
                 sla_xuly=sla_xuly,
                 tong_ngay=tong_ngay,
+                conn=None if own_conn else conn,
             )
             return {"status": status, "email": email, "type": obj_type, "object": obj}, sla_xuly, True if assignment[
                                                                                                               "c_CapDoXuLy"] == "Xử lý lần đầu" else False
         else:
             # logging.info(excel_Nhom, excel_L1, excel_L2, excel_L3, excel_L4)
             logging.info("No match database.")
-            ticket_id = assignment["id"].iloc[0] if isinstance(assignment["id"], pd.Series) else assignment["id"]
+            ticket_id = assignment["id"]
             # update_sla_manual(cursor, ticket_id, sla, sla_xuly, tong_ngay, assignment, logging)
             logging.info(f"Ticket {ticket_id} đã được cập nhật sla đóng.")
+            cursor.close()
+            if own_conn:
+                conn.close()
 
        
         return None, sla_xuly, True if assignment["c_CapDoXuLy"] == "Xử lý lần đầu" else False
@@ -551,14 +1037,18 @@ def update_ticket_status_main(
         sla_xuly,
         tong_ngay,
         requests=None,
+        conn=None,
 ):
+    # Có `conn`: mọi thay đổi nằm trong transaction fence của process_assignment, người gọi commit
+    own_conn = conn is None
     try:
         logging.info(f"Start updating.....")
         if status and status != "":
-            conn = connect_to_database(read=False)
-            if conn is None:
-                logging.error("Không thể kết nối tới cơ sở dữ liệu để cập nhật.")
-                return
+            if own_conn:
+                conn = connect_to_database(read=False)
+                if conn is None:
+                    logging.error("Không thể kết nối tới cơ sở dữ liệu để cập nhật.")
+                    return
 
             cursor = conn.cursor()
             logging.info(f"[*] Handle: {obj_type} - { assignment.get('c_type_ticket_ho', '')} - "
@@ -573,16 +1063,11 @@ def update_ticket_status_main(
                         sla_phanHoi = update_sla_manual(cursor, ticket_id, sla, sla_xuly, tong_ngay, assignment, logging, mode="full_day", include_saturday=False)
                     else:
                         sla_phanHoi = update_sla_manual(cursor, ticket_id, sla, sla_xuly, tong_ngay, assignment, logging)
-                conn.commit()
-                cursor.close()
-                conn.close()
+                if own_conn:
+                    conn.commit()
             except  Exception as e:
                 logging.error(f"Error sla: {e}", exc_info=True)
-
-            conn = connect_to_database(read=False)
-            if conn is None:
-                logging.error("Không thể kết nối tới cơ sở dữ liệu để cập nhật.")
-                return
+            cursor.close()
 
             cursor = conn.cursor()
 
@@ -606,210 +1091,548 @@ def update_ticket_status_main(
 
 
 
-            conn.commit()
             cursor.close()
-            conn.close()
+            if own_conn:
+                conn.commit()
+                conn.close()
     except mysql.connector.Error as err:
         logging.error(f"Error updating ticket {ticket_id}: {err}")
     except pika.exceptions.AMQPError as rabbit_err:
         logging.error(f"Error sending message to RabbitMQ: {rabbit_err}")
 
 
-def recall_data(rabbitmq_channel):
+def process_assignment(rabbitmq_channel, assignment, previous_versions=None):
+    """
+    Xử lý một dòng outbox trong một transaction fence: khóa claim trước khi ghi gì, mọi thay đổi
+    (lịch sử, SLA, trạng thái ticket, Done) dùng chung kết nối đó và chỉ commit một lần ở cuối,
+    sau khi message đã được broker xác nhận. Node mất claim/lease thì không có gì được ghi hay gửi.
+    """
+    assignment_id = assignment["id"]
+    ticket_index = int(assignment["ticket_index"])
+    conn = connect_to_database(read=False)
+    if conn is None:
+        raise RuntimeError(f"Cannot connect to database to process assignment ID: {assignment_id}")
     try:
-
-        logging.info("insert_tciket done")
-        assignments = fetch_assignments()
-        if assignments.empty:
-            logging.info("No assignments to recall.")
-            return
-
-        for _, assignment in assignments.iterrows():
+        conn.start_transaction()
+        cursor = conn.cursor()
+        owned = lock_claim(cursor, ticket_index)
+        cursor.close()
+        publisher = rabbitmq_channel if isinstance(rabbitmq_channel, RabbitMQPublisher) else None
+        if owned:
+            cursor = conn.cursor()
             try:
-                maTicket = assignment["c_maTicket"] if not isinstance(assignment["c_maTicket"], pd.Series) else assignment["c_maTicket"].iloc[0]
-                df_ticket = get_ticket_data(maTicket)
-                Ticket_id =df_ticket["id"] if not isinstance(df_ticket["id"], pd.Series) else df_ticket["id"].iloc[0]
-
-                ticket_data = get_ticket_data_from(Ticket_id)
-                if ticket_data is None:
+                if copy_ticket_data(cursor, assignment["c_maTicket"], only_if_missing=True):
                     logging.info("start insert ticket mới")
-                    insert_ticket_data(df_ticket)
                 else:
                     logging.info("không phải là ticket mới")
-            except Exception as e:
+            except mysql.connector.Error as e:
                 logging.error(f"Error in recall_data: {e}", exc_info=True)
-            assignment_id = assignment["id"]
+            finally:
+                cursor.close()
             logging.info(f"Processing assignment ID: {assignment_id}")
 
-            status_data, sla, check_xu_ly_lan_dau = match_and_fetch_status(rabbitmq_channel, assignment)
+            status_data, sla, check_xu_ly_lan_dau = match_and_fetch_status(rabbitmq_channel, assignment, conn)
             if status_data:
                 logging.info(f"Matched and updated ticket with status: {status_data}")
             else:
                 logging.info(f"No match found for assignment ID: {assignment_id}")
-            update_assignment_status(assignments, sla, check_xu_ly_lan_dau)
+            # Hàm bên ngoài có thể đã commit (mất lock): khóa và kiểm tra claim lần nữa trước khi gửi
+            cursor = conn.cursor()
+            owned = lock_claim(cursor, ticket_index)
+            cursor.close()
+        if not owned:
+            conn.rollback()
+            if publisher is not None:
+                publisher.discard()
+            logging.error(f"Assignment {ticket_index} is no longer claimed by {NODE_ID}, dropped")
+            return
+        # Message gửi Ticket_API/Ticket_Mail phải được broker xác nhận trước khi đánh dấu Done;
+        # không xác nhận được thì bỏ fence để process_ticket_group trả dòng về hàng chờ (fail_claim)
+        if publisher is not None and not publisher.flush(PUBLISH_CONFIRM_TIMEOUT):
+            conn.rollback()
+            raise RuntimeError(f"RabbitMQ did not confirm all messages of assignment ID: {assignment_id}")
+        if update_assignment_status(assignment, sla, check_xu_ly_lan_dau, previous_versions, conn=conn):
+            conn.commit()
             logging.info(
                 f"Recalled data and updated status for assignment ID: {assignment_id}"
             )
+    finally:
+        conn.close()
+
+
+def recall_data(rabbitmq_channel):
+    try:
+
+        logging.info("insert_tciket done")
+        assignments = fetch_assignments()
+        if not assignments:
+            logging.info("No assignments to recall.")
+            return
+
+        for assignment in assignments:
+            process_assignment(rabbitmq_channel, assignment)
 
 
     except Exception as e:
         logging.error(f"Error in recall_data: {e}", exc_info=True)
 
 
-##  data_label_for_level = ["c_PhanLoai","c_NhomYeuCau","c_DanhMucYeuCau","c_ChiTietYeuCau"]
-def retrieve_id_for_level(level: str, data: str) -> str:
-    try:
-        conn = connect_to_database(read=False)
-        if conn is None:
+class PublishRequest:
+    __slots__ = ("exchange", "routing_key", "body", "properties", "done", "ok")
+
+    def __init__(self, exchange, routing_key, body, properties):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body
+        self.properties = properties
+        self.done = threading.Event()
+        self.ok = False
+
+
+class RabbitMQPublisher:
+    """
+    Channel dùng chung cho mọi worker thread (pika không thread-safe): basic_publish() chỉ giữ
+    message trong bộ đệm của thread, flush() mới đưa vào hàng đợi và chờ xác nhận, discard() bỏ đi.
+    Một thread riêng giữ connection duy nhất, publish với publisher confirm (BlockingChannel xác nhận
+    đồng bộ từng message), tự kết nối lại và giữ heartbeat khi rảnh. Message chỉ persistent khi
+    [rabbitmq] durable_queues = true, vì message persistent trên queue không durable vẫn mất khi
+    broker khởi động lại.
+    """
+
+    def __init__(self, batch_size=PUBLISH_BATCH_SIZE, queue_size=PUBLISH_QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.connection = None
+        self.channel = None
+        self.persistent = False
+        self.stats = {"published": 0, "nacked": 0, "reconnects": 0}
+
+    @property
+    def is_open(self):
+        return True
+
+    @property
+    def is_closed(self):
+        return False
+
+    def start(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name="rabbitmq-publisher", daemon=True)
+                    self.thread.start()
+
+    def basic_publish(self, exchange="", routing_key="", body=b"", properties=None, mandatory=False):
+        request = PublishRequest(exchange, routing_key, body, properties or pika.BasicProperties())
+        pending = getattr(self.local, "pending", None)
+        if pending is None:
+            pending = self.local.pending = []
+        pending.append(request)
+
+    def discard(self):
+        """Bỏ các message thread hiện tại đã publish nhưng chưa flush (dòng không được gửi)."""
+        pending = getattr(self.local, "pending", None) or []
+        self.local.pending = []
+        return len(pending)
+
+    def flush(self, timeout=None):
+        """
+        Gửi các message do thread hiện tại publish và chờ broker xác nhận.
+        Returns:
+            bool: False nếu có message bị từ chối hoặc quá timeout.
+        """
+        pending = getattr(self.local, "pending", None) or []
+        self.local.pending = []
+        if pending:
+            self.start()
+        for request in pending:
+            self.queue.put(request)  # Hàng đợi đầy thì chờ (backpressure)
+        deadline = None if timeout is None else time.time() + timeout
+        ok = True
+        for request in pending:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            if not request.done.wait(remaining) or not request.ok:
+                ok = False
+        return ok
+
+    def connect(self):
+        self.close()
+        config = read_config(os.path.join(os.path.dirname(__file__), "common_config", "config.ini"))
+        self.connection, self.channel = setup_rabbitmq_connection(config)
+        self.persistent = config["rabbitmq"].getboolean("durable_queues", fallback=False)
+        if self.channel is not None:
+            self.channel.confirm_delivery()
+            self.stats["reconnects"] += 1
+
+    def close(self):
+        try:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+        self.connection, self.channel = None, None
+
+    def run(self):
+        batch = []
+        while True:
+            if not batch:
+                try:
+                    batch.append(self.queue.get(timeout=5))
+                except queue.Empty:
+                    # Giữ heartbeat khi không có message
+                    try:
+                        if self.connection is not None and self.connection.is_open:
+                            self.connection.process_data_events(time_limit=0)
+                    except Exception as e:
+                        logging.error(f"RabbitMQ heartbeat error: {e}")
+                        self.close()
+                    continue
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+            try:
+                if self.channel is None or self.channel.is_closed or self.connection.is_closed:
+                    self.connect()
+                    if self.channel is None:
+                        time.sleep(SLEEP_INTERVAL)
+                        continue
+
+                while batch:
+                    request = batch[0]
+                    if self.persistent and request.properties.delivery_mode is None:
+                        request.properties.delivery_mode = 2
+                    try:
+                        self.channel.basic_publish(
+                            exchange=request.exchange,
+                            routing_key=request.routing_key,
+                            body=request.body,
+                            properties=request.properties,
+                        )
+                        request.ok = True
+                        self.stats["published"] += 1
+                    except (pika.exceptions.NackError, pika.exceptions.UnroutableError):
+                        logging.error(f"Message rejected by RabbitMQ [{request.routing_key}]: {request.body[:255]}")
+                        self.stats["nacked"] += 1
+                    request.done.set()
+                    batch.pop(0)
+
+            except Exception as e:
+                logging.error(f"Error publishing to RabbitMQ ({len(batch)} messages pending): {e}")
+                self.close()
+                time.sleep(SLEEP_INTERVAL)
+
+
+rabbitmq_publisher = RabbitMQPublisher()
+
+
+def get_worker_rabbitmq_channel():
+    return rabbitmq_publisher
+
+
+def process_ticket_group(assignments, previous_versions=None):
+    # Các dòng của cùng một ticket được xử lý tuần tự theo dateModified; một dòng lỗi thì dừng cả nhóm,
+    # các dòng mới hơn được trả về hàng chờ và chỉ được claim lại sau khi dòng lỗi xong
+    for position, assignment in enumerate(assignments):
+        try:
+            process_assignment(get_worker_rabbitmq_channel(), assignment, previous_versions)
+        except Exception as e:
+            logging.error(f"Error processing assignment {assignment['ticket_index']}: {e}", exc_info=True)
+            get_worker_rabbitmq_channel().discard()
+            fail_claim(int(assignment["ticket_index"]), e)
+            release_claims([int(rest["ticket_index"]) for rest in assignments[position + 1:]])
             return
+
+
+def recall_data_batch(executor, buckets=None):
+    """
+    Claim a batch of pending outbox rows (of `buckets` when given) and process them on the worker pool.
+    Returns:
+        int: Number of rows claimed (0 when the outbox is empty).
+    """
+    assignments = claim_assignments(BATCH_SIZE, buckets)
+    if not assignments:
+        logging.info("No assignments to recall.")
+        return 0
+
+    groups = {}
+    for assignment in assignments:
+        groups.setdefault(assignment["id"], []).append(assignment)
+    logging.info(f"Claimed {len(assignments)} assignments for {len(groups)} tickets")
+
+    # Bản ghi trước của cả batch lấy một lần để tạo ghi chú thay đổi
+    previous_versions = fetch_previous_versions([assignment["ticket_index"] for assignment in assignments])
+
+    futures = [
+        executor.submit(process_ticket_group, group, previous_versions)
+        for group in groups.values()
+    ]
+    wait(futures)
+    return len(assignments)
+
+
+outbox_wakeup = threading.Event()
+
+
+def listen_outbox_changes():
+    """
+    Đăng ký fanout exchange outbox_changed (serviceITS publish sau khi ghi app_fd_sp_tickets)
+    bằng một queue exclusive riêng, để mọi worker đều được đánh thức.
+    """
+    while True:
+        connection = None
+        try:
+            config = read_config(os.path.join(os.path.dirname(__file__), "common_config", "config.ini"))
+            exchange = config["rabbitmq"].get("outbox_exchange", "outbox_changed")
+            connection = pika.BlockingConnection(create_rabbitmq_parameters(config))
+            channel = connection.channel()
+            channel.exchange_declare(exchange=exchange, exchange_type="fanout", durable=True)
+            queue_name = channel.queue_declare(queue="", exclusive=True).method.queue
+            channel.queue_bind(exchange=exchange, queue=queue_name)
+            channel.basic_consume(
+                queue=queue_name,
+                on_message_callback=lambda ch, method, properties, body: outbox_wakeup.set(),
+                auto_ack=True,
+            )
+            logging.info(f"Listening for outbox changes on exchange {exchange}")
+            outbox_wakeup.set()  # Có thể đã lỡ thông báo trong lúc mất kết nối
+            channel.start_consuming()
+        except Exception as e:
+            logging.error(f"Error listening for outbox changes: {e}")
+        finally:
+            if connection is not None and connection.is_open:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+        time.sleep(SLEEP_INTERVAL)
+
+
+def probe_outbox_loop():
+    """
+    Lưới an toàn cho các thay đổi không đi qua serviceITS (Joget, trigger): outbox_sp_tickets
+    chỉ thêm dòng, nên MAX(id) tăng là có việc mới. Thông báo fanout vẫn là đường chính,
+    probe chỉ chạy mỗi OUTBOX_PROBE_INTERVAL giây trên một kết nối slave riêng, giữ lâu dài
+    (không mượn pool để khỏi bị báo rò rỉ).
+    """
+    last_id = None
+    conn = None
+    while True:
+        try:
+            if conn is None:
+                conn = get_connection_pool(read=True)._connect()
+            conn.ping(reconnect=True)
+            cursor = conn.cursor()
+            cursor.execute("SELECT MAX(id) FROM jwdb.outbox_sp_tickets")
+            max_id = cursor.fetchall()[0][0]
+            cursor.close()
+            conn.rollback()  # Không giữ snapshot cũ giữa hai lần probe
+            if max_id != last_id:
+                if last_id is not None:
+                    outbox_wakeup.set()
+                last_id = max_id
+        except Exception as e:
+            logging.error(f"Error probing outbox: {e}")
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                conn = None
+        time.sleep(OUTBOX_PROBE_INTERVAL)
+
+
+routes_reload = threading.Event()
+
+
+def refresh_action_routes_loop():
+    """
+    Nạp trước toàn bộ định tuyến khi khởi động, sau đó làm mới các bộ sắp hết hạn
+    để luồng xử lý ticket không phải gọi tk_get_action_by_level.
+    """
+    full = True
+    while True:
+        conn = connect_to_database(read=False)
+        if conn is not None:
+            try:
+                cursor = conn.cursor()
+                warm_action_routes(cursor, None if full else expiring_route_keys(ROUTE_TTL / 2))
+                cursor.close()
+                full = False
+            except Exception as e:
+                logging.error(f"Error refreshing action routes: {e}")
+            finally:
+                conn.close()
+        if routes_reload.wait(ROUTE_TTL / 3):
+            # SIGHUP: xóa cache ở đây chứ không trong signal handler (handler không được lấy lock)
+            routes_reload.clear()
+            invalidate_action_routes()
+            invalidate_companies()
+            full = True
+
+
+def reload_action_routes(signum, frame):
+    # kill -HUP <pid>: chỉ báo cho refresh_action_routes_loop xóa cache và nạp lại
+    routes_reload.set()
+
+
+CHANGE_NOTE_LABELS = {
+    "c_source": "Nguồn",
+    "c_individual": "Nhóm KH",
+    "c_CapDoXuLy": "Cấp độ xử lý",
+    "c_PhanLoai": "Level 1 - Phân loại",
+    "c_NhomYeuCau": "Level 2 - Nhóm yêu cầu",
+    "c_DanhMucYeuCau": "Level 3",
+    "c_ChiTietYeuCau": "Level 4",
+    "c_level5": "Level 5",
+    "c_DonViGan": "Đơn vị gán",
+    "c_MucDo": "Mức độ ưu tiên",
+    "c_content": "Nội dung xử lý",
+    "modifiedBy": "User thay đổi",
+    "dateModified": "Thời gian thay đổi",
+    "c_sla_phanHoiKH": "SLA phản hồi",
+    "c_huongxl": "Nội dung xử lý",
+    "c_user_pheDuyet": "User phê duyệt",
+    "c_pheDuyet": "Trạng thái phê duyệt"
+}
+
+# Bản ghi outbox liền trước (dateModified nhỏ hơn) của từng dòng, tính bằng window function
+PREVIOUS_VERSIONS_QUERY = """
+    SELECT *
+    FROM (
+        SELECT
+            id AS ticket_index,
+            LAST_VALUE(id) OVER w AS previous_id,
+            {columns}
+        FROM jwdb.outbox_sp_tickets
+        WHERE ticket_id IN (
+            SELECT ticket_id FROM jwdb.outbox_sp_tickets WHERE id IN ({placeholders})
+        )
+        WINDOW w AS (
+            PARTITION BY ticket_id ORDER BY dateModified
+            RANGE BETWEEN UNBOUNDED PRECEDING AND INTERVAL 1 MICROSECOND PRECEDING
+        )
+    ) versions
+    WHERE ticket_index IN ({placeholders})
+    AND previous_id IS NOT NULL
+"""
+
+
+def fetch_previous_versions(ticket_indexes):
+    """
+    Lấy bản ghi trước đó của nhiều dòng outbox bằng một query.
+    Returns:
+        dict: ticket_index -> {cột: giá trị cũ}; dòng không có bản trước thì không có key.
+    """
+    ticket_indexes = [int(ticket_index) for ticket_index in ticket_indexes]
+    if not ticket_indexes:
+        return {}
+    conn = connect_to_database(read=True)
+    if conn is None:
+        return None
+    try:
+        placeholders = ", ".join(["%s"] * len(ticket_indexes))
+        columns = ",\n            ".join(f"LAST_VALUE({col}) OVER w AS {col}" for col in CHANGE_NOTE_LABELS)
+        query = PREVIOUS_VERSIONS_QUERY.format(columns=columns, placeholders=placeholders)
         cursor = conn.cursor()
-        if level == "c_PhanLoai":
-            query = """
-            SELECT c_ten_phan_loai
-            FROM jwdb.app_fd_sp_phanloai
-            WHERE id = %s
-            """
-        elif level == "c_NhomYeuCau":
-            query = """
-            SELECT c_ten_nhom_yeucau
-            FROM jwdb.app_fd_sp_nhomyeucau
-            WHERE id = %s
-            """
-        elif level == "c_DanhMucYeuCau":
-            query = """
-            SELECT c_ten_danh_muc_yeucau
-            FROM jwdb.app_fd_sp_danhmucyeucau
-            WHERE id = %s
-            """
-        else:
-            query = """
-            SELECT c_ten_level_4
-            FROM jwdb.app_fd_sp_ql_lv4
-            WHERE id = %s
-            """
-        cursor.execute(query, (data,))
-        result = cursor.fetchone()
+        versions = fetch_rows(cursor, query, ticket_indexes + ticket_indexes)
+        cursor.close()
+        return {int(row["ticket_index"]): row for row in versions}
+    except Exception as e:
+        logging.error(f"Error fetching previous versions: {e}")
+        return None
+    finally:
+        conn.close()
 
-        if result:
-            return result[0]
+
+def build_change_note(cursor, before, assignment, sla, check_xuly_lan_dau):
+    """Tạo bảng HTML các trường thay đổi so với bản ghi trước, giá trị được escape."""
+    differences = []
+    for col, label in CHANGE_NOTE_LABELS.items():
+        old_value = before[col]
+        if col != "c_sla_phanHoiKH":
+            new_value = assignment[col]
         else:
-            return None
-    except mysql.connector.Error as err:
-        logging.error(f'Error updating assignment status for id {level}: {err}')
+            new_value = sla if check_xuly_lan_dau else old_value
+        if col in LEVEL_COLUMNS:
+            old_value = get_level_name(cursor, LEVEL_COLUMNS[col], old_value)
+            new_value = get_level_name(cursor, LEVEL_COLUMNS[col], new_value)
+        if old_value != new_value:
+            differences.append({"label": label, "old_value": old_value, "new_value": new_value})
+
+    if not differences:
+        return "<p>Không có trường nào thay đổi.</p>"
+    agent = html.escape(str(assignment["modifiedBy"]))
+    note = "<p>Các trường đã thay đổi:</p>"
+    note += "<table border='1' cellpadding='5' cellspacing='0'>"
+    note += "<tr><th>Label</th><th>Giá trị cũ</th><th>Giá trị mới</th><th>Agent thay đổi</th></tr>"  # Tiêu đề bảng
+    for diff in differences:
+        note += (
+            f"<tr><td>{html.escape(diff['label'])}</td><td>{html.escape(str(diff['old_value']))}</td>"
+            f"<td>{html.escape(str(diff['new_value']))}</td><td>{agent}</td></tr>"
+        )
+    note += "</table>"
+    return note
 
 
-def update_assignment_status(assignment, sla, check_xuly_lan_dau):
+# Chỉ đánh dấu Done khi node này còn giữ claim của dòng
+ASSIGNMENT_DONE = """
+        UPDATE jwdb.outbox_sp_tickets o
+        JOIN jwdb.outbox_claims c ON c.outbox_id = o.id AND c.owner = %s
+        SET o.c_status = CONCAT(REPLACE(o.c_status, '-Claimed', ''), '-Done'), o.c_field20 = %s
+        WHERE o.id = %s AND o.c_status IN ('Inserted-Claimed', 'Updated-Claimed')
+        """
+CLAIM_DONE = "DELETE FROM jwdb.outbox_claims WHERE outbox_id = %s"
+
+
+def update_assignment_status(assignment, sla, check_xuly_lan_dau, previous_versions=None, conn=None):
+    """
+    Đánh dấu dòng Done và sao chép report / lịch sử. Có `conn` thì chạy trong transaction fence
+    của người gọi (người gọi commit), không thì tự mở kết nối và commit.
+    Returns:
+        bool: False nếu node không còn giữ claim hoặc lỗi DB.
+    """
+    own_conn = conn is None
     try:
-        conn = connect_to_database(read=False)
-        if conn is None:
-            return
+        if own_conn:
+            conn = connect_to_database(read=False)
+            if conn is None:
+                return False
         cursor = conn.cursor()
-        query_before = """
-            SELECT c_source,
-                c_individual,
-                c_CapDoXuLy,
-                c_PhanLoai,
-                c_NhomYeuCau,
-                c_DanhMucYeuCau,
-                c_ChiTietYeuCau,
-                c_level5,
-                c_DonViGan,
-                c_MucDo,
-                c_content,
-                modifiedBy,
-                dateModified,
-                c_sla_phanHoiKH,
-                c_huongxl,
-                c_user_pheDuyet,
-                c_pheDuyet
-            FROM jwdb.outbox_sp_tickets
-            WHERE ticket_id = %s
-            AND dateModified < %s
-            ORDER BY dateModified DESC
-            LIMIT 1
-        """
-        ticket_id = assignment["id"] if not isinstance(assignment["id"], pd.Series) else assignment["id"].iloc[0]
-        date_before = assignment["dateModified"] if not isinstance(assignment["dateModified"], pd.Series) else \
-        assignment["dateModified"].iloc[0]
+        ticket_id = assignment["id"]
+        ticket_index = int(assignment["ticket_index"])
 
-        assignments_before = pd.read_sql(query_before, conn, params=(ticket_id, date_before,))
-        logging.info(f"affect rows: {assignments_before}")
+        if previous_versions is None:
+            previous_versions = fetch_previous_versions([ticket_index]) or {}
+        before = previous_versions.get(ticket_index)
         note = ""
 
-        if assignments_before.empty:
-            logging.info(f"No previous record found for ticket_id {assignment['id']} - {ticket_id}")
+        if before is None:
+            logging.info(f"No previous record found for ticket_id {ticket_id}")
         else:
-            column_labels = {
-                "c_source": "Nguồn",
-                "c_individual": "Nhóm KH",
-                "c_CapDoXuLy": "Cấp độ xử lý",
-                "c_PhanLoai": "Level 1 - Phân loại",
-                "c_NhomYeuCau": "Level 2 - Nhóm yêu cầu",
-                "c_DanhMucYeuCau": "Level 3",
-                "c_ChiTietYeuCau": "Level 4",
-                "c_level5": "Level 5",
-                "c_DonViGan": "Đơn vị gán",
-                "c_MucDo": "Mức độ ưu tiên",
-                "c_content": "Nội dung xử lý",
-                "modifiedBy": "User thay đổi",
-                "dateModified": "Thời gian thay đổi",
-                "c_sla_phanHoiKH": "SLA phản hồi",
-                "c_huongxl": "Nội dung xử lý",
-                "c_user_pheDuyet": "User phê duyệt",
-                "c_pheDuyet": "Trạng thái phê duyệt"
-            }
-
-            differences = []
-            data_label_for_level = ["c_PhanLoai", "c_NhomYeuCau", "c_DanhMucYeuCau", "c_ChiTietYeuCau"]
-
-            for col in column_labels.keys():
-                old_value = assignments_before.iloc[0][col]
-                if col != "c_sla_phanHoiKH":
-                    new_value = assignment[col] if isinstance(assignment[col], (str, int, float)) else \
-                    assignment[col].iloc[
-                        0]
-                else:
-                    new_value = sla if check_xuly_lan_dau else old_value
-                if col in data_label_for_level:
-                    old_value = retrieve_id_for_level(col, old_value)
-                    new_value = retrieve_id_for_level(col, new_value)
-                # logging.info(f"Old value: {old_value}, New value: {new_value}")
-                if old_value != new_value:
-                    differences.append(
-                        {
-                            "label": column_labels[col],
-                            "old_value": old_value,
-                            "new_value": new_value
-                        })
-            agent = assignment.iloc[0]["modifiedBy"]
-            if not differences:
-                note = "<p>Không có trường nào thay đổi.</p>"
-            else:
-                note = "<p>Các trường đã thay đổi:</p>"
-                note += "<table border='1' cellpadding='5' cellspacing='0'>"
-                note += "<tr><th>Label</th><th>Giá trị cũ</th><th>Giá trị mới</th><th>Agent thay đổi</th></tr>"  # Tiêu đề bảng
-
-                for diff in differences:
-                    note += f"<tr><td>{diff['label']}</td><td>{diff['old_value']}</td><td>{diff['new_value']}</td><td>{agent}</td></tr>"
-
-                note += "</table>"
+            note = build_change_note(cursor, before, assignment, sla, check_xuly_lan_dau)
 
         logging.info(note)
-        query = """
-        UPDATE jwdb.outbox_sp_tickets
-        SET c_status = CONCAT(c_status, '-Done'),c_field20 = %s
-        WHERE id = %s
-        """
+        query = ASSIGNMENT_DONE
         # query_update = """
         # UPDATE jwdb.outbox_sp_ticket_report
         # SET c_status = CONCAT(c_status, '-Done'),c_field20 = %s
         # WHERE id = %s
         # """
-        ticket_index = assignment["ticket_index"] if not isinstance(assignment["ticket_index"], pd.Series) else \
-            assignment["ticket_index"].iloc[0]
-        ticket_index = int(ticket_index)
         logging.info(f'Executing query: {query} with id: {assignment["ticket_index"]}')
-        cursor.execute(query, (note, ticket_index,))
+        cursor.execute(query, (NODE_ID, note, ticket_index))
+        if not cursor.rowcount:
+            logging.error(f"Assignment {ticket_index} is no longer claimed by {NODE_ID}, not marked Done")
+            cursor.close()
+            if own_conn:
+                conn.rollback()
+            return False
+        cursor.execute(CLAIM_DONE, (ticket_index,))
         # cursor.execute(query_update, (note, ticket_index,))
 
 
@@ -824,65 +1647,70 @@ def update_assignment_status(assignment, sla, check_xuly_lan_dau):
         # cursor.execute(query, (ticket_id,))
 
         logging.info(f"Rows affected: {cursor.rowcount}")
-        conn.commit()
+        maTicket = assignment["c_maTicket"]
+        # Cập nhật trạng thái và sao chép report / lịch sử trong cùng một transaction
+        cursor.execute("SAVEPOINT ticket_copy")
+        try:
+            copy_ticket_to_report(cursor, ticket_index)
+            logging.info("update ticket data report")
+            copy_ticket_data(cursor, maTicket)
+            logging.info("update ticket data done")
+        except mysql.connector.Error as err:
+            # Không sao chép được thì vẫn đánh dấu Done như trước, tránh xử lý (gửi mail) lại
+            logging.error(f"Error copying ticket {ticket_index} to report/history: {err}", exc_info=True)
+            cursor.execute("ROLLBACK TO SAVEPOINT ticket_copy")
+        if own_conn:
+            conn.commit()
         cursor.close()
-        conn.close()
-
-        df = get_ticket(ticket_index)
-        insert_ticket(df)
-        logging.info("update ticket data report")
-        maTicket = assignment["c_maTicket"] if not isinstance(assignment["c_maTicket"], pd.Series) else \
-            assignment["c_maTicket"].iloc[0]
-        df_ticket = get_ticket_data(maTicket)
-        # if df["c_trangThai"].iloc[0] != df_ticket["c_trangThai"].iloc[0] or df_ticket["c_trangThai"].iloc[0] == "Mới":
-        logging.info("update ticket data")
-        insert_ticket_data(df_ticket)
-        logging.info("update ticket data done")
+        return True
     except mysql.connector.Error as err:
         logging.error(f'Error updating assignment status for id {assignment["id"]}: {err}', exc_info=True)
+        return False
+    finally:
+        if own_conn and conn is not None:
+            conn.close()
 
 
-if __name__ == "__main__":
-    setup_logging()
-    while True:
-        current_time = time.time()
-        lock_acquired = False
-        try:
-            if os.path.exists(LOCK_FILE):
-                lockfile_age = current_time - os.path.getmtime(LOCK_FILE)
-                if lockfile_age > LOCK_TIMEOUT:
-                    os.remove(LOCK_FILE)
-                    logging.info("Old lockfile removed due to timeout.")
-
-            with open(LOCK_FILE, "w") as lockfile:
-                try:
-                    fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                    lock_acquired = True
-
-                    logging.info("Start Manual Data Recall...")
-                    os.utime(LOCK_FILE, None)
-
-                    rabbitmq_config = read_config(
-                        os.path.join(
-                            os.path.dirname(__file__), "common_config", "config.ini"
-                        )
-                    )
-                    _, rabbitmq_channel = setup_rabbitmq_connection(rabbitmq_config)
-
-                    recall_data(rabbitmq_channel)
+def stop_worker(signum, frame):
+    raise SystemExit(0)
 
-                except IOError:
-                    logging.error("Lock already acquired by another process. Exiting.")
-                    continue
 
-        except Exception as e:
-            logging.error(f"Error: {e}")
+if __name__ == "__main__":
+    setup_logging()
+    check_worker_tables()
+    signal.signal(signal.SIGHUP, reload_action_routes)
+    signal.signal(signal.SIGTERM, stop_worker)
+    routes_thread = threading.Thread(target=refresh_action_routes_loop, name="action-routes", daemon=True)
+    routes_thread.start()
+    threading.Thread(target=listen_outbox_changes, name="outbox-listener", daemon=True).start()
+    if OUTBOX_PROBE_INTERVAL:
+        threading.Thread(target=probe_outbox_loop, name="outbox-probe", daemon=True).start()
+    executor = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="assignment")
+    maintain_leases()
+    threading.Thread(target=lease_heartbeat_loop, name="lease-heartbeat", daemon=True).start()
+    logging.info(f"Worker {NODE_ID} started with buckets {sorted(owned_buckets())}")
+    reclaimed_at = 0
+    try:
+        while True:
+            processed = 0
+            try:
+                # Giữa hai batch: trả bớt bucket nếu có node mới tham gia
+                maintain_leases(rebalance=True)
+                buckets = owned_buckets()
+                if buckets and time.monotonic() - reclaimed_at > SAFETY_POLL_INTERVAL:
+                    reclaim_stale_claims(sorted(buckets))
+                    reclaimed_at = time.monotonic()
+                if buckets:
+                    outbox_wakeup.clear()
+                    processed = recall_data_batch(executor, sorted(buckets))
 
-        finally:
-            if lock_acquired:
-                with open(LOCK_FILE, "w") as lockfile:
-                    fcntl.flock(lockfile, fcntl.LOCK_UN)
-                logging.info("Lock released. Task completed.")
-                os.remove(LOCK_FILE)
+            except Exception as e:
+                logging.error(f"Error: {e}")
+                time.sleep(SLEEP_INTERVAL)
 
-        time.sleep(SLEEP_INTERVAL)
+            # Outbox đã hết việc: chờ tín hiệu thay đổi, quá SAFETY_POLL_INTERVAL thì vẫn quét lại
+            if not processed:
+                outbox_wakeup.wait(SAFETY_POLL_INTERVAL)
+    finally:
+        executor.shutdown(wait=True)
+        release_leases()
@@ -1,6 +1,163 @@
 import json
+import os
+import threading
+import time
 from datetime import datetime
+from string import Formatter
 import logging
+from level_dictionary import get_level_names
+from sla_rule_matcher import fold
+
+ITS_TEMPLATE_PATH = "/home/Python/template/ITs.txt"
+GOPY_TEMPLATE_PATH = "/home/Python/template/15_Gopy_ho.txt"
+TEMPLATE_CHECK_INTERVAL = 10  # Seconds between file mtime / DB dateModified checks
+
+# Các trường handler_its_ho truyền vào từng loại template, dùng để kiểm tra template ngay khi nạp
+ITS_FIELDS = {
+    "MucDo", "CapDoXuLy", "thoigian_Tiepnhan", "sla", "cif", "customerName", "phoneNumber",
+    "NhomYeuCau", "DanhMucYeuCau", "content", "phone_number",
+}
+GOPY_FIELDS = {
+    "DonViGan", "thoigian_Tiepnhan", "cif", "customerName", "phoneNumber", "NhomYeuCau", "DanhMucYeuCau", "content",
+}
+EMAIL_CONTENT_FIELDS = ITS_FIELDS | {"DonViGan", "sla_phanHoiKH"}
+EMAIL_SUBJECT_FIELDS = {"maTicket", "customerName", "companyCode"}
+FILE_TEMPLATE_FIELDS = {ITS_TEMPLATE_PATH: ITS_FIELDS, GOPY_TEMPLATE_PATH: GOPY_FIELDS}
+
+template_formatter = Formatter()
+template_registry = {
+    "files": {},  # path -> (mtime, CompiledTemplate)
+    "files_checked": {},  # path -> thời điểm stat gần nhất
+    "emails": {},  # template_key(c_ma_tempalet) -> (CompiledTemplate tiêu đề, CompiledTemplate nội dung)
+    "emails_version": None,
+    "emails_checked": 0,
+    "emails_refreshing": False,
+}
+template_registry_lock = threading.Lock()
+
+
+class CompiledTemplate:
+    """
+    Template str.format đã parse sẵn. Lỗi cú pháp hoặc trường không có trong `fields`
+    được ghi nhận lúc nạp (error), render() khi đó trả về None.
+    """
+
+    __slots__ = ("name", "text", "parts", "error")
+
+    def __init__(self, name, text, fields):
+        self.name = name
+        self.text = text
+        self.parts = None
+        self.error = None
+        try:
+            parts = list(template_formatter.parse(text))
+            missing = set()
+            for _, field_name, format_spec, _ in parts:
+                if field_name is None:
+                    continue
+                if format_spec and "{" in format_spec:
+                    raise ValueError("nested replacement fields are not supported")
+                root = field_name.split(".", 1)[0].split("[", 1)[0]
+                if root == "" or root.isdigit():
+                    raise ValueError("positional fields are not supported")
+                if root not in fields:
+                    missing.add(root)
+            if missing:
+                raise KeyError(", ".join(sorted(missing)))
+            self.parts = parts
+        except KeyError as e:
+            self.error = f"Thiếu trường {e} trong dữ liệu để thay vào template"
+        except ValueError as e:
+            self.error = f"Template không hợp lệ: {e}"
+        if self.error:
+            logging.error(f"Template {name}: {self.error}")
+
+    def render(self, data):
+        if self.parts is None:
+            return None
+        out = []
+        for literal, field_name, format_spec, conversion in self.parts:
+            out.append(literal)
+            if field_name is not None:
+                value, _ = template_formatter.get_field(field_name, (), data)
+                if conversion:
+                    value = template_formatter.convert_field(value, conversion)
+                out.append(template_formatter.format_field(value, format_spec))
+        return "".join(out)
+
+
+def get_file_template(template_path):
+    """Template trong file, đọc lại khi mtime thay đổi (kiểm tra tối đa mỗi TEMPLATE_CHECK_INTERVAL giây)."""
+    now = time.time()
+    cached = template_registry["files"].get(template_path)
+    if cached is not None and now - template_registry["files_checked"].get(template_path, 0) < TEMPLATE_CHECK_INTERVAL:
+        return cached[1]
+    with template_registry_lock:
+        mtime = os.stat(template_path).st_mtime
+        template_registry["files_checked"][template_path] = now
+        cached = template_registry["files"].get(template_path)
+        if cached is None or cached[0] != mtime:
+            with open(template_path, "r", encoding="utf-8") as file:
+                text = file.read()
+            fields = FILE_TEMPLATE_FIELDS.get(template_path, ITS_FIELDS | GOPY_FIELDS)
+            cached = (mtime, CompiledTemplate(template_path, text, fields))
+            template_registry["files"][template_path] = cached
+            logging.info(f"Loaded template file {template_path}")
+        return cached[1]
+
+
+def template_key(code):
+    """Khóa tra c_ma_tempalet giống `c_ma_tempalet = %s` (collation _ci, bỏ dấu cách cuối)."""
+    return "" if code is None else fold(code).rstrip(" ")
+
+
+def reload_email_templates(cursor, force=False):
+    """Nạp lại app_fd_sp_template_email khi số dòng hoặc MAX(dateModified) thay đổi."""
+    if not force and time.time() - template_registry["emails_checked"] < TEMPLATE_CHECK_INTERVAL:
+        return
+    with template_registry_lock:
+        if template_registry["emails_refreshing"] or (
+            not force and time.time() - template_registry["emails_checked"] < TEMPLATE_CHECK_INTERVAL
+        ):
+            return
+        template_registry["emails_refreshing"] = True
+        known_version = template_registry["emails_version"]
+    try:
+        # Truy vấn ngoài lock, các luồng khác vẫn dùng template hiện có
+        cursor.execute("SELECT COUNT(*), MAX(dateModified) FROM jwdb.app_fd_sp_template_email")
+        version = tuple(cursor.fetchall()[0])
+        emails = None
+        if force or version != known_version:
+            cursor.execute("""
+                SELECT c_ma_tempalet, c_tieu_de, c_content
+                FROM jwdb.app_fd_sp_template_email
+                """)
+            emails = {}
+            for code, tieu_de, content in cursor.fetchall():
+                code_key = template_key(code)
+                if code_key in emails:
+                    continue
+                emails[code_key] = (
+                    CompiledTemplate(f"{code} (tiêu đề)", tieu_de or "", EMAIL_SUBJECT_FIELDS),
+                    CompiledTemplate(code, content or "", EMAIL_CONTENT_FIELDS),
+                )
+        with template_registry_lock:
+            if emails is not None:
+                template_registry["emails"] = emails
+                template_registry["emails_version"] = version
+            template_registry["emails_checked"] = time.time()
+        if emails is not None:
+            logging.info(f"Loaded {len(emails)} email templates")
+    except Exception as e:
+        if template_registry["emails_version"] is None:
+            raise
+        # Đã có template: dùng tiếp bản cũ, lần kiểm tra sau mới thử lại
+        logging.error(f"Error: {e}")
+        with template_registry_lock:
+            template_registry["emails_checked"] = time.time()
+    finally:
+        with template_registry_lock:
+            template_registry["emails_refreshing"] = False
 
 def update_ticket_email(cursor, ticket_id, ticket_email):
     query = """
@@ -17,45 +174,37 @@ def update_ticket_email(cursor, ticket_id, ticket_email):
 
 def get_email_template(cursor, template, logging):
     """
-    Lấy template email từ database.
+    Lấy template email (tiêu đề, nội dung) đã biên dịch từ registry.
     """
     try:
         ma_template = template.split(" - ", 1)[-1]
         logging.info(f"ma_template {ma_template}")
-        query = """
-            SELECT c_tieu_de AS tieu_de, c_content AS content
-            FROM jwdb.app_fd_sp_template_email
-            WHERE c_ma_tempalet = %s
-        """
-        cursor.execute(query, (ma_template,))
-        template_result = cursor.fetchone()
-
-        if template_result:
-            # tieu_de = template_result[0]
-            # content = template_result[1]
-            # logging.info(f"{tieu_de} {content}")
-            return template_result[0], template_result[1]
+        reload_email_templates(cursor)
+        return template_registry["emails"].get(template_key(ma_template))
 
     except Exception as e:
         # Bắt tất cả các lỗi không xác định
         logging.error(f"Error: {e}")
-    
-def fill_template(content, data, logging):
+
+
+def fill_template(template, data, logging):
     """
     Thay thế placeholder trong nội dung email bằng dữ liệu thực tế từ `assignment`.
+    Template lỗi (đã báo khi nạp) thì trả về nội dung gốc như trước.
     """
     try:
-        return content.format(**data)
-    
+        rendered = template.render(data)
+        return template.text if rendered is None else rendered
+
     except KeyError as e:
         logging.error(f"Lỗi: Thiếu trường {e} trong dữ liệu để thay vào template.")
-        return content
+        return template.text
 
 
 def handle_template(cursor, template, data_map, data_tieude, logging):
     try:
         tieu_de, content = get_email_template(cursor, template, logging)
-        logging.info(f"content {content}")
+        logging.info(f"content {content.text}")
         logging.info(f"template {template}")
         content_data = fill_template(content, data_map, logging)
         tieu_de_data = fill_template(tieu_de, data_tieude, logging)
@@ -80,8 +229,8 @@ def handler_its_ho(assignment, api, status, ticket_id, rabbitmq_channel, logging
                 ticket_email = "HO-Rui ro"
             else:
                 ticket_email = "HO"
+        # Người gọi commit: trong worker đây là transaction fence của dòng outbox
         update_ticket_email(conn.cursor(), ticket_id, ticket_email)
-        conn.commit()
 
         if len(status.split("+")) < 3:
             logging.warn(f"[!] Ticket {assignment.get('c_maTicket')} has invalid status to send to API - {status}")
@@ -154,8 +303,7 @@ def handler_its_ho(assignment, api, status, ticket_id, rabbitmq_channel, logging
                 "content": content,
                 "phone_number": phone_number,
             }
-            file_template_path = "/home/Python/template/ITs.txt"
-            description = get_template(file_template_path, data)
+            description = get_template(ITS_TEMPLATE_PATH, data)
             subject = f"[Tổng đài CSKH - {ma_ticket}] - {l1} - {l2} - {ten_dn}"
 
         else:
@@ -202,7 +350,7 @@ def handler_its_ho(assignment, api, status, ticket_id, rabbitmq_channel, logging
                         "DanhMucYeuCau": l4,
                         "content": content,
                     }
-                    description = get_template("/home/Python/template/15_Gopy_ho.txt", data)
+                    description = get_template(GOPY_TEMPLATE_PATH, data)
 
                 # Khác
                 else:
@@ -234,7 +382,6 @@ def handler_its_ho(assignment, api, status, ticket_id, rabbitmq_channel, logging
 
         cursor_update = conn.cursor()
         # update_flag_api(cursor_update, ticket_id, api)
-        conn.commit()
 
     except Exception as e:
         logging.error(f"[!] Fail to send to Ticket_API queue: {e}", exc_info=True)
@@ -242,46 +389,7 @@ def handler_its_ho(assignment, api, status, ticket_id, rabbitmq_channel, logging
 
 def fetch_data(cursor, phanloai_id, nhomyeucau_id, danhmucyeucau_id, level4):
     try:
-        query_l1 = """
-            SELECT a.c_ten_phan_loai
-            FROM jwdb.app_fd_sp_phanloai a
-            WHERE id = %s
-            """
-        cursor.execute(query_l1, (phanloai_id,))
-        result_1 = cursor.fetchone()
-        l1 = result_1[0] if result_1 else ""
-
-        query_l2 = """
-            SELECT n.c_ten_nhom_yeucau
-            FROM jwdb.app_fd_sp_nhomyeucau n
-            WHERE id = %s
-            """
-        cursor.execute(query_l2, (nhomyeucau_id,))
-        result_2 = cursor.fetchone()
-        l2 = result_2[0] if result_2 else ""
-
-        query_l3 = """
-            SELECT d.c_ten_danh_muc_yeucau
-            FROM jwdb.app_fd_sp_danhmucyeucau d
-            WHERE id = %s
-            """
-        cursor.execute(query_l3, (danhmucyeucau_id,))
-        result_3 = cursor.fetchone()
-        l3 = result_3[0] if result_3 else ""
-
-        if level4:
-            query_l4 = """
-                SELECT d.c_ten_level_4
-                FROM jwdb.app_fd_sp_ql_lv4 d
-                WHERE id = %s
-                """
-            cursor.execute(query_l4, (level4,))
-            result_4 = cursor.fetchone()
-            l4 = result_4[0] if result_4 else ""
-        else:
-            l4 = ""
-
-        return l1, l2, l3, l4
+        return get_level_names(cursor, phanloai_id, nhomyeucau_id, danhmucyeucau_id, level4)
 
     except Exception as e:
         logging.error(f"Error: {e}")
@@ -289,11 +397,7 @@ def fetch_data(cursor, phanloai_id, nhomyeucau_id, danhmucyeucau_id, level4):
 
 def get_template(template_path, data):
     try:
-        with open(template_path, "r", encoding="utf-8") as file:
-            html_template = file.read()
-
-        description = html_template.format(**data)
-        return description
+        return get_file_template(template_path).render(data)
 
     except Exception as e:
         logging.error(f"Error: {e}")
\ No newline at end of file